@@ -0,0 +1,236 @@
+"""
+Benchmark the classification pipeline on synthetic thin sections.
+
+Builds synthetic thin-section images (mineral grains plus small dark carbon
+specks) at several sizes and grain densities, times every pipeline stage for
+each model type and writes the results as JSON so throughput and peak memory
+can be compared between versions:
+
+    python benchmarks/bench_pipeline.py --sizes 1 10 50 200 --output bench.json
+
+Stages: train (sample features + fitting), detect_carbon, features, scaling,
+inference, statistics and save (figures, CSV and TIFF). Each stage reports
+wall and CPU time, pixels per second and peak traced memory (see RunProfiler).
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import mineral_classifier_Version6 as mc  # noqa: E402
+
+# Mean RGB colors of the synthetic minerals (all brighter than the carbon threshold)
+MINERAL_PALETTE = np.array([
+    (225, 225, 220),  # quartz-like
+    (200, 170, 150),  # feldspar-like
+    (130, 90, 50),    # biotite-like
+    (110, 160, 80),   # olivine-like
+], dtype=np.int16)
+CARBON_COLOR = 12
+NOISE_LEVEL = 8
+# Default GUI settings
+CARBON_THRESHOLD = 30
+CARBON_BLOB_SIZE = 100
+OTHER_THRESHOLD = 50.0
+SAMPLES_PER_MINERAL = 30
+# Random batches of 4096 candidate pixels tried per mineral before giving up on it
+MAX_SAMPLE_BATCHES = 200
+MODEL_TYPES = ("knn", "svm", "rf", "kmeans")
+
+
+def make_thin_section(megapixels, grain_density, carbon_density, seed=0, band_rows=1024):
+    """
+    Build a synthetic thin section of about megapixels million pixels (4:3).
+    grain_density is the number of mineral grains and carbon_density the number of
+    carbon specks per megapixel. Returns (image, labels), labels using the
+    classifier's class numbering (minerals, then carbon).
+    """
+    rng = np.random.default_rng(seed)
+    n_minerals = len(MINERAL_PALETTE)
+    w = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    h = int(megapixels * 1e6 / w)
+
+    # Coarse grid of grains, warped so the boundaries are not straight lines
+    cell = max(4, int(np.sqrt(1e6 / grain_density)))
+    grains = rng.integers(0, n_minerals, size=(h // cell + 3, w // cell + 3), dtype=np.uint8)
+    amplitude = cell / 3
+
+    image = np.empty((h, w, 3), dtype=np.uint8)
+    labels = np.empty((h, w), dtype=np.uint8)
+    xs = np.arange(w)
+    for start in range(0, h, band_rows):
+        end = min(start + band_rows, h)
+        ys = np.arange(start, end)[:, None]
+        rows = ((ys + amplitude * np.sin(xs / (0.7 * cell))) / cell + 1).astype(np.intp)
+        cols = ((xs + amplitude * np.sin(ys / (0.9 * cell))) / cell + 1).astype(np.intp)
+        band_labels = grains[rows, cols]
+        labels[start:end] = band_labels
+        noise = rng.integers(-NOISE_LEVEL, NOISE_LEVEL + 1, size=(end - start, w, 3), dtype=np.int16)
+        image[start:end] = np.clip(MINERAL_PALETTE[band_labels] + noise, 0, 255)
+
+    # Small dark specks, well below the default minimum blob size
+    n_specks = int(carbon_density * megapixels)
+    for _ in range(n_specks):
+        radius = int(rng.integers(1, 4))
+        y, x = int(rng.integers(0, h)), int(rng.integers(0, w))
+        image[max(0, y - radius):y + radius, max(0, x - radius):x + radius] = CARBON_COLOR
+        labels[max(0, y - radius):y + radius, max(0, x - radius):x + radius] = n_minerals
+
+    return image, labels
+
+
+def pick_samples(labels, n_per_class, seed=0):
+    """
+    Pick n_per_class random sample coordinates of every mineral class.
+    Classes that are absent (or too rare to find) in small images get fewer or no samples.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = labels.shape
+    xs, ys, y_labels = [], [], []
+    for c in range(len(MINERAL_PALETTE)):
+        found = 0
+        for _ in range(MAX_SAMPLE_BATCHES):
+            if found >= n_per_class:
+                break
+            cand_y = rng.integers(0, h, 4096)
+            cand_x = rng.integers(0, w, 4096)
+            hit = np.flatnonzero(labels[cand_y, cand_x] == c)[:n_per_class - found]
+            ys.extend(cand_y[hit])
+            xs.extend(cand_x[hit])
+            y_labels.extend([c] * len(hit))
+            found += len(hit)
+        if found < n_per_class:
+            print(f"mineral {c}: only {found} of {n_per_class} samples found", file=sys.stderr)
+    return np.array(xs), np.array(ys), np.array(y_labels)
+
+
+def benchmark_image(megapixels, grain_density, carbon_density, models, feature_set, trace_memory, output_dir):
+    """Benchmark every model on one synthetic image and return the result records"""
+    image, truth = make_thin_section(megapixels, grain_density, carbon_density)
+    h, w = truth.shape
+    n_minerals = len(MINERAL_PALETTE)
+    names = [f"mineral_{i}" for i in range(n_minerals)]
+    xs, ys, y_labels = pick_samples(truth, SAMPLES_PER_MINERAL)
+
+    # Carbon detection does not depend on the model
+    carbon_profiler = mc.RunProfiler(trace_memory=trace_memory)
+    with carbon_profiler.stage("detect_carbon", pixels=h * w):
+        carbon_mask = mc.detect_carbon_mask(image, CARBON_THRESHOLD, CARBON_BLOB_SIZE)
+
+    records = []
+    for model_type in models:
+        profiler = mc.RunProfiler(trace_memory=trace_memory)
+        profiler.stages.update({name: dict(stage) for name, stage in carbon_profiler.stages.items()})
+
+        with profiler.stage("train"):
+            X = mc.sample_features(image, xs, ys, feature_set)
+            classifier, scaler = mc.train_model(X, y_labels, model_type)
+
+        # Features, scaling and inference are timed inside the engine
+        result, confidence = mc.classify_image_array(image, classifier, scaler, model_type, carbon_mask,
+                                                     OTHER_THRESHOLD, n_minerals, feature_set=feature_set,
+                                                     profiler=profiler)
+        result_image = result.reshape(h, w)
+        confidence_image = confidence.reshape(h, w)
+
+        with profiler.stage("statistics", pixels=h * w):
+            percentages, pixel_counts, confidence_intervals = mc.compute_statistics(result_image, names)
+
+        with profiler.stage("save"):
+            fig = mc.create_results_figure(result_image, percentages)
+            mc.save_classification_files(output_dir, f"bench_{megapixels}mp_{model_type}", fig, result_image,
+                                         confidence_image, percentages, pixel_counts, confidence_intervals)
+
+        stages = profiler.report()['stages']
+        classify_seconds = sum(stages[name]['wall_seconds'] for name in ("features", "scaling", "inference")
+                               if name in stages)
+        records.append({
+            'megapixels': megapixels,
+            'width': w,
+            'height': h,
+            'grain_density': grain_density,
+            'carbon_density': carbon_density,
+            'model': model_type,
+            'feature_set': list(feature_set),
+            'stages': stages,
+            'classify_pixels_per_second': h * w / classify_seconds if classify_seconds else None,
+            # Cluster numbers of K-Means do not correspond to mineral labels
+            'accuracy': None if model_type == "kmeans" else float(np.mean(result_image == truth)),
+            'max_rss_bytes': mc.max_rss_bytes(),
+        })
+        print(f"{megapixels} MP, density {grain_density}, {model_type}: "
+              + ", ".join(f"{name} {stage['wall_seconds']:.2f}s" for name, stage in stages.items()),
+              file=sys.stderr)
+
+    return records
+
+
+def code_version():
+    """Git commit of the benchmarked code, if available"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 16],
+                        help="image sizes in megapixels (e.g. 1 10 50 200)")
+    parser.add_argument("--grain-densities", type=float, nargs="+", default=[50, 500],
+                        help="mineral grains per megapixel")
+    parser.add_argument("--carbon-density", type=float, default=200, help="carbon specks per megapixel")
+    parser.add_argument("--models", nargs="+", choices=MODEL_TYPES, default=list(MODEL_TYPES))
+    parser.add_argument("--features", nargs="*", choices=mc.FEATURE_OPTIONS, default=[],
+                        help="optional pixel features to enable")
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="skip tracemalloc peak memory measurement (lower overhead)")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    feature_set = tuple(name for name in mc.FEATURE_OPTIONS if name in args.features)
+    trace_memory = not args.no_trace_memory
+    if trace_memory:
+        tracemalloc.start()
+
+    records = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for megapixels in args.sizes:
+            for grain_density in args.grain_densities:
+                records.extend(benchmark_image(megapixels, grain_density, args.carbon_density, args.models,
+                                               feature_set, trace_memory, output_dir))
+
+    import sklearn
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'code_version': code_version(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'trace_memory': trace_memory,
+        'results': records,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
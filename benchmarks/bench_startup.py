@@ -0,0 +1,98 @@
+"""
+Benchmark application startup time.
+
+Each measurement runs in a fresh Python process so nothing is cached between
+runs. Two scenarios are measured:
+
+- import: importing the module, which is what headless entry points
+  (benchmarks, batch runs) pay before doing any work
+- gui: importing the module, creating the main window and drawing it once
+  (skipped when no display is available)
+
+The heavy modules still loaded after each scenario are listed, so a change
+that re-introduces an eager import is easy to spot. Pass --module to measure
+another version of the application file, e.g. an older release:
+
+    python benchmarks/bench_startup.py --repeat 10 --module old/mineral_classifier.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULE = os.path.join(REPO_ROOT, "mineral_classifier_Version6.py")
+HEAVY_MODULES = ("matplotlib", "sklearn", "skimage", "scipy", "tifffile")
+
+# Runs in the child process; prints one JSON line
+CHILD_SCRIPT = r"""
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("mineral_classifier_bench", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+window = None
+if sys.argv[2] == "gui":
+    root = module.tk.Tk()
+    app = module.MineralClassifier(root)
+    root.update()
+    window = time.perf_counter()
+    root.destroy()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "window_seconds": None if window is None else window - start,
+    "heavy_modules": sorted(name for name in sys.argv[3].split(",") if name in sys.modules),
+}))
+"""
+
+
+def measure(module_path, scenario):
+    """Run one scenario in a fresh interpreter and return its JSON result"""
+    completed = subprocess.run([sys.executable, "-c", CHILD_SCRIPT, module_path, scenario, ",".join(HEAVY_MODULES)],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs, key):
+    """Median / min / max of one timing over several runs"""
+    values = [run[key] for run in runs if run[key] is not None]
+    if not values:
+        return None
+    return {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark application startup time")
+    parser.add_argument("--module", default=DEFAULT_MODULE, help="application file to measure")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per scenario")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {'module': os.path.abspath(args.module), 'python': sys.version.split()[0], 'scenarios': {}}
+    for scenario in ("import", "gui"):
+        runs = [measure(args.module, scenario) for _ in range(args.repeat)]
+        if any(run is None for run in runs):
+            # No display for the GUI scenario (or the module failed to import)
+            report['scenarios'][scenario] = None
+            continue
+        report['scenarios'][scenario] = {
+            'import_seconds': summarize(runs, 'import_seconds'),
+            'window_seconds': summarize(runs, 'window_seconds'),
+            'heavy_modules': runs[-1]['heavy_modules'],
+        }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,2484 @@
 import os
+import sys
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk, ImageOps
+from PIL import Image, ImageDraw, ImageTk
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')  # Use TkAgg backend for matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from sklearn.cluster import KMeans
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import SVC
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler
-from skimage import measure, filters
-from scipy import ndimage
 import datetime
 import json
 import csv
-from scipy import stats
-import tifffile
+import itertools
+import re
+import hashlib
+import tempfile
+import time
+import contextlib
+import tracemalloc
+import cProfile
+import pickle
+import threading
+import queue
+import argparse
+import base64
+import collections
+import io
+import urllib.parse
+
+# matplotlib, scikit-learn, scikit-image, scipy and tifffile are imported inside
+# the functions that use them, so the window (or a headless caller) starts
+# without paying for the heavy scientific stack up front.
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Supported image file extensions (lowercase)
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+# Subfolder where classification results are written
+RESULTS_FOLDER_NAME = "mineral_classification_results"
+# Cached list of image paths, stored in the results folder
+IMAGE_INDEX_FILENAME = "image_index.txt"
+IMAGE_INDEX_HEADER = "# mineral classifier image index v1"
+# Number of paths pulled from the folder scanner per GUI idle callback
+SCAN_BATCH_SIZE = 500
+# Optional per-pixel features added to the raw channel values
+FEATURE_OPTIONS = ('hsv', 'lab', 'texture', 'gradient')
+# Window width for the local mean/variance texture features
+FEATURE_WINDOW = 5
+# Image rows processed per feature chunk (bounds the float32 feature memory)
+FEATURE_CHUNK_ROWS = 256
+# Images with more pixels are labelled for carbon detection in row bands with a disk-backed label map
+CARBON_STREAMING_PIXELS = 1 << 26
+# Image rows per band of the streaming carbon labeler
+CARBON_BAND_ROWS = 1024
+# Polarization suffix of paired images, e.g. "BOM-24-29-A-LPNA.JPG" / "BOM-24-29-A-LPA.JPG"
+# (LPNA/LPA: non-analysed/analysed polarized light, i.e. PPL/XPL)
+STACK_NAME_PATTERN = re.compile(r'^(?P<base>.+?)[-_ ](?P<mode>LPNA|LPA|PPL|XPL)$', re.IGNORECASE)
+# Channel order of the layers in a stack (plane-polarized first)
+STACK_MODE_ORDER = {'lpna': 0, 'ppl': 0, 'lpa': 1, 'xpl': 1}
+# Subfolder of the results folder holding decoded, memory-mappable image layers
+STACK_CACHE_FOLDER_NAME = "stack_cache"
+# Size cap of a decoded-layer cache folder; least recently used layers are removed first
+STACK_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Mineral selections are stored per image as {image}_selections.npz (JSON from older versions is still read)
+SELECTIONS_SUFFIX = "_selections"
+SELECTIONS_FORMAT_VERSION = 1
+# Maximum number of selected pixels listed individually in the GUI
+SELECTION_LIST_LIMIT = 200
+# Sample selection tools: single pixels, or every pixel covered by a region
+SELECTION_TOOLS = ('point', 'rectangle', 'polygon', 'brush')
+# Model trained on the selections of all images, cached in the results folder
+CAMPAIGN_MODEL_FILENAME = "campaign_model.pkl"
+CAMPAIGN_MODEL_VERSION = 1
+# Block bootstrap confidence intervals: tile size (pixels), replicates, and the
+# maximum number of blocks (neighbouring tiles are merged on very large maps)
+BOOTSTRAP_TILE_SIZE = 64
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_MAX_BLOCKS = 2048
+# Replicate weights held in memory at once (elements)
+BOOTSTRAP_CHUNK_ELEMENTS = 1 << 22
+# Default classification settings (the GUI starts with the same values)
+DEFAULT_SETTINGS = {
+    'carbon_threshold': 30,
+    'min_blob_size': 100,
+    'other_threshold': 50.0,
+    'postprocess': "none",  # "none", "majority" or "superpixels"
+    'majority_size': 3,
+    'n_segments': 2000,
+    'ci_method': "binomial",  # "binomial" or "bootstrap"
+    'bootstrap_tile_size': BOOTSTRAP_TILE_SIZE,
+}
+# Preview classification: about this many pixels are classified first, then
+# full-resolution pixels near class boundaries or below this confidence are refined
+PREVIEW_PIXELS = 250000
+PREVIEW_CONFIDENCE = 0.6
+# Label overlay colors: minerals cycle through matplotlib's tab10 palette
+OVERLAY_MINERAL_COLORS = (
+    (31, 119, 180), (255, 127, 14), (44, 160, 44), (214, 39, 40), (148, 103, 189),
+    (140, 86, 75), (227, 119, 194), (127, 127, 127), (188, 189, 34), (23, 190, 207),
+)
+OVERLAY_CARBON_COLOR = (0, 0, 0)
+OVERLAY_OTHER_COLOR = (255, 0, 255)
+# Decoded images / finished results held between the stages of a batch run
+BATCH_QUEUE_SIZE = 4
+# Selection set ID of the campaign model in the HTTP service
+CAMPAIGN_SELECTION_SET = "campaign"
+# Largest image accepted by the HTTP service
+MAX_UPLOAD_BYTES = 1 << 30
+
+
+def scan_image_folder(folder_path, recursive=True, skip_dirs=(RESULTS_FOLDER_NAME,)):
+    """
+    Lazily yield image paths below folder_path in a stable order.
+    Entries are sorted by name within each directory; the files of a directory
+    are yielded before its subdirectories are visited (depth-first).
+    """
+    # Explicit stack instead of recursion so deep archives cannot hit the recursion limit
+    pending_dirs = [folder_path]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            with os.scandir(current_dir) as it:
+                entries = sorted(it, key=lambda e: (e.name.lower(), e.name))
+        except OSError:
+            # Unreadable directory - skip it rather than aborting the whole scan
+            continue
+        
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if recursive and entry.name not in skip_dirs and not entry.name.startswith('.'):
+                        subdirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+            except OSError:
+                continue
+        
+        # Push in reverse so subdirectories are visited in sorted order
+        pending_dirs.extend(reversed(subdirs))
+
+
+def iter_image_paths(folder_path, index_path=None, refresh=False):
+    """
+    Yield image paths below folder_path, optionally through a cached index file.
+    If index_path exists (and refresh is False) the paths are read from it;
+    otherwise the folder is scanned and the index is written as paths are yielded.
+    The index is only committed once the scan has run to completion.
+    """
+    if index_path and not refresh and os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            if f.readline().rstrip('\n') == IMAGE_INDEX_HEADER:
+                for line in f:
+                    rel_path = line.rstrip('\n')
+                    if rel_path:
+                        yield os.path.join(folder_path, rel_path)
+                return
+        # Unknown or outdated index format - fall through and rebuild it
+    
+    if not index_path:
+        yield from scan_image_folder(folder_path)
+        return
+    
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    completed = False
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(IMAGE_INDEX_HEADER + "\n")
+            for path in scan_image_folder(folder_path):
+                # Store relative paths so the archive can be moved or remounted
+                f.write(os.path.relpath(path, folder_path) + "\n")
+                yield path
+        completed = True
+        os.replace(tmp_path, index_path)
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def max_rss_bytes():
+    """Peak resident set size of this process so far, or None if unavailable"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class RunProfiler:
+    """
+    Opt-in timing and memory instrumentation of the classification stages.
+    Wrap each stage in "with profiler.stage(name, pixels):". Repeated stages
+    (e.g. one per chunk or batch) accumulate; nested stages are allowed and their
+    peak memory counts towards the enclosing stage. A disabled profiler only
+    costs one attribute check per stage.
+    """
+    def __init__(self, enabled=True, trace_memory=True, use_cprofile=False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.use_cprofile = use_cprofile
+        self.stages = {}
+        self.metadata = {}
+        self._open_stages = []
+        self._started_tracemalloc = False
+        self._cprofile = None
+        self._start_wall = None
+        self._total_wall = None
+    
+    def start(self):
+        """Start the run (tracemalloc and cProfile, if requested)"""
+        if not self.enabled:
+            return
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if self.use_cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._start_wall = time.perf_counter()
+        self._total_wall = None
+    
+    def stop(self):
+        """Stop the run and the tracers started by start(); later calls do nothing"""
+        if not self.enabled or self._start_wall is None or self._total_wall is not None:
+            return
+        self._total_wall = time.perf_counter() - self._start_wall
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+    
+    @contextlib.contextmanager
+    def stage(self, name, pixels=None):
+        """Measure wall time, CPU time and peak memory of the enclosed block"""
+        if not self.enabled:
+            yield
+            return
+        
+        tracing = tracemalloc.is_tracing()
+        # tracemalloc.reset_peak is new in Python 3.9; without it the peak is only
+        # known for stages that raise the overall peak
+        can_reset_peak = hasattr(tracemalloc, "reset_peak")
+        frame = {'child_peak': 0, 'baseline': 0, 'start_peak': 0}
+        if tracing:
+            frame['baseline'], frame['start_peak'] = tracemalloc.get_traced_memory()
+            if can_reset_peak:
+                tracemalloc.reset_peak()
+        self._open_stages.append(frame)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            self._open_stages.pop()
+            
+            record = self.stages.setdefault(name, {
+                'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'pixels': 0,
+                'peak_traced_bytes': None, 'max_rss_bytes': None,
+            })
+            record['calls'] += 1
+            record['wall_seconds'] += wall
+            record['cpu_seconds'] += cpu
+            if pixels is not None:
+                record['pixels'] += int(pixels)
+            if tracing:
+                # Absolute peak, including peaks of nested stages that reset the counter
+                peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+                if self._open_stages:
+                    parent = self._open_stages[-1]
+                    parent['child_peak'] = max(parent['child_peak'], peak)
+                if can_reset_peak or peak > frame['start_peak']:
+                    record['peak_traced_bytes'] = max(record['peak_traced_bytes'] or 0, peak - frame['baseline'])
+            record['max_rss_bytes'] = max_rss_bytes()
+    
+    def report(self):
+        """Return the per-stage measurements as a JSON-serializable dict"""
+        stages = {}
+        for name, record in self.stages.items():
+            stage = dict(record)
+            stage['pixels_per_second'] = (record['pixels'] / record['wall_seconds']
+                                          if record['pixels'] and record['wall_seconds'] else None)
+            stages[name] = stage
+        return {
+            'metadata': self.metadata,
+            'total_wall_seconds': self._total_wall,
+            'max_rss_bytes': max_rss_bytes(),
+            'stages': stages,
+        }
+    
+    def summary(self):
+        """One line per stage, for display"""
+        return [f"{name}: {record['wall_seconds']:.3f} s wall, {record['cpu_seconds']:.3f} s CPU"
+                for name, record in self.stages.items()]
+    
+    def write_report(self, path_prefix):
+        """Write {path_prefix}.json (and {path_prefix}.prof for cProfile runs); return the paths"""
+        paths = [path_prefix + ".json"]
+        with open(paths[0], 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        if self._cprofile is not None:
+            paths.append(path_prefix + ".prof")
+            self._cprofile.dump_stats(paths[1])
+        return paths
+
+
+# Shared no-op profiler for callers that do not instrument a run
+NO_PROFILER = RunProfiler(enabled=False)
+
+
+def image_max_value(dtype):
+    """Full-scale value of an image dtype (float images are assumed to be in 0-1)"""
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).max
+    return 1.0
+
+
+def normalize_image(array):
+    """
+    Apply the input channel and dtype policy, returning views wherever possible.
+    - Channels: the result is always (h, w, channels). Grayscale gets a channel
+      axis, alpha is dropped (RGBA -> RGB, LA -> L), planar (channels, h, w)
+      TIFF data is transposed and extra pages/planes keep only the first one.
+      All of these are views of the input.
+    - Dtype: uint8, uint16 and floating point data are kept as is; bool and
+      other integer types are converted to uint8/uint16 (one copy).
+    """
+    # Multi-page or volumetric data: keep the first page
+    while array.ndim > 3:
+        array = array[0]
+    
+    if array.ndim == 2:
+        array = array[..., None]
+    elif array.shape[2] > 4 and array.shape[0] <= 4:
+        # Planar configuration (channels first)
+        array = np.moveaxis(array, 0, -1)
+    
+    if array.shape[2] in (2, 4):
+        # Drop the alpha channel
+        array = array[..., :-1]
+    
+    if array.dtype == np.bool_:
+        array = array.astype(np.uint8)
+        array *= 255
+    elif np.issubdtype(array.dtype, np.integer) and array.dtype not in (np.uint8, np.uint16):
+        if array.size and (array.min() < 0 or array.max() > np.iinfo(np.uint16).max):
+            raise ValueError(f"Unsupported pixel value range for {array.dtype} image")
+        array = array.astype(np.uint16)
+    
+    return array
+
+
+def _read_with_pil(path):
+    """Decode an image with PIL into a numpy array, expanding palette and other special modes"""
+    with Image.open(path) as img:
+        if img.mode in ('P', 'PA', 'CMYK', 'YCbCr', 'LAB', 'HSV'):
+            img = img.convert('RGB')
+        elif img.mode == '1':
+            img = img.convert('L')
+        return np.asarray(img)
+
+
+def load_image_array(path):
+    """
+    Read an image file into a normalized (h, w, channels) array (see normalize_image).
+    TIFFs are read with tifffile, so 16-bit and multi-channel microscope data keep
+    their full depth; the decoded buffer is the only copy made.
+    """
+    if path.lower().endswith(('.tif', '.tiff')):
+        import tifffile
+        try:
+            return normalize_image(tifffile.imread(path))
+        except (ValueError, tifffile.TiffFileError):
+            # Not readable by tifffile - fall back to PIL
+            pass
+    return normalize_image(_read_with_pil(path))
+
+
+def decode_image_bytes(data):
+    """Decode an image file held in memory (e.g. an HTTP upload), like load_image_array"""
+    if data[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        import tifffile
+        try:
+            return normalize_image(tifffile.imread(io.BytesIO(data)))
+        except (ValueError, tifffile.TiffFileError):
+            # Not readable by tifffile - fall back to PIL
+            pass
+    return normalize_image(_read_with_pil(io.BytesIO(data)))
+
+
+def display_image(image):
+    """
+    Return an 8-bit PIL image for displaying a normalized image array.
+    16-bit data keeps its high byte and float data is scaled in float32, both
+    per row chunk, so the 8-bit output is the only full-size allocation.
+    """
+    image = image[..., :1] if image.shape[2] == 1 else image[..., :3]
+    if image.dtype != np.uint8:
+        display = np.empty(image.shape, dtype=np.uint8)
+        scale = np.float32(255.0 / image_max_value(image.dtype))
+        for start in range(0, image.shape[0], FEATURE_CHUNK_ROWS):
+            chunk = np.asarray(image[start:start + FEATURE_CHUNK_ROWS])
+            if chunk.dtype == np.uint16:
+                chunk = chunk >> 8
+            else:
+                chunk = chunk.astype(np.float32) * scale
+                np.clip(chunk, 0, 255, out=chunk)
+            display[start:start + FEATURE_CHUNK_ROWS] = chunk
+        image = display
+    if image.shape[2] == 1:
+        return Image.fromarray(image[..., 0])
+    return Image.fromarray(np.ascontiguousarray(image))
+
+
+def grayscale(image):
+    """
+    Luminance of an (h, w, channels) image block using ITU-R 601 weights.
+    8-bit data is rounded exactly like PIL's grayscale conversion; 16-bit and
+    float data use a float32 weighted sum. Single-channel images are returned as a view.
+    """
+    if image.shape[2] < 3:
+        return image[..., 0]
+    if image.dtype == np.uint8:
+        # PIL's fixed-point conversion: L = (R*19595 + G*38470 + B*7471 + 0x8000) >> 16
+        gray = image[..., 0].astype(np.uint32) * 19595
+        gray += image[..., 1].astype(np.uint32) * 38470
+        gray += image[..., 2].astype(np.uint32) * 7471
+        gray += 0x8000
+        return (gray >> 16).astype(np.uint8)
+    gray = image[..., 0].astype(np.float32) * np.float32(0.299)
+    gray += image[..., 1].astype(np.float32) * np.float32(0.587)
+    gray += image[..., 2].astype(np.float32) * np.float32(0.114)
+    return gray
+
+
+def dark_pixel_mask(image, threshold, chunk_rows=FEATURE_CHUNK_ROWS):
+    """
+    Boolean mask of pixels whose luminance is below threshold (given on the 0-255 scale).
+    Stacks use their plane-polarized layer. Luminance is computed per row chunk,
+    so the only full-size allocation is the mask itself.
+    """
+    image = primary_layer(image)
+    h, w = image.shape[:2]
+    # Express the 8-bit threshold in the units of the image dtype
+    scaled_threshold = threshold * image_max_value(image.dtype) / 255.0
+    
+    mask = np.empty((h, w), dtype=bool)
+    for start in range(0, h, chunk_rows):
+        end = min(start + chunk_rows, h)
+        mask[start:end] = grayscale(np.asarray(image[start:end])) < scaled_threshold
+    return mask
+
+
+def detect_carbon_mask(image, threshold, min_blob_size, work_dir=None):
+    """
+    Detect carbon (graphite) in the image.
+    Carbon appears as diffuse black areas: dark connected regions smaller than
+    min_blob_size pixels. Images larger than CARBON_STREAMING_PIXELS are labelled
+    band by band (see detect_carbon_mask_streaming), with the same result.
+    """
+    from scipy import ndimage
+    
+    h, w = image.shape[:2]
+    if h * w > CARBON_STREAMING_PIXELS:
+        return detect_carbon_mask_streaming(image, threshold, min_blob_size, work_dir=work_dir)
+    
+    # Binary threshold for dark areas
+    binary = dark_pixel_mask(image, threshold)
+    
+    # Label connected regions
+    labeled_array, num_features = ndimage.label(binary)
+    
+    # Calculate sizes of labeled regions and keep the small ones (label 0 is background)
+    sizes = np.bincount(labeled_array.ravel(), minlength=num_features + 1)
+    small_region = sizes < min_blob_size
+    small_region[0] = False
+    
+    return small_region[labeled_array]
+
+
+def find_label_roots(parent, pairs):
+    """
+    Union-find over component labels: join every (a, b) pair of pairs in
+    parent (parent[i] == i for roots, updated in place) and return the root
+    label of every label.
+    """
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]  # Path halving
+            label = parent[label]
+        return label
+    
+    for a, b in pairs.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            # The smaller label becomes the root, so roots stay in band order
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    
+    # Point every label directly at its root
+    roots = parent
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+def detect_carbon_mask_streaming(image, threshold, min_blob_size, band_rows=CARBON_BAND_ROWS, work_dir=None,
+                                 out=None):
+    """
+    Out-of-core version of detect_carbon_mask for images larger than memory.
+    Pass 1 labels the dark pixels of each band of band_rows rows with
+    ndimage.label, offsets the labels so they are unique over the image, writes
+    them to a temporary memory-mapped file in work_dir (system temp folder by
+    default) and counts the pixels of every label. Labels touching across a band
+    boundary (4-connectivity, like ndimage.label) are merged with union-find and
+    their sizes summed. Pass 2 reads the labels back band by band and marks the
+    pixels of components smaller than min_blob_size. out can be a preallocated
+    (e.g. memory-mapped) boolean array receiving the mask.
+    """
+    from scipy import ndimage
+    
+    h, w = image.shape[:2]
+    if out is None:
+        out = np.empty((h, w), dtype=bool)
+    # At most every other pixel starts a new component
+    label_dtype = np.int32 if (h * w + 1) // 2 < np.iinfo(np.int32).max else np.int64
+    
+    with tempfile.TemporaryFile(dir=work_dir) as label_file:
+        labels = np.memmap(label_file, dtype=label_dtype, mode='w+', shape=(h, w))
+        
+        # Pass 1: label every band, collect sizes and the pairs touching across band boundaries
+        sizes = [np.zeros(1, dtype=np.int64)]  # Label 0 is background
+        pairs = []
+        n_labels = 0
+        previous_row = None
+        for start in range(0, h, band_rows):
+            end = min(start + band_rows, h)
+            band_labels, n_band = ndimage.label(dark_pixel_mask(primary_layer(image)[start:end], threshold))
+            # Sizes from the band-local labels, before they are offset past the labels of earlier bands
+            sizes.append(np.bincount(band_labels.ravel(), minlength=n_band + 1)[1:])
+            band_labels = band_labels.astype(label_dtype, copy=False)
+            band_labels[band_labels > 0] += n_labels
+            labels[start:end] = band_labels
+            
+            if previous_row is not None:
+                touching = (previous_row > 0) & (band_labels[0] > 0)
+                if touching.any():
+                    pairs.append(np.unique(np.stack([previous_row[touching], band_labels[0][touching]], axis=1),
+                                           axis=0))
+            previous_row = band_labels[-1].copy()
+            n_labels += n_band
+        
+        # Merge components across bands and sum their sizes onto the root label
+        parent = np.arange(n_labels + 1, dtype=label_dtype)
+        if pairs:
+            roots = find_label_roots(parent, np.concatenate(pairs))
+        else:
+            roots = parent
+        sizes = np.concatenate(sizes)
+        component_sizes = np.bincount(roots, weights=sizes, minlength=n_labels + 1)
+        small_label = component_sizes[roots] < min_blob_size
+        small_label[0] = False
+        
+        # Pass 2: mark the pixels of small components
+        for start in range(0, h, band_rows):
+            end = min(start + band_rows, h)
+            out[start:end] = small_label[labels[start:end]]
+        del labels
+    
+    return out
+
+
+def stack_key(path):
+    """Return (group key, layer order) for a polarization-suffixed file name, or None"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    match = STACK_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+    key = (os.path.dirname(path), match.group('base').lower())
+    return key, STACK_MODE_ORDER[match.group('mode').lower()]
+
+
+def group_image_stacks(paths):
+    """
+    Group a stream of image paths into co-registered stacks.
+    Yields lists of paths ordered by STACK_MODE_ORDER (plane-polarized first);
+    files without a polarization suffix are yielded on their own. Paths are
+    buffered one directory at a time, so the stream stays lazy.
+    """
+    def flush(directory_paths):
+        groups = {}
+        order = []
+        for path in directory_paths:
+            key = stack_key(path)
+            group_id = key[0] if key is not None else path
+            if group_id not in groups:
+                groups[group_id] = []
+                order.append(group_id)
+            groups[group_id].append((key[1] if key is not None else 0, path))
+        for group_id in order:
+            yield [path for _, path in sorted(groups[group_id])]
+    
+    current_dir = None
+    buffered = []
+    for path in paths:
+        directory = os.path.dirname(path)
+        if directory != current_dir and buffered:
+            yield from flush(buffered)
+            buffered = []
+        current_dir = directory
+        buffered.append(path)
+    yield from flush(buffered)
+
+
+def open_memmapped_image(path, cache_dir=None):
+    """
+    Return the pixels of an image file as a read-only memory-mapped array.
+    Uncompressed TIFFs are mapped directly; other formats are decoded once into
+    an .npy file in cache_dir and mapped from there, so the decoded pixels live
+    in the page cache instead of the Python heap. Writing a new cache entry
+    removes older entries of the same file and keeps the folder below
+    STACK_CACHE_MAX_BYTES (see prune_image_cache).
+    """
+    if path.lower().endswith(('.tif', '.tiff')):
+        import tifffile
+        try:
+            return normalize_image(tifffile.memmap(path, mode='r'))
+        except ValueError:
+            # Compressed or tiled TIFF - decode it like any other format
+            pass
+    
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), "mineral_classifier_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    # Cache key changes whenever the source file is modified
+    stat = os.stat(path)
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    base_filename = os.path.splitext(os.path.basename(path))[0]
+    source_prefix = f"{base_filename}_{digest}_"
+    cache_path = os.path.join(cache_dir, f"{source_prefix}{stat.st_size}_{stat.st_mtime_ns}.npy")
+    
+    if os.path.exists(cache_path):
+        # Mark as recently used for the size cap
+        os.utime(cache_path)
+    else:
+        pixels = _read_with_pil(path)
+        tmp_path = cache_path + ".tmp.npy"
+        np.save(tmp_path, pixels)
+        del pixels
+        os.replace(tmp_path, cache_path)
+        prune_image_cache(cache_dir, cache_path, source_prefix)
+    
+    return normalize_image(np.load(cache_path, mmap_mode='r'))
+
+
+def prune_image_cache(cache_dir, keep_path, source_prefix, max_bytes=STACK_CACHE_MAX_BYTES):
+    """
+    Remove superseded decoded layers of a source file (names starting with
+    source_prefix, other than keep_path), then the least recently used layers
+    until the cache folder holds at most max_bytes. keep_path is never removed.
+    Files that cannot be removed (e.g. still mapped on Windows) are left alone.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, name)
+        if not name.endswith(".npy") or entry_path == keep_path:
+            continue
+        try:
+            if name.startswith(source_prefix):
+                # Older version of the same source file
+                os.remove(entry_path)
+                continue
+            stat = os.stat(entry_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+    
+    total = sum(size for _, size, _ in entries) + os.path.getsize(keep_path)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+        total -= size
+
+
+class ImageStack:
+    """
+    Co-registered images exposed as a single (h, w, channels) array.
+    The layers are never concatenated as a whole: indexing concatenates only the
+    requested rows, so chunked feature extraction over a stack needs no more
+    memory than over a single image.
+    """
+    def __init__(self, layers):
+        # Every layer as an (h, w, channels) view
+        self.layers = [normalize_image(layer) for layer in layers]
+        h, w = self.layers[0].shape[:2]
+        for layer in self.layers[1:]:
+            if layer.shape[:2] != (h, w):
+                raise ValueError(f"Stack layers are not co-registered: {layer.shape[:2]} vs {(h, w)}")
+        self.shape = (h, w, sum(layer.shape[2] for layer in self.layers))
+        self.dtype = np.result_type(*[layer.dtype for layer in self.layers])
+        self.ndim = 3
+    
+    @property
+    def primary(self):
+        """The first (plane-polarized) layer"""
+        return self.layers[0]
+    
+    def __getitem__(self, key):
+        # Row/column indexing only; the channel axis is formed by the layers
+        return np.concatenate([np.asarray(layer[key]) for layer in self.layers], axis=-1)
+
+
+def load_image_stack(paths, cache_dir=None):
+    """Open the co-registered images in paths as a memory-mapped ImageStack"""
+    return ImageStack([open_memmapped_image(path, cache_dir) for path in paths])
+
+
+def primary_layer(image):
+    """Return the image itself, or the first layer of an ImageStack"""
+    return image.primary if isinstance(image, ImageStack) else image
+
+
+def feature_halo(feature_set):
+    """Number of overlap rows a chunk needs so neighbourhood features match the full image"""
+    if 'texture' in feature_set or 'gradient' in feature_set:
+        # Radius of the texture window, which also covers the 3x3 Sobel kernel
+        return max(FEATURE_WINDOW // 2, 1)
+    return 0
+
+
+def compute_features(image, feature_set=()):
+    """
+    Compute per-pixel features for an (h, w, channels) image block.
+    Returns an (h, w, n_features) float32 array: the raw channels followed by the
+    features in feature_set, in FEATURE_OPTIONS order.
+    """
+    block = image.astype(np.float32)
+    features = [block]
+    
+    # Color space conversions need an RGB image scaled to 0-1
+    if image.shape[2] >= 3 and ('hsv' in feature_set or 'lab' in feature_set):
+        from skimage.color import rgb2hsv, rgb2lab
+        rgb = block[..., :3] / np.float32(image_max_value(image.dtype))
+        if 'hsv' in feature_set:
+            features.append(rgb2hsv(rgb).astype(np.float32))
+        if 'lab' in feature_set:
+            features.append(rgb2lab(rgb).astype(np.float32))
+    
+    if 'texture' in feature_set or 'gradient' in feature_set:
+        from scipy import ndimage
+        if image.shape[2] >= 3:
+            gray = block[..., 0] * 0.299 + block[..., 1] * 0.587 + block[..., 2] * 0.114
+        else:
+            gray = block.mean(axis=2)
+        
+        if 'texture' in feature_set:
+            # Local mean and variance over a FEATURE_WINDOW x FEATURE_WINDOW window
+            local_mean = ndimage.uniform_filter(gray, size=FEATURE_WINDOW, mode='reflect')
+            local_sq_mean = ndimage.uniform_filter(gray * gray, size=FEATURE_WINDOW, mode='reflect')
+            local_var = np.maximum(local_sq_mean - local_mean * local_mean, 0)
+            features.append(local_mean[..., None])
+            features.append(local_var[..., None])
+        
+        if 'gradient' in feature_set:
+            gradient = np.hypot(ndimage.sobel(gray, axis=0, mode='reflect'),
+                                ndimage.sobel(gray, axis=1, mode='reflect'))
+            features.append(gradient[..., None])
+    
+    if len(features) == 1:
+        return block
+    return np.concatenate(features, axis=2)
+
+
+def _feature_rows(image, start, end, feature_set, halo):
+    """Features of image rows start:end, computed on a block extended by halo rows"""
+    lo = max(0, start - halo)
+    hi = min(image.shape[0], end + halo)
+    block = compute_features(image[lo:hi], feature_set)
+    return block[start - lo:end - lo]
+
+
+def iter_feature_chunks(image, feature_set=(), chunk_rows=FEATURE_CHUNK_ROWS, profiler=NO_PROFILER):
+    """
+    Yield (row_start, row_end, features) for consecutive row chunks of image.
+    features is a flat (rows * w, n_features) float32 array; chunks overlap by a
+    halo so the results equal compute_features on the whole image.
+    """
+    h, w = image.shape[:2]
+    halo = feature_halo(feature_set)
+    for start in range(0, h, chunk_rows):
+        end = min(start + chunk_rows, h)
+        with profiler.stage("features", pixels=(end - start) * w):
+            features = _feature_rows(image, start, end, feature_set, halo)
+        yield start, end, features.reshape(-1, features.shape[2])
+
+
+def sample_features(image, xs, ys, feature_set=(), chunk_rows=FEATURE_CHUNK_ROWS):
+    """
+    Features of the pixels at (xs, ys), computed with the same chunking as
+    iter_feature_chunks so training samples match the features seen at inference.
+    """
+    xs = np.asarray(xs, dtype=np.intp)
+    ys = np.asarray(ys, dtype=np.intp)
+    h = image.shape[0]
+    halo = feature_halo(feature_set)
+    
+    result = None
+    chunk_ids = ys // chunk_rows
+    for chunk_id in np.unique(chunk_ids):
+        start = int(chunk_id) * chunk_rows
+        end = min(start + chunk_rows, h)
+        features = _feature_rows(image, start, end, feature_set, halo)
+        if result is None:
+            result = np.empty((len(xs), features.shape[2]), dtype=np.float32)
+        in_chunk = chunk_ids == chunk_id
+        result[in_chunk] = features[ys[in_chunk] - start, xs[in_chunk]]
+    
+    if result is None:
+        result = np.empty((0, image.shape[2]), dtype=np.float32)
+    return result
+
+
+class SampleSet:
+    """
+    Columnar storage of training samples: contiguous int32 (x, y) coordinates and
+    pixel colors (in the dtype of the image, uint8 for ordinary images).
+    Appends are amortized O(1); coords and colors return views, so samples can be
+    fed to training without per-sample Python objects.
+    """
+    def __init__(self, coords=None, colors=None):
+        if coords is None or len(coords) == 0:
+            # Empty, e.g. a mineral saved without samples; the channel count is set by the first append
+            self._coords = np.empty((0, 2), dtype=np.int32)
+            self._colors = None
+            self._size = 0
+        else:
+            self._coords = np.ascontiguousarray(coords, dtype=np.int32).reshape(-1, 2)
+            self._colors = np.ascontiguousarray(colors).reshape(len(self._coords), -1)
+            self._size = len(self._coords)
+    
+    def __len__(self):
+        return self._size
+    
+    @property
+    def coords(self):
+        """(n, 2) int32 array of (x, y) positions"""
+        return self._coords[:self._size]
+    
+    @property
+    def colors(self):
+        """(n, channels) array of pixel values"""
+        if self._colors is None:
+            return np.empty((0, 0), dtype=np.uint8)
+        return self._colors[:self._size]
+    
+    def _reserve(self, extra, n_channels, dtype):
+        """Grow the buffers geometrically so repeated appends stay cheap"""
+        if self._colors is None:
+            self._colors = np.empty((0, n_channels), dtype=dtype)
+        elif self._colors.shape[1] != n_channels:
+            raise ValueError(f"Sample has {n_channels} channels, expected {self._colors.shape[1]}")
+        
+        needed = self._size + extra
+        if needed <= len(self._coords):
+            return
+        capacity = max(needed, 2 * len(self._coords), 16)
+        coords = np.empty((capacity, 2), dtype=np.int32)
+        coords[:self._size] = self.coords
+        colors = np.empty((capacity, n_channels), dtype=self._colors.dtype)
+        colors[:self._size] = self.colors
+        self._coords, self._colors = coords, colors
+    
+    def append(self, x, y, color):
+        """Add a single sample"""
+        color = np.asarray(color).reshape(-1)
+        self._reserve(1, len(color), color.dtype)
+        self._coords[self._size] = (x, y)
+        self._colors[self._size] = color
+        self._size += 1
+    
+    def extend(self, coords, colors):
+        """Add many samples at once from (n, 2) coordinates and (n, channels) colors"""
+        coords = np.asarray(coords).reshape(-1, 2)
+        colors = np.asarray(colors).reshape(len(coords), -1)
+        self._reserve(len(coords), colors.shape[1], colors.dtype)
+        self._coords[self._size:self._size + len(coords)] = coords
+        self._colors[self._size:self._size + len(coords)] = colors
+        self._size += len(coords)
+    
+    def copy(self):
+        """Compact copy holding only the used part of the buffers"""
+        return SampleSet(self.coords.copy(), self.colors.copy()) if self._size else SampleSet()
+    
+    def mean_color(self):
+        return self.colors.mean(axis=0).astype(int)
+
+
+def mineral_training_features(mineral_colors, feature_set, n_channels, open_image):
+    """
+    Training features (X, y) of the samples of all minerals, labelled in order.
+    Every mineral's samples were selected on the image in its 'source' entry.
+    Raw channels and per-pixel color features (HSV, Lab) are rebuilt from the
+    stored colors; neighbourhood features, or colors with a channel count other
+    than n_channels, are taken from the source image, opened with
+    open_image(source). Raises ValueError when a source image cannot be opened
+    or has a channel count other than n_channels.
+    """
+    from_colors = feature_halo(feature_set) == 0
+    parts = []
+    labels = []
+    images = {}
+    for label, (name, data) in enumerate(mineral_colors.items()):
+        samples = data['samples']
+        if len(samples) == 0:
+            continue
+        if from_colors and samples.colors.shape[1] == n_channels:
+            features = compute_features(samples.colors[:, None, :], feature_set)[:, 0]
+        else:
+            source = data.get('source')
+            if source not in images:
+                try:
+                    images[source] = open_image(source)
+                except (OSError, ValueError) as e:
+                    raise ValueError(f"Cannot open {source}, where the samples of {name} were selected: {e}")
+            image = images[source]
+            if image.shape[2] != n_channels:
+                raise ValueError(f"The samples of {name} were selected on an image with {image.shape[2]} "
+                                 f"channels ({source}), the classified image has {n_channels}")
+            h, w = image.shape[:2]
+            coords = samples.coords
+            features = sample_features(image, np.clip(coords[:, 0], 0, w - 1), np.clip(coords[:, 1], 0, h - 1),
+                                       feature_set)
+        parts.append(features)
+        labels.append(np.full(len(samples), label))
+    
+    if not parts:
+        raise ValueError("No mineral samples to train on")
+    return np.concatenate(parts), np.concatenate(labels)
+
+
+def save_selections(file_path, image_path, mineral_colors):
+    """
+    Save mineral selections as a compact .npz file (one coordinate and color
+    array per mineral, plus the image the mineral was selected on).
+    """
+    arrays = {
+        'format_version': np.array(SELECTIONS_FORMAT_VERSION),
+        'image_path': np.array(image_path or ""),
+        'names': np.array(list(mineral_colors), dtype=str),
+    }
+    for i, data in enumerate(mineral_colors.values()):
+        arrays[f'color_{i}'] = np.asarray(data['color'])
+        arrays[f'coords_{i}'] = data['samples'].coords
+        arrays[f'colors_{i}'] = data['samples'].colors
+        arrays[f'source_{i}'] = np.array(data.get('source') or "")
+    np.savez_compressed(file_path, **arrays)
+
+
+def load_selections(file_path):
+    """
+    Load mineral selections from a .npz file, or from a .json file written by
+    earlier versions. Returns (image_path, mineral_colors); minerals saved
+    without a source image count as selected on image_path.
+    """
+    mineral_colors = {}
+    if file_path.lower().endswith('.npz'):
+        with np.load(file_path) as data:
+            image_path = str(data['image_path']) or None
+            for i, name in enumerate(data['names']):
+                source = str(data[f'source_{i}']) if f'source_{i}' in data.files else ""
+                mineral_colors[str(name)] = {
+                    'color': data[f'color_{i}'],
+                    'samples': SampleSet(data[f'coords_{i}'], data[f'colors_{i}']),
+                    'source': source or image_path,
+                }
+        return image_path, mineral_colors
+    
+    with open(file_path, 'r') as f:
+        selections_data = json.load(f)
+    for name, data in selections_data['minerals'].items():
+        # Samples are [x, y, [r, g, b]] lists
+        samples = data['samples']
+        coords = np.array([s[:2] for s in samples], dtype=np.int32).reshape(-1, 2)
+        colors = np.array([s[2] for s in samples])
+        if colors.size and colors.min() >= 0 and colors.max() <= 255:
+            colors = colors.astype(np.uint8)
+        mineral_colors[name] = {
+            'color': np.array(data['color']),
+            'samples': SampleSet(coords, colors),
+            'source': selections_data.get('image_path'),
+        }
+    return selections_data.get('image_path'), mineral_colors
+
+
+def _region_mask_coords(image_shape, bounds, draw):
+    """
+    Rasterize a shape into a mask covering only its bounding box and return the
+    (n, 2) int32 (x, y) coordinates of the covered pixels inside the image.
+    draw(ImageDraw, x0, y0) draws the shape with coordinates relative to (x0, y0).
+    """
+    h, w = image_shape[:2]
+    x0, y0 = max(0, int(np.floor(bounds[0]))), max(0, int(np.floor(bounds[1])))
+    x1, y1 = min(w - 1, int(np.ceil(bounds[2]))), min(h - 1, int(np.ceil(bounds[3])))
+    if x1 < x0 or y1 < y0:
+        return np.empty((0, 2), dtype=np.int32)
+    
+    mask = Image.new('1', (x1 - x0 + 1, y1 - y0 + 1), 0)
+    draw(ImageDraw.Draw(mask), x0, y0)
+    ys, xs = np.nonzero(np.asarray(mask))
+    return np.column_stack((xs + x0, ys + y0)).astype(np.int32)
+
+
+def polygon_pixel_coords(vertices, image_shape):
+    """(x, y) coordinates of all image pixels inside (or on the edge of) a polygon"""
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+    if len(vertices) == 0:
+        return np.empty((0, 2), dtype=np.int32)
+    bounds = (*vertices.min(axis=0), *vertices.max(axis=0))
+    
+    def draw(canvas, x0, y0):
+        canvas.polygon([(x - x0, y - y0) for x, y in vertices], fill=1, outline=1)
+    
+    return _region_mask_coords(image_shape, bounds, draw)
+
+
+def rectangle_pixel_coords(corner_a, corner_b, image_shape):
+    """(x, y) coordinates of all image pixels inside a rectangle given by two opposite corners"""
+    (xa, ya), (xb, yb) = corner_a, corner_b
+    return polygon_pixel_coords([(xa, ya), (xb, ya), (xb, yb), (xa, yb)], image_shape)
+
+
+def brush_pixel_coords(path, radius, image_shape):
+    """(x, y) coordinates of all image pixels within radius of a brush stroke (list of points)"""
+    path = np.asarray(path, dtype=float).reshape(-1, 2)
+    if len(path) == 0:
+        return np.empty((0, 2), dtype=np.int32)
+    bounds = (*(path.min(axis=0) - radius), *(path.max(axis=0) + radius))
+    
+    def draw(canvas, x0, y0):
+        points = [(x - x0, y - y0) for x, y in path]
+        if len(points) > 1:
+            canvas.line(points, fill=1, width=int(2 * radius + 1))
+        # Round caps and joints
+        for x, y in points:
+            canvas.ellipse((x - radius, y - radius, x + radius, y + radius), fill=1)
+    
+    return _region_mask_coords(image_shape, bounds, draw)
+
+
+def subsample_coords(coords, max_samples, seed=None):
+    """Randomly keep at most max_samples coordinates (all of them when max_samples is 0)"""
+    if max_samples <= 0 or len(coords) <= max_samples:
+        return coords
+    rng = np.random.default_rng(seed)
+    keep = np.sort(rng.choice(len(coords), size=max_samples, replace=False))
+    return coords[keep]
+
+
+def output_stem(image_path, folder_path=None):
+    """
+    File name stem of an image's output files (selections, results): its path
+    relative to folder_path without extension, subfolders joined by "__", so
+    images of the same name in different subfolders do not share outputs.
+    Images directly in folder_path (or without folder_path) keep their own name.
+    """
+    stem = os.path.splitext(image_path)[0]
+    if folder_path:
+        relative = os.path.relpath(stem, folder_path)
+        if not relative.startswith(os.pardir + os.sep):
+            return "__".join(relative.split(os.sep))
+    return os.path.basename(stem)
+
+
+def find_selections_file(output_folder, image_path, folder_path=None):
+    """
+    Return the saved selections file for an image (.npz preferred over legacy
+    .json), or None. Files named by the image's file name only (earlier
+    versions) are used when they were saved for this image.
+    """
+    stem = output_stem(image_path, folder_path)
+    for extension in ('.npz', '.json'):
+        candidate = os.path.join(output_folder, f"{stem}{SELECTIONS_SUFFIX}{extension}")
+        if os.path.exists(candidate):
+            return candidate
+    
+    legacy_stem = output_stem(image_path)
+    if legacy_stem != stem:
+        for extension in ('.npz', '.json'):
+            candidate = os.path.join(output_folder, f"{legacy_stem}{SELECTIONS_SUFFIX}{extension}")
+            if os.path.exists(candidate) and load_selections(candidate)[0] == image_path:
+                return candidate
+    return None
+
+
+def campaign_selection_files(output_folder):
+    """
+    All saved selection files of a results folder, one per image
+    (.npz preferred over a legacy .json file of the same image).
+    """
+    if not os.path.isdir(output_folder):
+        # Nothing saved yet
+        return []
+    selections = {}
+    for name in sorted(os.listdir(output_folder)):
+        stem, extension = os.path.splitext(name)
+        if not stem.endswith(SELECTIONS_SUFFIX) or extension.lower() not in ('.npz', '.json'):
+            continue
+        if stem in selections and extension.lower() == '.json':
+            continue
+        selections[stem] = os.path.join(output_folder, name)
+    return [selections[stem] for stem in sorted(selections)]
+
+
+def build_training_library(output_folder, feature_set=(), n_channels=None, open_image=load_image_array):
+    """
+    Merge the samples of every selection file in output_folder into one training set.
+    Minerals are matched by name and the same pixel of the same image labeled
+    with the same mineral is kept once. Samples whose channel count differs from
+    n_channels (e.g. stacks vs. single images) are skipped; without n_channels the
+    channel count of the first usable file is used. With a feature_set the
+    source images are opened (open_image(path)) to compute the sample features.
+    Returns a dict with 'mineral_names', 'X', 'y', 'files', 'duplicates' and 'skipped'.
+    """
+    files = campaign_selection_files(output_folder)
+    mineral_names = []
+    sources = []
+    parts = []  # (source id, mineral name, SampleSet)
+    skipped = []
+    for file_path in files:
+        _, minerals = load_selections(file_path)
+        for name, data in minerals.items():
+            samples = data['samples']
+            if len(samples) == 0:
+                continue
+            # Selections of the same image (e.g. copied files, minerals kept across images) share one source
+            if data['source'] not in sources:
+                sources.append(data['source'])
+            source_id = sources.index(data['source'])
+            if n_channels is None:
+                n_channels = samples.colors.shape[1]
+            elif samples.colors.shape[1] != n_channels:
+                skipped.append(file_path)
+                continue
+            if name not in mineral_names:
+                mineral_names.append(name)
+            parts.append((source_id, name, samples))
+    
+    if not parts:
+        raise ValueError(f"No usable mineral selections found in {output_folder}")
+    
+    # Labels follow sorted mineral names so they do not depend on file order
+    mineral_names = sorted(mineral_names)
+    label_of = {name: i for i, name in enumerate(mineral_names)}
+    keys = np.concatenate([
+        np.column_stack((np.full(len(samples), source_id), np.full(len(samples), label_of[name]),
+                         samples.coords))
+        for source_id, name, samples in parts
+    ]).astype(np.int64)
+    colors = np.concatenate([samples.colors for _, _, samples in parts])
+    
+    # Drop duplicate (image, mineral, x, y) samples
+    _, first = np.unique(keys, axis=0, return_index=True)
+    first.sort()
+    duplicates = len(keys) - len(first)
+    keys = keys[first]
+    y = keys[:, 1]
+    
+    if not feature_set:
+        X = colors[first].astype(np.float32)
+    else:
+        X = np.empty((len(keys), 0), dtype=np.float32)
+        for source_id in np.unique(keys[:, 0]):
+            rows = np.flatnonzero(keys[:, 0] == source_id)
+            image = open_image(sources[source_id])
+            h, w = image.shape[:2]
+            xs = np.clip(keys[rows, 2], 0, w - 1)
+            ys = np.clip(keys[rows, 3], 0, h - 1)
+            features = sample_features(image, xs, ys, feature_set)
+            if X.shape[1] != features.shape[1]:
+                X = np.empty((len(keys), features.shape[1]), dtype=np.float32)
+            X[rows] = features
+    
+    return {
+        'mineral_names': mineral_names,
+        'X': X,
+        'y': y,
+        'files': files,
+        'duplicates': duplicates,
+        'skipped': sorted(set(skipped)),
+    }
+
+
+def campaign_fingerprint(files, model_type, feature_set, n_channels):
+    """Hash of the selection files (names, sizes, modification times) and training settings"""
+    entries = []
+    for path in files:
+        stat = os.stat(path)
+        entries.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    settings = [CAMPAIGN_MODEL_VERSION, model_type, list(feature_set), n_channels, entries]
+    return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()
+
+
+def load_or_train_campaign_model(output_folder, model_type, feature_set=(), n_channels=3,
+                                 open_image=load_image_array):
+    """
+    Return the campaign model for all selections in output_folder: a dict with
+    'classifier', 'scaler', 'mineral_names', 'y', 'model_type', 'feature_set'
+    and 'fingerprint'. The class-balanced model is trained once and pickled to
+    CAMPAIGN_MODEL_FILENAME; it is retrained only when a selection file or a
+    training setting changes.
+    """
+    files = campaign_selection_files(output_folder)
+    fingerprint = campaign_fingerprint(files, model_type, feature_set, n_channels)
+    model_path = os.path.join(output_folder, CAMPAIGN_MODEL_FILENAME)
+    
+    if os.path.exists(model_path):
+        try:
+            with open(model_path, 'rb') as f:
+                model = pickle.load(f)
+            if model.get('fingerprint') == fingerprint:
+                return model
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError) as e:
+            # Unreadable cache, or pickled by other library versions (ImportError
+            # includes ModuleNotFoundError) - retrain
+            print(f"Discarded campaign model cache {model_path}: {e!r}", file=sys.stderr)
+    
+    library = build_training_library(output_folder, feature_set, n_channels, open_image)
+    classifier, scaler = train_model(library['X'], library['y'], model_type, balance=True)
+    model = {
+        'classifier': classifier,
+        'scaler': scaler,
+        'mineral_names': library['mineral_names'],
+        'y': library['y'],
+        'model_type': model_type,
+        'feature_set': tuple(feature_set),
+        'fingerprint': fingerprint,
+    }
+    
+    tmp_path = model_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, model_path)
+    return model
+
+
+def train_model(X, y, model_type, balance=False, seed=0):
+    """
+    Fit a scaler and a classifier of the given type ("knn", "svm", "rf" or "kmeans")
+    on sample features X with integer labels y. Returns (classifier, scaler).
+    With balance, classes count equally: SVM and Random Forest weight each sample
+    by the inverse of its class size, KNN and K-Means are fitted on an equal-size
+    random subsample of every class.
+    """
+    from sklearn.preprocessing import StandardScaler
+    
+    # Normalize features for better performance
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
+    
+    y = np.asarray(y)
+    sample_weight = None
+    if balance:
+        classes, class_index, counts = np.unique(y, return_inverse=True, return_counts=True)
+        if model_type in ("svm", "rf"):
+            sample_weight = len(y) / (len(classes) * counts[class_index])
+        else:
+            rng = np.random.default_rng(seed)
+            keep = np.sort(np.concatenate([
+                rng.choice(np.flatnonzero(class_index == i), size=counts.min(), replace=False)
+                for i in range(len(classes))
+            ]))
+            X_scaled, y = X_scaled[keep], y[keep]
+    
+    # Only the selected model's module is imported
+    if model_type == "svm":
+        # Support Vector Machine
+        from sklearn.svm import SVC
+        classifier = SVC(probability=True)
+    elif model_type == "rf":
+        # Random Forest
+        from sklearn.ensemble import RandomForestClassifier
+        classifier = RandomForestClassifier(n_estimators=100)
+    elif model_type == "kmeans":
+        # K-Means: one cluster per mineral
+        from sklearn.cluster import KMeans
+        classifier = KMeans(n_clusters=len(np.unique(y)))
+    else:
+        # K-Nearest Neighbors (also the default)
+        from sklearn.neighbors import KNeighborsClassifier
+        classifier = KNeighborsClassifier(n_neighbors=min(3, len(X_scaled)))
+    
+    # Train the classifier
+    if sample_weight is not None:
+        classifier.fit(X_scaled, y, sample_weight=sample_weight)
+    else:
+        classifier.fit(X_scaled, y)
+    
+    return classifier, scaler
+
+
+def binomial_confidence_interval(proportion, n, confidence=0.95):
+    """Calculate binomial proportion confidence interval"""
+    if n == 0 or proportion == 0:
+        return 0, 0
+    
+    from scipy.special import ndtri  # Inverse of the standard normal CDF
+    
+    z = ndtri(1 - (1 - confidence) / 2)
+    interval = z * np.sqrt((proportion * (1 - proportion)) / n)
+    return max(0, proportion - interval), min(1, proportion + interval)
+
+
+def predict_pixels(classifier, model_type, pixels_scaled, other_threshold, other_class):
+    """
+    Classify a batch of scaled pixels.
+    Returns (labels, confidence); pixels that do not match any mineral closely
+    enough are assigned to other_class with a low confidence.
+    """
+    if model_type == "knn":
+        # KNN: Use distances to determine confidence
+        dists, indices = classifier.kneighbors(pixels_scaled)
+        predictions = classifier.predict(pixels_scaled)
+        
+        # Store distances (lower is better)
+        mean_dists = dists.mean(axis=1)
+        # Convert distance to confidence (inverse relationship)
+        confidence = np.exp(-mean_dists / 50)  # Exponential decay of confidence with distance
+        
+        # Assign minerals to pixels within the distance threshold
+        within_threshold = mean_dists < other_threshold
+        
+    elif model_type == "kmeans":
+        # K-Means: Use distance to cluster centers
+        predictions = classifier.predict(pixels_scaled)
+        distances = np.min(classifier.transform(pixels_scaled), axis=1)
+        
+        # Convert distance to confidence
+        confidence = np.exp(-distances / 50)
+        
+        # Assign clusters to pixels within the distance threshold
+        within_threshold = distances < other_threshold
+        
+    else:  # SVM and Random Forest
+        # Use probability estimates for confidence
+        predictions = classifier.predict(pixels_scaled)
+        proba = classifier.predict_proba(pixels_scaled)
+        
+        # Get highest probability for each prediction
+        confidence = np.max(proba, axis=1)
+        
+        # Assign minerals to pixels with sufficient confidence
+        within_threshold = confidence > (1.0 - other_threshold/200)  # Convert distance to probability threshold
+    
+    labels = np.where(within_threshold, predictions, other_class).astype(np.int32)
+    confidence = np.where(within_threshold, confidence, 0.1).astype(np.float32)  # Low confidence for "Other"
+    return labels, confidence
+
+
+def classify_pixels(pixels, classifier, scaler, model_type, carbon_mask, other_threshold, n_minerals,
+                    batch_size=10000, progress_callback=None, profiler=NO_PROFILER):
+    """
+    Classify a flat (N, n_features) pixel or feature array in batches.
+    Carbon pixels (flat boolean carbon_mask) get class n_minerals, pixels that
+    match no mineral get the "Other" class n_minerals + 1.
+    progress_callback, if given, is called with the completed fraction after each batch.
+    """
+    n_pixels = len(pixels)
+    result = np.zeros(n_pixels, dtype=np.int32)
+    confidence = np.zeros(n_pixels, dtype=np.float32)
+    
+    # Carbon pixels are fixed up front with high confidence
+    result[carbon_mask] = n_minerals
+    confidence[carbon_mask] = 1.0
+    
+    num_batches = max(1, -(-n_pixels // batch_size))
+    for i in range(num_batches):
+        start_idx = i * batch_size
+        end_idx = min((i + 1) * batch_size, n_pixels)
+        
+        # Skip pixels that are already classified as carbon
+        non_carbon_indices = np.flatnonzero(~carbon_mask[start_idx:end_idx]) + start_idx
+        
+        if len(non_carbon_indices) > 0:
+            with profiler.stage("scaling", pixels=len(non_carbon_indices)):
+                batch_pixels = scaler.transform(pixels[non_carbon_indices])
+            with profiler.stage("inference", pixels=len(non_carbon_indices)):
+                result[non_carbon_indices], confidence[non_carbon_indices] = predict_pixels(
+                    classifier, model_type, batch_pixels, other_threshold, n_minerals + 1)
+        
+        if progress_callback is not None:
+            progress_callback((i + 1) / num_batches)
+    
+    return result, confidence
+
+
+def classify_image_array(image, classifier, scaler, model_type, carbon_mask, other_threshold, n_minerals,
+                         feature_set=(), progress_callback=None, profiler=NO_PROFILER):
+    """
+    Classify a whole (h, w, channels) image chunk by chunk.
+    Features are computed per row chunk (see iter_feature_chunks), so memory stays
+    bounded regardless of image size. Returns flat (result, confidence) arrays.
+    """
+    h, w = image.shape[:2]
+    carbon_flat = carbon_mask.reshape(h * w)
+    result = np.empty(h * w, dtype=np.int32)
+    confidence = np.empty(h * w, dtype=np.float32)
+    
+    for start, end, features in iter_feature_chunks(image, feature_set, profiler=profiler):
+        rows = slice(start * w, end * w)
+        result[rows], confidence[rows] = classify_pixels(features, classifier, scaler, model_type,
+                                                         carbon_flat[rows], other_threshold, n_minerals,
+                                                         profiler=profiler)
+        if progress_callback is not None:
+            progress_callback(end / h)
+    
+    return result, confidence
+
+
+def segment_superpixels(image, n_segments=2000, compactness=10.0, sigma=1.0):
+    """Split an RGB image into SLIC superpixels, returning an (h, w) segment label array"""
+    from skimage import segmentation
+    
+    # Light Gaussian smoothing keeps sensor noise from fragmenting the segments
+    return segmentation.slic(image, n_segments=n_segments, compactness=compactness, sigma=sigma,
+                             start_label=0, channel_axis=-1)
+
+
+def classify_superpixels(image, segments, classifier, scaler, model_type, carbon_mask, other_threshold,
+                         n_minerals, feature_set=()):
+    """
+    Classify each superpixel once from its mean features and broadcast the label to its pixels.
+    Carbon pixels are excluded from the segment means and keep the carbon class.
+    Returns flat (result, confidence) arrays like classify_pixels.
+    """
+    h, w = image.shape[:2]
+    seg_flat = segments.reshape(h * w)
+    carbon_flat = carbon_mask.reshape(h * w)
+    n_segments = int(seg_flat.max()) + 1
+    
+    # Mean features of the non-carbon pixels of every segment, accumulated chunk by chunk
+    counts = np.zeros(n_segments, dtype=np.float64)
+    sums = None
+    for start, end, features in iter_feature_chunks(image, feature_set):
+        rows = slice(start * w, end * w)
+        keep = ~carbon_flat[rows]
+        seg_keep = seg_flat[rows][keep]
+        features = features[keep]
+        if sums is None:
+            sums = np.zeros((n_segments, features.shape[1]), dtype=np.float64)
+        counts += np.bincount(seg_keep, minlength=n_segments)
+        for c in range(features.shape[1]):
+            sums[:, c] += np.bincount(seg_keep, weights=features[:, c], minlength=n_segments)
+    
+    valid = counts > 0
+    means = sums[valid] / counts[valid, None]
+    
+    # One prediction per segment instead of one per pixel
+    segment_labels = np.full(n_segments, n_minerals + 1, dtype=np.int32)
+    segment_confidence = np.full(n_segments, 0.1, dtype=np.float32)
+    if np.any(valid):
+        segment_labels[valid], segment_confidence[valid] = predict_pixels(
+            classifier, model_type, scaler.transform(means.astype(np.float32)), other_threshold, n_minerals + 1)
+    
+    result = segment_labels[seg_flat]
+    confidence = segment_confidence[seg_flat]
+    result[carbon_flat] = n_minerals
+    confidence[carbon_flat] = 1.0
+    return result, confidence
+
+
+def majority_filter(labels, size=3, classes=None, fixed_mask=None):
+    """
+    Replace every label by the most frequent label in its size x size neighbourhood.
+    Only labels in classes take part in the vote (all labels by default); ties keep
+    the original label and pixels in fixed_mask are never changed.
+    Runs one uniform filter per class, so memory stays a few arrays of image size.
+    """
+    from scipy import ndimage
+    
+    if classes is None:
+        classes = np.unique(labels)
+    
+    best_label = labels.copy()
+    best_count = np.full(labels.shape, -1.0, dtype=np.float32)
+    own_count = np.zeros(labels.shape, dtype=np.float32)
+    
+    for c in classes:
+        member = labels == c
+        # Fraction of neighbours with label c
+        counts = ndimage.uniform_filter(member.astype(np.float32), size=size, mode='nearest')
+        better = counts > best_count
+        best_label[better] = c
+        best_count[better] = counts[better]
+        own_count[member] = counts[member]
+    
+    # Keep the original label when it is tied with the winner
+    keep = own_count >= best_count - 1e-6
+    if fixed_mask is not None:
+        keep |= fixed_mask
+    return np.where(keep, labels, best_label)
+
+
+def tile_class_histograms(result_image, n_classes, tile_size=BOOTSTRAP_TILE_SIZE):
+    """
+    Per-tile class pixel counts of a label map as a (tiles_y, tiles_x, n_classes) array.
+    The map is processed one band of tile rows at a time with a single bincount
+    per band, so no per-pixel index array of the whole map is built.
+    """
+    h, w = result_image.shape
+    tiles_y = -(-h // tile_size)
+    tiles_x = -(-w // tile_size)
+    # Offset of each column's tile in the flat (tile, class) histogram of a band
+    column_offsets = (np.arange(w, dtype=np.intp) // tile_size) * n_classes
+    
+    histograms = np.empty((tiles_y, tiles_x * n_classes), dtype=np.int64)
+    for ty in range(tiles_y):
+        band = result_image[ty * tile_size:(ty + 1) * tile_size]
+        histograms[ty] = np.bincount((band + column_offsets).ravel(), minlength=tiles_x * n_classes)
+    return histograms.reshape(tiles_y, tiles_x, n_classes)
+
+
+def block_bootstrap_intervals(tile_histograms, n_replicates=BOOTSTRAP_REPLICATES, confidence=0.95, seed=0,
+                              max_blocks=BOOTSTRAP_MAX_BLOCKS):
+    """
+    Block bootstrap confidence intervals of the class proportions from per-tile
+    class histograms (see tile_class_histograms). Tiles are resampled with
+    replacement, which keeps the spatial correlation of neighbouring pixels that
+    the binomial interval ignores. Each replicate is a vector of tile counts, so
+    all replicates are a (replicates x tiles) @ (tiles x classes) product computed
+    in chunks. Returns (lower, upper) proportion arrays per class.
+    """
+    tiles_y, tiles_x, n_classes = tile_histograms.shape
+    
+    # Merge neighbouring tiles into larger blocks when there are too many tiles
+    factor = int(np.ceil(np.sqrt(tiles_y * tiles_x / max_blocks)))
+    if factor > 1:
+        padded = np.zeros((-(-tiles_y // factor) * factor, -(-tiles_x // factor) * factor, n_classes),
+                          dtype=tile_histograms.dtype)
+        padded[:tiles_y, :tiles_x] = tile_histograms
+        tile_histograms = padded.reshape(padded.shape[0] // factor, factor,
+                                         padded.shape[1] // factor, factor, n_classes).sum(axis=(1, 3))
+    
+    blocks = tile_histograms.reshape(-1, n_classes).astype(np.float64)
+    blocks = blocks[blocks.sum(axis=1) > 0]
+    n_blocks = len(blocks)
+    if n_blocks == 0:
+        return np.zeros(n_classes), np.zeros(n_classes)
+    
+    rng = np.random.default_rng(seed)
+    proportions = np.empty((n_replicates, n_classes))
+    chunk = max(1, BOOTSTRAP_CHUNK_ELEMENTS // n_blocks)
+    for start in range(0, n_replicates, chunk):
+        m = min(chunk, n_replicates - start)
+        # How often each block is drawn in each replicate
+        picks = rng.integers(0, n_blocks, size=(m, n_blocks)) + n_blocks * np.arange(m)[:, None]
+        weights = np.bincount(picks.ravel(), minlength=m * n_blocks).reshape(m, n_blocks)
+        totals = weights.astype(np.float64) @ blocks
+        proportions[start:start + m] = totals / totals.sum(axis=1, keepdims=True)
+    
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(proportions, [alpha, 1 - alpha], axis=0)
+    return lower, upper
+
+
+def compute_statistics(result_image, mineral_names, ci_method="binomial", tile_size=BOOTSTRAP_TILE_SIZE,
+                       n_replicates=BOOTSTRAP_REPLICATES, seed=0):
+    """
+    Calculate percentages, pixel counts and 95% confidence intervals per class.
+    Minerals are always reported; carbon and "Other" only when present.
+    ci_method "binomial" treats pixels as independent; "bootstrap" resamples
+    tile_size x tile_size tiles (block_bootstrap_intervals), giving realistic
+    intervals for spatially correlated maps.
+    """
+    n_minerals = len(mineral_names)
+    total_pixels = result_image.size
+    
+    if ci_method == "bootstrap":
+        histograms = tile_class_histograms(result_image, n_minerals + 2, tile_size)
+        counts = histograms.sum(axis=(0, 1))
+        bootstrap_lower, bootstrap_upper = block_bootstrap_intervals(histograms, n_replicates, seed=seed)
+    else:
+        counts = np.bincount(result_image.ravel(), minlength=n_minerals + 2)
+    
+    percentages = {}
+    pixel_counts = {}
+    confidence_intervals = {}
+    
+    class_names = list(mineral_names) + ["Carbon (Graphite)", "Other"]
+    for idx, name in enumerate(class_names):
+        count = int(counts[idx])
+        if idx >= n_minerals and count == 0:
+            continue
+        
+        proportion = count / total_pixels
+        percentages[name] = proportion * 100
+        pixel_counts[name] = count
+        
+        # Calculate confidence interval (95%)
+        if ci_method == "bootstrap":
+            lower_ci, upper_ci = bootstrap_lower[idx], bootstrap_upper[idx]
+        else:
+            lower_ci, upper_ci = binomial_confidence_interval(proportion, total_pixels)
+        confidence_intervals[name] = (lower_ci * 100, upper_ci * 100)
+    
+    return percentages, pixel_counts, confidence_intervals
+
+
+class SampleSuggester:
+    """
+    Suggests where to pick the next training samples, based on the results of
+    the last classification run: the least confident regions, or representative
+    pixels of the "Other" class. Tile statistics and clusters are computed once
+    per result and handed out incrementally, so asking for more suggestions does
+    not require another classification pass.
+    """
+    def __init__(self, result_image, confidence_image, other_class, tile_size=32):
+        self.result_image = result_image
+        self.confidence_image = confidence_image
+        self.other_class = other_class
+        self.tile_size = tile_size
+        self._tile_order = None  # Tile indices sorted by mean confidence
+        self._tile_points = None  # (y, x) of the least confident pixel of every tile
+        self._next_tile = 0
+        self._other_points = None
+        self._next_other = 0
+    
+    def _rank_tiles(self):
+        """Compute mean confidence and least confident pixel per tile (vectorized, once)"""
+        h, w = self.confidence_image.shape
+        t = self.tile_size
+        ty, tx = -(-h // t), -(-w // t)
+        
+        # Pad to whole tiles with NaN so partial tiles only average real pixels
+        padded = np.full((ty * t, tx * t), np.nan, dtype=np.float32)
+        padded[:h, :w] = self.confidence_image
+        tiles = padded.reshape(ty, t, tx, t).transpose(0, 2, 1, 3).reshape(ty * tx, t * t)
+        
+        tile_means = np.nanmean(tiles, axis=1)
+        within = np.nanargmin(tiles, axis=1)
+        tile_rows, tile_cols = np.divmod(np.arange(ty * tx), tx)
+        self._tile_points = np.stack([tile_rows * t + within // t, tile_cols * t + within % t], axis=1)
+        self._tile_order = np.argsort(tile_means, kind='stable')
+    
+    def next_low_confidence(self, n, exclude_points=()):
+        """
+        Return up to n (x, y) points from the least confident tiles not returned yet.
+        Tiles that already contain one of exclude_points (x, y) are skipped.
+        """
+        if self._tile_order is None:
+            self._rank_tiles()
+        
+        t = self.tile_size
+        tiles_x = -(-self.confidence_image.shape[1] // t)
+        exclude_points = np.asarray(exclude_points, dtype=np.intp).reshape(-1, 2)
+        excluded = set(((exclude_points[:, 1] // t) * tiles_x + exclude_points[:, 0] // t).tolist())
+        
+        points = []
+        while len(points) < n and self._next_tile < len(self._tile_order):
+            tile = self._tile_order[self._next_tile]
+            self._next_tile += 1
+            if tile in excluded:
+                continue
+            y, x = self._tile_points[tile]
+            points.append((int(x), int(y)))
+        return points
+    
+    def next_other_clusters(self, image, n, n_clusters=20, max_pixels=20000, seed=0):
+        """
+        Return up to n (x, y) points representative of the "Other" class: the pixels
+        closest to K-Means cluster centers of a random subsample of "Other" pixels.
+        Clusters are computed on the first call and returned largest first.
+        """
+        if self._other_points is None:
+            self._other_points = self._cluster_other(image, n_clusters, max_pixels, seed)
+        
+        points = self._other_points[self._next_other:self._next_other + n]
+        self._next_other += len(points)
+        return points
+    
+    def _cluster_other(self, image, n_clusters, max_pixels, seed):
+        other_indices = np.flatnonzero(self.result_image.ravel() == self.other_class)
+        if len(other_indices) == 0:
+            return []
+        
+        rng = np.random.default_rng(seed)
+        if len(other_indices) > max_pixels:
+            other_indices = rng.choice(other_indices, max_pixels, replace=False)
+        ys, xs = np.divmod(other_indices, self.result_image.shape[1])
+        colors = np.asarray(image[ys, xs], dtype=np.float32).reshape(len(xs), -1)
+        
+        from sklearn.cluster import KMeans
+        n_clusters = min(n_clusters, len(np.unique(colors, axis=0)))
+        kmeans = KMeans(n_clusters=n_clusters, n_init=3, random_state=seed).fit(colors)
+        
+        # Nearest sampled pixel to every center, biggest clusters first
+        nearest = np.argmin(kmeans.transform(colors), axis=0)
+        cluster_sizes = np.bincount(kmeans.labels_, minlength=n_clusters)
+        order = np.argsort(-cluster_sizes, kind='stable')
+        return [(int(xs[nearest[c]]), int(ys[nearest[c]])) for c in order]
+
+
+def get_colormap(name, n_colors):
+    """Return a matplotlib colormap resampled to n_colors"""
+    import matplotlib
+    if hasattr(matplotlib, 'colormaps'):
+        return matplotlib.colormaps[name].resampled(n_colors)
+    # matplotlib < 3.5
+    from matplotlib import cm
+    return cm.get_cmap(name, n_colors)
+
+
+def class_palette(n_minerals, alpha=255):
+    """RGBA lookup table (n_minerals + 2, 4) for label maps: minerals, then carbon and 'Other'"""
+    colors = [OVERLAY_MINERAL_COLORS[i % len(OVERLAY_MINERAL_COLORS)] for i in range(n_minerals)]
+    colors += [OVERLAY_CARBON_COLOR, OVERLAY_OTHER_COLOR]
+    palette = np.empty((n_minerals + 2, 4), dtype=np.uint8)
+    palette[:, :3] = colors
+    palette[:, 3] = alpha
+    return palette
+
+
+def render_label_overlay(labels, view_x, view_y, view_width, view_height, zoom, palette, label_stride=1):
+    """
+    Colorize the visible part of a label map for display at the given zoom.
+    (view_x, view_y, view_width, view_height) is the viewport in zoomed display
+    pixels; labels[i, j] covers image pixels (i * label_stride, j * label_stride)
+    (label_stride > 1 for preview maps). Only the viewport is sampled (nearest
+    neighbour) and mapped through the palette, so the cost depends on the window
+    size, not the image size. Returns an RGBA uint8 array, clipped to the image.
+    """
+    h, w = labels.shape
+    display_width = int(w * label_stride * zoom)
+    display_height = int(h * label_stride * zoom)
+    x0, y0 = max(0, int(view_x)), max(0, int(view_y))
+    x1 = min(display_width, int(view_x + view_width))
+    y1 = min(display_height, int(view_y + view_height))
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((0, 0, 4), dtype=np.uint8)
+    
+    # Label cell under every display pixel of the viewport
+    rows = np.minimum((np.arange(y0, y1) / (zoom * label_stride)).astype(np.intp), h - 1)
+    cols = np.minimum((np.arange(x0, x1) / (zoom * label_stride)).astype(np.intp), w - 1)
+    return palette[labels[rows[:, None], cols]]
+
+
+def create_results_figure(result_image, percentages):
+    """Create the classification map + pie chart summary figure"""
+    from matplotlib.figure import Figure
+    
+    fig = Figure(figsize=(10, 6))
+    
+    # Create a colorful visualization of the classification
+    ax1 = fig.add_subplot(121)
+    max_category = len(percentages)
+    cmap = get_colormap('tab10', max_category)
+    classification_img = ax1.imshow(result_image, cmap=cmap, vmin=0, vmax=max_category-1)
+    ax1.set_title('Classification')
+    ax1.axis('off')
+    
+    # Add color bar
+    cbar = fig.colorbar(classification_img, ax=ax1, ticks=range(max_category))
+    cbar.set_ticklabels(list(percentages.keys()))
+    
+    # Create a pie chart of percentages with error bars
+    ax2 = fig.add_subplot(122)
+    wedges, texts, autotexts = ax2.pie(
+        percentages.values(), 
+        labels=percentages.keys(), 
+        autopct='%1.1f%%',
+        textprops={'fontsize': 9}
+    )
+    ax2.set_title('Mineral Percentages')
+    ax2.axis('equal')
+    
+    # Adjust layout
+    fig.tight_layout()
+    return fig
+
+
+def save_classification_files(output_folder, base_filename, fig, result_image, confidence_image,
+                              percentages, pixel_counts, confidence_intervals, timestamp=None):
+    """
+    Save classification results to output_folder and return the written file paths.
+    Figures are rendered through the object-oriented matplotlib API, so saving
+    does not need a display and can run outside the GUI thread.
+    """
+    import tifffile
+    from matplotlib.figure import Figure
+    
+    # Create a timestamp
+    if timestamp is None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # Save the classification figure
+    fig_filename = os.path.join(output_folder, f"{base_filename}_classification_{timestamp}.png")
+    fig.savefig(fig_filename, dpi=300)
+    
+    # Save the classification data as CSV with confidence intervals
+    data_filename = os.path.join(output_folder, f"{base_filename}_data_{timestamp}.csv")
+    with open(data_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Mineral", "Percentage", "Lower_CI", "Upper_CI", "Pixel_Count"])
+        for name, percentage in percentages.items():
+            lower, upper = confidence_intervals[name]
+            pixel_count = pixel_counts[name]
+            writer.writerow([name, percentage, lower, upper, pixel_count])
+    
+    # Save the classification image as a separate file (without legend)
+    # Create a new figure for just the classified image without legend
+    image_fig = Figure(figsize=(10, 10))
+    ax = image_fig.add_subplot(111)
+    ax.imshow(result_image, cmap=get_colormap('tab10', len(percentages)))
+    ax.axis('off')
+    
+    # Save the image
+    img_filename = os.path.join(output_folder, f"{base_filename}_classified_{timestamp}.png")
+    image_fig.savefig(img_filename, dpi=300, bbox_inches='tight')
+    
+    # Save as TIFF file without legend
+    tiff_filename = os.path.join(output_folder, f"{base_filename}_classified_{timestamp}.tiff")
+    tifffile.imwrite(tiff_filename, result_image.astype(np.uint8))
+    
+    # Save confidence map as an additional visualization
+    conf_fig = Figure(figsize=(10, 10))
+    ax = conf_fig.add_subplot(111)
+    conf_img = ax.imshow(confidence_image, cmap='viridis', vmin=0, vmax=1)
+    conf_fig.colorbar(conf_img, ax=ax, label='Confidence')
+    ax.set_title('Classification Confidence')
+    ax.axis('off')
+    
+    # Save the confidence map
+    conf_filename = os.path.join(output_folder, f"{base_filename}_confidence_{timestamp}.png")
+    conf_fig.savefig(conf_filename, dpi=300, bbox_inches='tight')
+    
+    return {
+        'figure': fig_filename,
+        'data': data_filename,
+        'image': img_filename,
+        'tiff': tiff_filename,
+        'confidence': conf_filename,
+    }
+
+
+def classify_loaded_image(image, model, settings=None, progress_callback=None, profiler=NO_PROFILER):
+    """
+    Classify one image with a trained model: carbon detection, pixel or superpixel
+    classification, optional majority filter and statistics.
+    model is a dict with 'classifier', 'scaler', 'model_type', 'feature_set' and
+    'mineral_names' (see load_or_train_campaign_model); settings override
+    DEFAULT_SETTINGS. Returns a dict with 'result_image', 'confidence_image',
+    'carbon_mask', 'percentages', 'pixel_counts' and 'confidence_intervals'.
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    classifier, scaler = model['classifier'], model['scaler']
+    model_type = model['model_type']
+    feature_set = tuple(model['feature_set'])
+    n_minerals = len(model['mineral_names'])
+    other_threshold = settings['other_threshold']
+    h, w = image.shape[:2]
+    
+    # Create a mask for the carbon (special handling)
+    with profiler.stage("detect_carbon", pixels=h * w):
+        carbon_mask = detect_carbon_mask(image, settings['carbon_threshold'], settings['min_blob_size'])
+    
+    if settings['postprocess'] == "superpixels":
+        # Classify once per superpixel instead of once per pixel
+        with profiler.stage("superpixel_segmentation", pixels=h * w):
+            segments = segment_superpixels(primary_layer(image), n_segments=settings['n_segments'])
+        if progress_callback is not None:
+            progress_callback(0.5)
+        with profiler.stage("superpixel_classification", pixels=h * w):
+            result, confidence = classify_superpixels(image, segments, classifier, scaler, model_type,
+                                                      carbon_mask, other_threshold, n_minerals,
+                                                      feature_set=feature_set)
+        if progress_callback is not None:
+            progress_callback(1.0)
+    else:
+        result, confidence = classify_image_array(image, classifier, scaler, model_type, carbon_mask,
+                                                  other_threshold, n_minerals, feature_set=feature_set,
+                                                  progress_callback=progress_callback, profiler=profiler)
+    
+    # Reshape back to image shape
+    result_image = result.reshape((h, w))
+    confidence_image = confidence.reshape((h, w))
+    
+    return _finish_outcome(result_image, confidence_image, carbon_mask, model, settings, profiler)
+
+
+def _finish_outcome(result_image, confidence_image, carbon_mask, model, settings, profiler=NO_PROFILER):
+    """
+    Optional majority filter and statistics of a classified (h, w) label map.
+    Pixels relabelled by the majority filter get confidence 0 (in place).
+    """
+    h, w = result_image.shape
+    n_minerals = len(model['mineral_names'])
+    
+    if settings['postprocess'] == "majority":
+        # Smooth isolated pixels; carbon keeps its own detection rule
+        with profiler.stage("majority_filter", pixels=h * w):
+            filtered = majority_filter(result_image, size=settings['majority_size'],
+                                       classes=list(range(n_minerals)) + [n_minerals + 1],
+                                       fixed_mask=carbon_mask)
+            # Only the probability of the predicted class is kept, so a relabelled
+            # pixel has no confidence for its new label: mark it as uncertain
+            confidence_image[filtered != result_image] = 0.0
+            result_image = filtered
+    
+    # Calculate percentages and confidence intervals
+    with profiler.stage("statistics", pixels=h * w):
+        percentages, pixel_counts, confidence_intervals = compute_statistics(
+            result_image, model['mineral_names'], ci_method=settings['ci_method'],
+            tile_size=settings['bootstrap_tile_size'])
+    
+    return {
+        'result_image': result_image,
+        'confidence_image': confidence_image,
+        'carbon_mask': carbon_mask,
+        'percentages': percentages,
+        'pixel_counts': pixel_counts,
+        'confidence_intervals': confidence_intervals,
+    }
+
+
+def preview_stride(shape, target_pixels=PREVIEW_PIXELS):
+    """Row/column step that brings an image of the given shape down to about target_pixels"""
+    h, w = shape[:2]
+    return max(1, int(np.ceil(np.sqrt(h * w / target_pixels))))
+
+
+def classify_preview(image, model, settings=None, stride=None, profiler=NO_PROFILER):
+    """
+    Quick classification of every stride-th row and column (see preview_stride).
+    Size-dependent settings are scaled to the coarse grid: the minimum carbon blob
+    size by stride**2 and the bootstrap tile size by stride; post-processing is
+    left to the full-resolution pass. Returns an outcome like classify_loaded_image
+    (at preview resolution) plus 'stride'.
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    if stride is None:
+        stride = preview_stride(image.shape)
+    
+    preview_settings = dict(settings,
+                            min_blob_size=max(1.0, settings['min_blob_size'] / stride ** 2),
+                            bootstrap_tile_size=max(4, settings['bootstrap_tile_size'] // stride),
+                            postprocess="none")
+    with profiler.stage("preview_read"):
+        preview = np.ascontiguousarray(image[::stride, ::stride])
+    outcome = classify_loaded_image(preview, model, preview_settings, profiler=profiler)
+    outcome['stride'] = stride
+    return outcome
+
+
+def refinement_mask(coarse_result, coarse_confidence, confidence_threshold=PREVIEW_CONFIDENCE):
+    """
+    Preview pixels whose full-resolution pixels must be classified again: class
+    boundaries (another label in the 3x3 neighbourhood) and low-confidence
+    pixels, grown by one preview pixel.
+    """
+    from scipy import ndimage
+    
+    boundary = ndimage.maximum_filter(coarse_result, size=3) != ndimage.minimum_filter(coarse_result, size=3)
+    return ndimage.binary_dilation(boundary | (coarse_confidence < confidence_threshold))
+
+
+def refine_classification(image, model, preview, settings=None, confidence_threshold=PREVIEW_CONFIDENCE,
+                          progress_callback=None, stop_event=None, profiler=NO_PROFILER):
+    """
+    Full-resolution result from a preview (see classify_preview): the preview labels
+    are upsampled and only the pixels selected by refinement_mask, plus pixels whose
+    carbon status differs at full resolution, are classified again. Features are only
+    computed for row chunks that contain such pixels. Returns an outcome like
+    classify_loaded_image plus 'refined_fraction', or None if stop_event was set.
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    if settings['postprocess'] == "superpixels":
+        # Superpixels are segmented at full resolution anyway
+        return dict(classify_loaded_image(image, model, settings, progress_callback, profiler), refined_fraction=1.0)
+    
+    h, w = image.shape[:2]
+    stride = preview['stride']
+    classifier, scaler = model['classifier'], model['scaler']
+    feature_set = tuple(model['feature_set'])
+    n_minerals = len(model['mineral_names'])
+    halo = feature_halo(feature_set)
+    
+    with profiler.stage("detect_carbon", pixels=h * w):
+        carbon_mask = detect_carbon_mask(image, settings['carbon_threshold'], settings['min_blob_size'])
+    
+    coarse_result = preview['result_image']
+    coarse_confidence = preview['confidence_image']
+    coarse_refine = refinement_mask(coarse_result, coarse_confidence, confidence_threshold)
+    # Preview pixel of every full-resolution row and column
+    row_index = np.arange(h) // stride
+    column_index = np.arange(w) // stride
+    
+    result_image = np.empty((h, w), dtype=np.int32)
+    confidence_image = np.empty((h, w), dtype=np.float32)
+    refined = 0
+    for start in range(0, h, FEATURE_CHUNK_ROWS):
+        if stop_event is not None and stop_event.is_set():
+            return None
+        end = min(start + FEATURE_CHUNK_ROWS, h)
+        rows = row_index[start:end]
+        labels = coarse_result[rows][:, column_index]
+        result_image[start:end] = labels
+        confidence_image[start:end] = coarse_confidence[rows][:, column_index]
+        
+        carbon = carbon_mask[start:end]
+        result_image[start:end][carbon] = n_minerals
+        confidence_image[start:end][carbon] = 1.0
+        todo = (coarse_refine[rows][:, column_index] | (labels == n_minerals)) & ~carbon
+        
+        n_todo = int(np.count_nonzero(todo))
+        if n_todo:
+            with profiler.stage("features", pixels=(end - start) * w):
+                features = _feature_rows(image, start, end, feature_set, halo)[todo]
+            result_image[start:end][todo], confidence_image[start:end][todo] = classify_pixels(
+                features, classifier, scaler, model['model_type'], np.zeros(n_todo, dtype=bool),
+                settings['other_threshold'], n_minerals, profiler=profiler)
+            refined += n_todo
+        
+        if progress_callback is not None:
+            progress_callback(end / h)
+    
+    outcome = _finish_outcome(result_image, confidence_image, carbon_mask, model, settings, profiler)
+    outcome['refined_fraction'] = refined / (h * w)
+    return outcome
+
+
+def _open_image_group(paths, stack_cache_dir=None):
+    """Open a single image, or the co-registered images of a stack as one ImageStack"""
+    if len(paths) > 1:
+        return load_image_stack(paths, stack_cache_dir)
+    return load_image_array(paths[0])
+
+
+def find_stack_group(path):
+    """The stack (see group_image_stacks) whose primary image is path, from the files of its folder"""
+    directory = os.path.dirname(path)
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    for group in group_image_stacks(os.path.join(directory, name) for name in names):
+        if os.path.normpath(group[0]) == os.path.normpath(path):
+            return group
+    return [path]
+
+
+def make_group_opener(path_groups, stack_cache_dir=None, find_stacks=False):
+    """
+    Return open_image(path) for training on saved selections: the primary path
+    of one of path_groups (lists of paths, see group_image_stacks) is opened as
+    its whole stack, any other path as a single image. With find_stacks, stacks
+    not in path_groups are looked up in the folder of the path (find_stack_group).
+    """
+    groups_by_primary = {paths[0]: paths for paths in path_groups}
+    
+    def open_image(path):
+        if path not in groups_by_primary and find_stacks:
+            groups_by_primary[path] = find_stack_group(path)
+        return _open_image_group(groups_by_primary.get(path, [path]), stack_cache_dir)
+    
+    return open_image
+
+
+def classify_folder(path_groups, output_folder, model, settings=None, n_workers=2, n_writers=2,
+                    queue_size=BATCH_QUEUE_SIZE, stack_cache_dir=None, progress_callback=None, stop_event=None,
+                    folder_path=None):
+    """
+    Classify many images as a three-stage pipeline connected by bounded queues:
+    a reader thread decodes the next images, n_workers threads classify them and
+    n_writers threads render and save the results, so decoding, computing and
+    writing of different images overlap. path_groups yields lists of paths (one
+    image, or the layers of a stack). At most queue_size decoded images and
+    queue_size finished results wait between stages.
+    progress_callback(done, total) is called from the writer threads; total is
+    None while path_groups is still being consumed. Setting stop_event stops
+    reading new images. Errors are recorded per image and do not stop the run.
+    model can also be a function returning the model for the first decoded image
+    (e.g. trained for its channel count); if it raises, the run stops and the
+    exception is raised here.
+    Output files are named by the image path below folder_path (see output_stem).
+    Returns one record per image in input order and writes batch_summary_{timestamp}.csv.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if stop_event is None:
+        stop_event = threading.Event()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    records = {}
+    lock = threading.Lock()
+    state = {'read': 0, 'done': 0, 'total': None}
+    model_state = {'model': None if callable(model) else model, 'error': None}
+    model_lock = threading.Lock()
+    
+    def model_for(image):
+        # Built once, by the first worker to get an image
+        with model_lock:
+            if model_state['model'] is None and model_state['error'] is None:
+                try:
+                    model_state['model'] = model(image)
+                except Exception as e:
+                    model_state['error'] = e
+                    stop_event.set()
+            if model_state['error'] is not None:
+                raise model_state['error']
+            return model_state['model']
+    
+    def finish(index, record):
+        with lock:
+            records[index] = record
+            state['done'] += 1
+            done, total = state['done'], state['total']
+        if progress_callback is not None:
+            progress_callback(done, total)
+    
+    def reader():
+        try:
+            for index, paths in enumerate(path_groups):
+                if stop_event.is_set():
+                    break
+                paths = list(paths)
+                try:
+                    image = _open_image_group(paths, stack_cache_dir)
+                except Exception as e:
+                    finish(index, {'image_path': paths[0], 'error': f"read failed: {e}"})
+                else:
+                    read_queue.put((index, paths, image))
+                state['read'] = index + 1
+        finally:
+            with lock:
+                state['total'] = state['read']
+            for _ in range(n_workers):
+                read_queue.put(None)
+    
+    def worker():
+        while True:
+            item = read_queue.get()
+            if item is None:
+                return
+            index, paths, image = item
+            try:
+                outcome = classify_loaded_image(image, model_for(image), settings)
+            except Exception as e:
+                finish(index, {'image_path': paths[0], 'error': f"classification failed: {e}"})
+                continue
+            # Release the decoded image before the results wait for a writer
+            del image
+            write_queue.put((index, paths, outcome))
+    
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            index, paths, outcome = item
+            record = {'image_path': paths[0], 'percentages': outcome['percentages'],
+                      'confidence_intervals': outcome['confidence_intervals'], 'error': None}
+            try:
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                base_filename = output_stem(paths[0], folder_path)
+                fig = create_results_figure(outcome['result_image'], outcome['percentages'])
+                record['files'] = save_classification_files(output_folder, base_filename, fig,
+                                                            outcome['result_image'], outcome['confidence_image'],
+                                                            outcome['percentages'], outcome['pixel_counts'],
+                                                            outcome['confidence_intervals'], timestamp=timestamp)
+            except Exception as e:
+                record['error'] = f"save failed: {e}"
+            finish(index, record)
+    
+    reader_thread = threading.Thread(target=reader, name="batch-reader", daemon=True)
+    workers = [threading.Thread(target=worker, name=f"batch-worker-{i}", daemon=True) for i in range(n_workers)]
+    writers = [threading.Thread(target=writer, name=f"batch-writer-{i}", daemon=True) for i in range(n_writers)]
+    for thread in [reader_thread] + workers + writers:
+        thread.start()
+    
+    reader_thread.join()
+    for thread in workers:
+        thread.join()
+    # All results are queued; tell the writers to finish
+    for _ in range(n_writers):
+        write_queue.put(None)
+    for thread in writers:
+        thread.join()
+    
+    if model_state['error'] is not None:
+        raise model_state['error']
+    results = [records[index] for index in sorted(records)]
+    if results:
+        write_batch_summary(output_folder, results)
+    return results
+
+
+def write_batch_summary(output_folder, results, timestamp=None):
+    """Write one CSV row of mineral percentages per image of a batch run; return the file path"""
+    if timestamp is None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # Union of the reported classes, in first-seen order
+    names = []
+    for record in results:
+        for name in record.get('percentages') or {}:
+            if name not in names:
+                names.append(name)
+    
+    summary_filename = os.path.join(output_folder, f"batch_summary_{timestamp}.csv")
+    with open(summary_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Image"] + names + ["Error"])
+        for record in results:
+            percentages = record.get('percentages') or {}
+            writer.writerow([record['image_path']] + [percentages.get(name, 0.0) for name in names]
+                            + [record.get('error') or ""])
+    return summary_filename
+
+
+def train_selection_set_model(selections_file, model_type, feature_set=(), n_channels=3,
+                              open_image=load_image_array):
+    """
+    Train a model on the samples of one saved selection file (as the GUI does for
+    the current image). Returns a model dict like load_or_train_campaign_model.
+    """
+    image_path, minerals = load_selections(selections_file)
+    if not minerals:
+        raise ValueError(f"No minerals in {selections_file}")
+    # Sample features come from the images the minerals were selected on
+    X, y = mineral_training_features(minerals, feature_set, n_channels, open_image)
+    
+    classifier, scaler = train_model(X, y, model_type)
+    return {
+        'classifier': classifier,
+        'scaler': scaler,
+        'mineral_names': list(minerals),
+        'y': y,
+        'model_type': model_type,
+        'feature_set': tuple(feature_set),
+    }
+
+
+class ClassificationService:
+    """
+    Classification of uploaded images against the saved selection sets of a
+    results folder. A selection set is identified by the image name of its
+    selection file ({id}_selections.npz), or CAMPAIGN_SELECTION_SET for the model
+    trained on all of them. Trained models stay in memory in an LRU pool of
+    max_models entries and are retrained only when their selection files change;
+    requests are run on a pool of n_workers threads. Each request is classified on
+    its own: concurrent requests for the same model share the model but are not
+    batched into one prediction.
+    """
+    def __init__(self, output_folder, n_workers=2, max_models=8, open_image=load_image_array):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.output_folder = output_folder
+        self.max_models = max_models
+        self.open_image = open_image
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="classify")
+        self.models = collections.OrderedDict()  # key -> (fingerprint, model), least recently used first
+        self.lock = threading.Lock()
+        self.training_locks = {}  # key -> lock, so a model is trained once even for concurrent requests
+    
+    def selection_sets(self):
+        """IDs of the available selection sets"""
+        ids = [os.path.splitext(os.path.basename(path))[0][:-len(SELECTIONS_SUFFIX)]
+               for path in campaign_selection_files(self.output_folder)]
+        return [CAMPAIGN_SELECTION_SET] + ids if ids else []
+    
+    def _fingerprint(self, selection_set, model_type, feature_set, n_channels):
+        if selection_set == CAMPAIGN_SELECTION_SET:
+            files = campaign_selection_files(self.output_folder)
+            if not files:
+                raise KeyError(selection_set)
+            return campaign_fingerprint(files, model_type, feature_set, n_channels), None
+        for path in campaign_selection_files(self.output_folder):
+            stem = os.path.splitext(os.path.basename(path))[0]
+            if stem == selection_set + SELECTIONS_SUFFIX:
+                stat = os.stat(path)
+                return (stat.st_size, stat.st_mtime_ns), path
+        raise KeyError(selection_set)
+    
+    def get_model(self, selection_set, model_type, feature_set, n_channels):
+        """Return the warm model for a selection set, training it on first use"""
+        key = (selection_set, model_type, tuple(feature_set), n_channels)
+        fingerprint, selections_file = self._fingerprint(*key)
+        
+        def cached():
+            with self.lock:
+                entry = self.models.get(key)
+                if entry is not None and entry[0] == fingerprint:
+                    self.models.move_to_end(key)
+                    return entry[1]
+                return None
+        
+        model = cached()
+        if model is not None:
+            return model
+        
+        with self.lock:
+            training_lock = self.training_locks.setdefault(key, threading.Lock())
+        with training_lock:
+            # Another request may have trained it while this one waited
+            model = cached()
+            if model is not None:
+                return model
+            
+            try:
+                if selections_file is None:
+                    model = load_or_train_campaign_model(self.output_folder, model_type, feature_set, n_channels,
+                                                         open_image=self.open_image)
+                else:
+                    model = train_selection_set_model(selections_file, model_type, feature_set, n_channels,
+                                                      open_image=self.open_image)
+            except Exception:
+                with self.lock:
+                    if key not in self.models:
+                        self.training_locks.pop(key, None)
+                raise
+            
+            with self.lock:
+                self.models[key] = (fingerprint, model)
+                self.models.move_to_end(key)
+                while len(self.models) > self.max_models:
+                    # Evicted models drop their training lock too
+                    evicted, _ = self.models.popitem(last=False)
+                    self.training_locks.pop(evicted, None)
+        return model
+    
+    def classify(self, data, selection_set, model_type="knn", feature_set=(), settings=None, include_labels=True):
+        """Classify an encoded image on the worker pool and return the JSON-ready result"""
+        future = self.executor.submit(self._classify, data, selection_set, model_type, tuple(feature_set),
+                                      settings, include_labels)
+        return future.result()
+    
+    def _classify(self, data, selection_set, model_type, feature_set, settings, include_labels):
+        start = time.perf_counter()
+        image = decode_image_bytes(data)
+        h, w, n_channels = image.shape
+        model = self.get_model(selection_set, model_type, feature_set, n_channels)
+        outcome = classify_loaded_image(image, model, settings)
+        
+        n_minerals = len(model['mineral_names'])
+        classes = list(model['mineral_names']) + ["Carbon (Graphite)", "Other"]
+        response = {
+            'selection_set': selection_set,
+            'model': model_type,
+            'feature_set': list(feature_set),
+            'width': w,
+            'height': h,
+            'classes': {str(i): name for i, name in enumerate(classes[:n_minerals + 2])},
+            'percentages': {name: float(value) for name, value in outcome['percentages'].items()},
+            'pixel_counts': {name: int(value) for name, value in outcome['pixel_counts'].items()},
+            'confidence_intervals': {name: [float(lower), float(upper)]
+                                     for name, (lower, upper) in outcome['confidence_intervals'].items()},
+        }
+        if include_labels:
+            # Row-major uint8 class indices (see 'classes')
+            labels = np.ascontiguousarray(outcome['result_image'], dtype=np.uint8)
+            response['labels'] = {
+                'dtype': 'uint8',
+                'shape': [h, w],
+                'encoding': 'base64',
+                'data': base64.b64encode(labels.tobytes()).decode('ascii'),
+            }
+        response['seconds'] = time.perf_counter() - start
+        return response
+
+
+def make_request_handler(service):
+    """
+    HTTP front end of a ClassificationService:
+    GET /health, GET /selection_sets and
+    POST /classify?selection_set=ID[&model=knn&features=hsv,lab&labels=0&carbon_threshold=30...]
+    with the encoded image (TIFF, PNG, JPEG, ...) as the request body.
+    """
+    # Only the service needs the HTTP machinery
+    from http.server import BaseHTTPRequestHandler
+    
+    class ClassificationRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urllib.parse.urlparse(self.path).path
+            if path == "/health":
+                self.send_json(200, {'status': "ok", 'warm_models': len(service.models)})
+            elif path == "/selection_sets":
+                self.send_json(200, {'selection_sets': service.selection_sets()})
+            else:
+                self.send_json(404, {'error': f"Unknown path {path}"})
+        
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/classify":
+                self.send_json(404, {'error': f"Unknown path {url.path}"})
+                return
+            
+            params = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length <= 0:
+                self.send_json(400, {'error': "Send the image as the request body"})
+                return
+            if length > MAX_UPLOAD_BYTES:
+                self.send_json(413, {'error': f"Image larger than {MAX_UPLOAD_BYTES} bytes"})
+                return
+            data = self.rfile.read(length)
+            
+            try:
+                selection_set = params['selection_set']
+                model_type = params.get('model', "knn")
+                if model_type not in ("knn", "svm", "rf", "kmeans"):
+                    raise ValueError(f"Unknown model {model_type}")
+                feature_set = tuple(name for name in FEATURE_OPTIONS
+                                    if name in params.get('features', "").split(","))
+                # Settings in the query string override the defaults, with the same types
+                settings = {name: type(default)(params[name])
+                            for name, default in DEFAULT_SETTINGS.items() if name in params}
+                if settings.get('postprocess', "none") not in ("none", "majority", "superpixels"):
+                    raise ValueError(f"Unknown postprocess {settings['postprocess']}")
+                if settings.get('majority_size', 1) < 1 or settings.get('n_segments', 1) < 1:
+                    raise ValueError("majority_size and n_segments must be positive")
+                if settings.get('ci_method', "binomial") not in ("binomial", "bootstrap"):
+                    raise ValueError(f"Unknown ci_method {settings['ci_method']}")
+                if settings.get('bootstrap_tile_size', 1) < 1:
+                    raise ValueError("bootstrap_tile_size must be positive")
+                include_labels = params.get('labels', "1") not in ("0", "false", "no")
+            except KeyError:
+                self.send_json(400, {'error': "Missing selection_set parameter"})
+                return
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            
+            try:
+                response = service.classify(data, selection_set, model_type, feature_set, settings,
+                                                 include_labels)
+            except KeyError:
+                self.send_json(404, {'error': f"Unknown selection set {selection_set}"})
+            except (ValueError, OSError) as e:
+                self.send_json(400, {'error': str(e)})
+            except Exception as e:
+                self.send_json(500, {'error': f"Classification failed: {e}"})
+            else:
+                self.send_json(200, response)
+        
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    
+    return ClassificationRequestHandler
+
+
+def serve(folder_path, host="127.0.0.1", port=8765, n_workers=2, max_models=8, stack=False):
+    """Run the HTTP classification service for the selection sets saved in folder_path's results folder"""
+    output_folder = os.path.join(folder_path, RESULTS_FOLDER_NAME)
+    stack_cache_dir = os.path.join(output_folder, STACK_CACHE_FOLDER_NAME)
+    # Sample features of stacked selections come from the same stacks
+    path_groups = group_image_stacks(iter_image_paths(folder_path)) if stack else []
+    open_image = make_group_opener(path_groups, stack_cache_dir)
+    
+    from http.server import ThreadingHTTPServer
+    
+    service = ClassificationService(output_folder, n_workers, max_models, open_image)
+    server = ThreadingHTTPServer((host, port), make_request_handler(service))
+    print(f"Serving classification on http://{host}:{server.server_address[1]}/ "
+          f"(selection sets in {output_folder})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.executor.shutdown()
+
 
 class MineralClassifier:
     def __init__(self, root):
@@ -27,10 +2487,28 @@ class MineralClassifier:
         self.root.geometry("1400x800")  # Wider to accommodate the third panel
         
         self.current_image_path = None
+        self.folder_path = None
         self.images_paths = []
+        self.image_scanner = None  # Generator still yielding paths of the current folder
+        self.path_scanner = None  # Underlying folder / index scan (ungrouped paths)
+        self.scanned_paths = []  # Every path pulled from path_scanner so far, in scan order
+        self.scan_job = None  # Pending Tk callback that continues the folder scan
+        self.stack_members = {}  # Primary image path -> all paths of its PPL/XPL stack
         self.current_image_index = 0
-        self.selected_pixels = []
+        self.selected_pixels = SampleSet()  # Pixels selected for the next mineral
+        self.selection_regions = []  # Regions drawn for the next mineral (overlay shapes + sample index range)
+        self.region_points = []  # Vertices / brush path of the region being drawn (image coordinates)
         self.mineral_colors = {}  # Dictionary to store mineral colors
+        self.mineral_names = []  # Class names of the last trained classifier
+        self.batch_thread = None  # Background "Classify Folder" run
+        self.batch_stop = None
+        self.batch_progress = (0, 0)
+        self.batch_results = None
+        self.refine_run = None  # Background full-resolution refinement of a preview (see start_refinement)
+        self.overlay_labels = None  # Label map shown as canvas overlay (preview or full resolution)
+        self.overlay_stride = 1  # Image pixels per overlay label (preview maps)
+        self.overlay_photo = None
+        self.overlay_job = None  # Pending Tk callback redrawing the overlay
         self.current_image = None
         self.current_image_array = None
         self.current_display_image = None  # For zoomed image display
@@ -48,8 +2526,24 @@ class MineralClassifier:
         self.right_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         # Left frame components - Image display and navigation
-        self.btn_select_folder = tk.Button(self.left_frame, text="Select Folder", command=self.select_folder)
-        self.btn_select_folder.pack(pady=10)
+        self.folder_frame = tk.Frame(self.left_frame)
+        self.folder_frame.pack(pady=10)
+        
+        self.btn_select_folder = tk.Button(self.folder_frame, text="Select Folder", command=self.select_folder)
+        self.btn_select_folder.grid(row=0, column=0, padx=5)
+        
+        self.btn_rescan_folder = tk.Button(self.folder_frame, text="Rescan", command=self.rescan_folder)
+        self.btn_rescan_folder.grid(row=0, column=1, padx=5)
+        
+        self.use_image_index_var = tk.BooleanVar(value=False)
+        self.use_image_index_check = tk.Checkbutton(self.folder_frame, text="Use cached image index",
+                                                    variable=self.use_image_index_var)
+        self.use_image_index_check.grid(row=0, column=2, padx=5)
+        
+        self.stack_images_var = tk.BooleanVar(value=False)
+        self.stack_images_check = tk.Checkbutton(self.folder_frame, text="Stack PPL + XPL",
+                                                 variable=self.stack_images_var, command=self.toggle_stacking)
+        self.stack_images_check.grid(row=0, column=3, padx=5)
         
         # Zoom controls
         self.zoom_frame = tk.Frame(self.left_frame)
@@ -67,6 +2561,18 @@ class MineralClassifier:
         self.zoom_label = tk.Label(self.zoom_frame, text="Zoom: 100%")
         self.zoom_label.grid(row=0, column=3, padx=5)
         
+        # Semi-transparent classification overlay on the image canvas
+        self.show_overlay_var = tk.BooleanVar(value=True)
+        self.show_overlay_check = tk.Checkbutton(self.zoom_frame, text="Show Overlay",
+                                                 variable=self.show_overlay_var, command=self.draw_overlay)
+        self.show_overlay_check.grid(row=0, column=4, padx=5)
+        
+        self.overlay_alpha_var = tk.IntVar(value=50)  # Overlay opacity in percent
+        self.overlay_alpha_scale = tk.Scale(self.zoom_frame, variable=self.overlay_alpha_var, from_=0, to=100,
+                                            resolution=5, orient=tk.HORIZONTAL, length=100, showvalue=False,
+                                            command=lambda value: self.schedule_overlay())
+        self.overlay_alpha_scale.grid(row=0, column=5, padx=5)
+        
         # Image canvas with scrollbars
         self.image_frame = tk.Frame(self.left_frame, width=530, height=580)
         self.image_frame.pack(pady=10, fill=tk.BOTH, expand=True)
@@ -83,10 +2589,15 @@ class MineralClassifier:
                                yscrollcommand=self.v_scrollbar.set)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
-        self.h_scrollbar.config(command=self.canvas.xview)
-        self.v_scrollbar.config(command=self.canvas.yview)
+        self.h_scrollbar.config(command=self.scroll_x)
+        self.v_scrollbar.config(command=self.scroll_y)
         
         self.canvas.bind("<Button-1>", self.on_canvas_click)
+        # Region selection tools (rectangle / brush drag, polygon double-click to close)
+        self.canvas.bind("<B1-Motion>", self.on_canvas_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
+        self.canvas.bind("<Double-Button-1>", self.on_canvas_double_click)
+        self.root.bind("<Escape>", self.cancel_region)
         # Add mouse wheel binding for zoom
         self.canvas.bind("<MouseWheel>", self.on_mousewheel)  # For Windows
         self.canvas.bind("<Button-4>", self.on_mousewheel)  # For Linux, scroll up
@@ -94,6 +2605,8 @@ class MineralClassifier:
         # Add panning with middle mouse button
         self.canvas.bind("<ButtonPress-2>", self.start_pan)
         self.canvas.bind("<B2-Motion>", self.pan_image)
+        # The overlay only covers the visible region, so it follows resizes and scrolling
+        self.canvas.bind("<Configure>", lambda event: self.schedule_overlay())
         
         # Navigation buttons
         self.navigation_frame = tk.Frame(self.left_frame)
@@ -151,6 +2664,35 @@ class MineralClassifier:
         self.load_selections_btn = tk.Button(self.save_load_frame, text="Load Selections", command=self.load_mineral_selections)
         self.load_selections_btn.grid(row=0, column=1, padx=5)
         
+        # Selection tool: single pixels or all pixels of a region
+        self.selection_tool_frame = tk.Frame(self.control_frame)
+        self.selection_tool_frame.grid(row=5, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
+        
+        self.selection_tool_var = tk.StringVar(value="point")
+        tool_labels = {'point': "Point", 'rectangle': "Rectangle", 'polygon': "Polygon", 'brush': "Brush"}
+        for i, name in enumerate(SELECTION_TOOLS):
+            radio = tk.Radiobutton(self.selection_tool_frame, text=tool_labels[name],
+                                   variable=self.selection_tool_var, value=name, command=self.cancel_region)
+            radio.grid(row=0, column=i, padx=2, sticky=tk.W)
+        
+        self.brush_radius_label = tk.Label(self.selection_tool_frame, text="Brush Radius:")
+        self.brush_radius_label.grid(row=1, column=0, padx=2, sticky=tk.W)
+        
+        self.brush_radius_var = tk.IntVar(value=5)
+        self.brush_radius_spinbox = tk.Spinbox(self.selection_tool_frame, from_=1, to=100, width=4,
+                                               textvariable=self.brush_radius_var)
+        self.brush_radius_spinbox.grid(row=1, column=1, padx=2, sticky=tk.W)
+        
+        self.max_region_samples_label = tk.Label(self.selection_tool_frame, text="Max Pixels/Region:")
+        self.max_region_samples_label.grid(row=1, column=2, padx=2, sticky=tk.W)
+        
+        # 0 keeps every covered pixel
+        self.max_region_samples_var = tk.IntVar(value=2000)
+        self.max_region_samples_spinbox = tk.Spinbox(self.selection_tool_frame, from_=0, to=1000000,
+                                                     increment=500, width=8,
+                                                     textvariable=self.max_region_samples_var)
+        self.max_region_samples_spinbox.grid(row=1, column=3, padx=2, sticky=tk.W)
+        
         # Classification model selection
         self.model_frame = tk.LabelFrame(self.center_frame, text="Classification Model")
         self.model_frame.pack(pady=10, fill=tk.X, padx=10)
@@ -173,6 +2715,28 @@ class MineralClassifier:
                                            variable=self.model_var, value="kmeans")
         self.kmeans_radio.grid(row=1, column=1, padx=5, pady=5, sticky=tk.W)
         
+        # Train on the saved selections of every image instead of the current minerals only
+        self.use_campaign_model_var = tk.BooleanVar(value=False)
+        self.use_campaign_model_check = tk.Checkbutton(self.model_frame, text="Use campaign model (all saved selections)",
+                                                       variable=self.use_campaign_model_var)
+        self.use_campaign_model_check.grid(row=2, column=0, columnspan=2, padx=5, pady=2, sticky=tk.W)
+        
+        # Optional pixel features (raw channel values are always used)
+        self.features_frame = tk.LabelFrame(self.center_frame, text="Pixel Features")
+        self.features_frame.pack(pady=10, fill=tk.X, padx=10)
+        
+        self.feature_vars = {}
+        feature_labels = {
+            'hsv': "HSV Color",
+            'lab': "Lab Color",
+            'texture': "Local Mean/Variance",
+            'gradient': "Gradient Magnitude",
+        }
+        for i, name in enumerate(FEATURE_OPTIONS):
+            self.feature_vars[name] = tk.BooleanVar(value=False)
+            check = tk.Checkbutton(self.features_frame, text=feature_labels[name], variable=self.feature_vars[name])
+            check.grid(row=i // 2, column=i % 2, padx=5, pady=2, sticky=tk.W)
+        
         # Classification button and reset button
         self.buttons_frame = tk.Frame(self.center_frame)
         self.buttons_frame.pack(pady=10)
@@ -183,12 +2747,34 @@ class MineralClassifier:
         self.reset_results_btn = tk.Button(self.buttons_frame, text="Reset Results", command=self.reset_results)
         self.reset_results_btn.grid(row=0, column=1, padx=5)
         
+        self.classify_folder_btn = tk.Button(self.buttons_frame, text="Classify Folder", command=self.classify_all_images)
+        self.classify_folder_btn.grid(row=0, column=2, padx=5)
+        
+        # Show a quick strided classification first and refine it in the background
+        self.preview_var = tk.BooleanVar(value=False)
+        self.preview_check = tk.Checkbutton(self.buttons_frame, text="Quick Preview First", variable=self.preview_var)
+        self.preview_check.grid(row=1, column=0, columnspan=3, pady=2)
+        
         # Save results checkbox
         self.save_results_var = tk.BooleanVar(value=True)
         self.save_results_check = tk.Checkbutton(self.center_frame, text="Save Results", 
                                                variable=self.save_results_var)
         self.save_results_check.pack(pady=5)
         
+        # Opt-in stage timing / memory report
+        self.profile_frame = tk.Frame(self.center_frame)
+        self.profile_frame.pack(pady=5)
+        
+        self.profile_run_var = tk.BooleanVar(value=False)
+        self.profile_run_check = tk.Checkbutton(self.profile_frame, text="Profile Run",
+                                                variable=self.profile_run_var)
+        self.profile_run_check.grid(row=0, column=0, padx=5)
+        
+        self.cprofile_var = tk.BooleanVar(value=False)
+        self.cprofile_check = tk.Checkbutton(self.profile_frame, text="cProfile Dump",
+                                             variable=self.cprofile_var)
+        self.cprofile_check.grid(row=0, column=1, padx=5)
+        
         # Minerals frame
         self.minerals_frame = tk.LabelFrame(self.center_frame, text="Identified Minerals")
         self.minerals_frame.pack(pady=10, fill=tk.X, padx=10)
@@ -196,6 +2782,28 @@ class MineralClassifier:
         self.minerals_listbox = tk.Listbox(self.minerals_frame, width=50, height=5)
         self.minerals_listbox.pack(pady=5, padx=5, fill=tk.X)
         
+        # Active learning: suggest where to pick the next samples
+        self.suggest_frame = tk.LabelFrame(self.center_frame, text="Sample Suggestions")
+        self.suggest_frame.pack(pady=5, fill=tk.X, padx=10)
+        
+        self.suggest_mode_var = tk.StringVar(value="confidence")
+        
+        self.suggest_confidence_radio = tk.Radiobutton(self.suggest_frame, text="Lowest Confidence",
+                                                       variable=self.suggest_mode_var, value="confidence")
+        self.suggest_confidence_radio.grid(row=0, column=0, padx=5, pady=2, sticky=tk.W)
+        
+        self.suggest_other_radio = tk.Radiobutton(self.suggest_frame, text="'Other' Clusters",
+                                                  variable=self.suggest_mode_var, value="other")
+        self.suggest_other_radio.grid(row=0, column=1, padx=5, pady=2, sticky=tk.W)
+        
+        self.suggest_count_var = tk.IntVar(value=5)
+        self.suggest_count_spinbox = tk.Spinbox(self.suggest_frame, from_=1, to=50, width=4,
+                                                textvariable=self.suggest_count_var)
+        self.suggest_count_spinbox.grid(row=0, column=2, padx=5, pady=2)
+        
+        self.suggest_btn = tk.Button(self.suggest_frame, text="Suggest Samples", command=self.suggest_samples)
+        self.suggest_btn.grid(row=0, column=3, padx=5, pady=2)
+        
         # Results frame for displaying classification results
         self.results_frame = tk.LabelFrame(self.center_frame, text="Classification Results")
         self.results_frame.pack(pady=10, fill=tk.BOTH, expand=True, padx=10)
@@ -256,6 +2864,62 @@ class MineralClassifier:
                                             from_=10.0, to=200.0, resolution=5.0, orient=tk.HORIZONTAL, length=150)
         self.other_threshold_scale.grid(row=0, column=1, padx=5, pady=5, sticky=tk.W)
         
+        # Post-classification smoothing
+        self.postprocess_frame = tk.LabelFrame(self.settings_frame, text="Post-processing")
+        self.postprocess_frame.pack(pady=5, fill=tk.X)
+        
+        self.postprocess_var = tk.StringVar(value="none")
+        
+        self.postprocess_none_radio = tk.Radiobutton(self.postprocess_frame, text="None",
+                                                     variable=self.postprocess_var, value="none")
+        self.postprocess_none_radio.grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        
+        self.postprocess_majority_radio = tk.Radiobutton(self.postprocess_frame, text="Majority Filter",
+                                                         variable=self.postprocess_var, value="majority")
+        self.postprocess_majority_radio.grid(row=0, column=1, padx=5, pady=5, sticky=tk.W)
+        
+        self.postprocess_superpixel_radio = tk.Radiobutton(self.postprocess_frame, text="Superpixels",
+                                                           variable=self.postprocess_var, value="superpixels")
+        self.postprocess_superpixel_radio.grid(row=0, column=2, padx=5, pady=5, sticky=tk.W)
+        
+        self.majority_size_label = tk.Label(self.postprocess_frame, text="Filter Size:")
+        self.majority_size_label.grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
+        
+        self.majority_size_var = tk.IntVar(value=3)  # Default neighbourhood size
+        self.majority_size_scale = tk.Scale(self.postprocess_frame, variable=self.majority_size_var,
+                                            from_=3, to=15, resolution=2, orient=tk.HORIZONTAL, length=150)
+        self.majority_size_scale.grid(row=1, column=1, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        
+        self.superpixel_count_label = tk.Label(self.postprocess_frame, text="Superpixels:")
+        self.superpixel_count_label.grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
+        
+        self.superpixel_count_var = tk.IntVar(value=2000)  # Default number of segments
+        self.superpixel_count_scale = tk.Scale(self.postprocess_frame, variable=self.superpixel_count_var,
+                                               from_=100, to=20000, resolution=100, orient=tk.HORIZONTAL, length=150)
+        self.superpixel_count_scale.grid(row=2, column=1, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        
+        # Confidence interval method for the mineral proportions
+        self.ci_frame = tk.LabelFrame(self.settings_frame, text="Confidence Intervals")
+        self.ci_frame.pack(pady=5, fill=tk.X)
+        
+        self.ci_method_var = tk.StringVar(value="binomial")
+        
+        self.ci_binomial_radio = tk.Radiobutton(self.ci_frame, text="Binomial",
+                                                variable=self.ci_method_var, value="binomial")
+        self.ci_binomial_radio.grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        
+        self.ci_bootstrap_radio = tk.Radiobutton(self.ci_frame, text="Block Bootstrap",
+                                                 variable=self.ci_method_var, value="bootstrap")
+        self.ci_bootstrap_radio.grid(row=0, column=1, padx=5, pady=5, sticky=tk.W)
+        
+        self.bootstrap_tile_label = tk.Label(self.ci_frame, text="Tile Size:")
+        self.bootstrap_tile_label.grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
+        
+        self.bootstrap_tile_var = tk.IntVar(value=BOOTSTRAP_TILE_SIZE)  # Default tile size in pixels
+        self.bootstrap_tile_scale = tk.Scale(self.ci_frame, variable=self.bootstrap_tile_var,
+                                             from_=16, to=512, resolution=16, orient=tk.HORIZONTAL, length=150)
+        self.bootstrap_tile_scale.grid(row=1, column=1, padx=5, pady=5, sticky=tk.W)
+        
         # Variables for panning
         self.pan_start_x = 0
         self.pan_start_y = 0
@@ -264,6 +2928,10 @@ class MineralClassifier:
         # Initialize classifier
         self.classifier = None
         self.scaler = None
+        
+        # Cached results of the last classification, used for sample suggestions
+        self.suggester = None
+        self.suggested_points = []
 
     def add_parameter_descriptions(self):
         """Add descriptive text for all parameters to the help panel"""
@@ -277,7 +2945,7 @@ class MineralClassifier:
         
         usage_text = (
             "1. Select a folder with mineral images\n"
-            "2. Click on pixels to select minerals\n"
+            "2. Click pixels or draw regions to select minerals\n"
             "3. Name and add minerals\n"
             "4. Choose classification model\n"
             "5. Adjust thresholds if needed\n"
@@ -358,6 +3026,54 @@ class MineralClassifier:
         distance_label = tk.Label(distance_frame, text=distance_text, justify=tk.LEFT)
         distance_label.pack(pady=5, anchor="w")
         
+        # Pixel features
+        features_frame = tk.LabelFrame(self.help_content_frame, text="Pixel Features")
+        features_frame.pack(pady=5, fill=tk.X, padx=5)
+        
+        features_text = (
+            "Extra information used besides the\n"
+            "raw RGB value of each pixel.\n\n"
+            "- HSV/Lab: separate hue and\n  brightness of similar colors\n"
+            "- Local Mean/Variance: texture in a\n  5x5 window (e.g. carbon vs opaques)\n"
+            "- Gradient: strength of edges\n"
+            "- Features of selected samples are\n  taken from the current image\n"
+            "- Default: RGB only"
+        )
+        
+        features_label = tk.Label(features_frame, text=features_text, justify=tk.LEFT)
+        features_label.pack(pady=5, anchor="w")
+        
+        # Post-processing
+        postprocess_frame = tk.LabelFrame(self.help_content_frame, text="Post-processing")
+        postprocess_frame.pack(pady=5, fill=tk.X, padx=5)
+        
+        postprocess_text = (
+            "Reduces salt-and-pepper noise in\n"
+            "the classification map.\n\n"
+            "- Majority Filter: each pixel takes the\n  most common class around it\n"
+            "- Filter Size: neighbourhood width\n  in pixels (default: 3)\n"
+            "- Superpixels: groups similar pixels\n  and classifies each group once\n"
+            "- Much faster on large images\n"
+            "- Default: 2000 superpixels"
+        )
+        
+        postprocess_label = tk.Label(postprocess_frame, text=postprocess_text, justify=tk.LEFT)
+        postprocess_label.pack(pady=5, anchor="w")
+        
+        # Confidence intervals
+        ci_frame = tk.LabelFrame(self.help_content_frame, text="Confidence Intervals")
+        ci_frame.pack(pady=5, fill=tk.X, padx=5)
+        
+        ci_text = (
+            "Uncertainty of the mineral percentages.\n\n"
+            "- Binomial: treats every pixel as\n  independent; intervals are far\n  too narrow on real maps\n"
+            "- Block Bootstrap: resamples square\n  tiles, so neighbouring pixels of\n  one grain count together\n"
+            "- Tile Size: should be larger than\n  typical grains (default: 64)"
+        )
+        
+        ci_label = tk.Label(ci_frame, text=ci_text, justify=tk.LEFT)
+        ci_label.pack(pady=5, anchor="w")
+        
         # Tips
         tips_frame = tk.LabelFrame(self.help_content_frame, text="Tips")
         tips_frame.pack(pady=5, fill=tk.X, padx=5)
@@ -369,7 +3085,8 @@ class MineralClassifier:
             "• Try different models for best results\n"
             "• Adjust thresholds incrementally\n"
             "• Check the confidence intervals\n"
-            "• Use 'Other' category for unknown minerals"
+            "• Use 'Other' category for unknown minerals\n"
+            "• After classifying, use 'Suggest Samples'\n  to find regions worth labeling next"
         )
         
         tips_label = tk.Label(tips_frame, text=tips_text, justify=tk.LEFT)
@@ -380,23 +3097,52 @@ class MineralClassifier:
         if not folder_path:
             return
             
-        # Get all image files from the selected folder
-        self.images_paths = []
-        for file in os.listdir(folder_path):
-            if file.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg')):
-                self.images_paths.append(os.path.join(folder_path, file))
+        self.open_folder(folder_path)
+
+    def rescan_folder(self):
+        """Scan the current folder again, rebuilding the cached index if it is used"""
+        if not self.folder_path:
+            return
+            
+        self.open_folder(self.folder_path, refresh_index=True)
+
+    def open_folder(self, folder_path, refresh_index=False):
+        """Start a lazy scan of folder_path and display the first image found"""
+        self.stop_image_scan()
+        
+        # Output folder for classification results (also holds the cached index)
+        output_folder = os.path.join(folder_path, RESULTS_FOLDER_NAME)
+        index_path = None
+        if self.use_image_index_var.get():
+            index_path = os.path.join(output_folder, IMAGE_INDEX_FILENAME)
+        
+        # Only pull the first image now; the rest of the folder is scanned in the background
+        self.stack_members = {}
+        self.scanned_paths = []
+        self.path_scanner = iter_image_paths(folder_path, index_path, refresh=refresh_index)
+        scanner = self.record_scanned_paths(self.path_scanner)
+        if self.stack_images_var.get():
+            scanner = self.iter_stack_primaries(scanner)
+        first_paths = list(itertools.islice(scanner, 1))
                 
-        if not self.images_paths:
+        if not first_paths:
+            scanner.close()
+            self.path_scanner.close()
+            self.path_scanner = None
             messagebox.showinfo("No Images", "No image files found in the selected folder.")
             return
             
+        self.folder_path = folder_path
+        self.images_paths = first_paths
+        self.image_scanner = scanner
+        
         # Create output folder for classification results
-        self.output_folder = os.path.join(folder_path, "mineral_classification_results")
+        self.output_folder = output_folder
         os.makedirs(self.output_folder, exist_ok=True)
         
         # Reset variables
         self.current_image_index = 0
-        self.selected_pixels = []
+        self.new_selection()
         self.mineral_colors = {}
         self.zoom_level = 1.0
         self.update_selected_pixels_display()
@@ -408,33 +3154,141 @@ class MineralClassifier:
         
         # Display the first image
         self.display_current_image()
+        
+        # Continue scanning the folder between GUI events
+        self.scan_job = self.root.after(1, self.continue_image_scan)
+
+    def toggle_stacking(self):
+        """
+        Regroup the images of the current folder with or without PPL/XPL stacking.
+        The paths scanned so far are regrouped (a running scan continues), so the
+        image index, the mineral definitions and the current image are kept.
+        """
+        if not self.folder_path:
+            return
+        
+        # Keep the underlying scan running, only replace the grouping on top of it
+        if self.scan_job is not None:
+            self.root.after_cancel(self.scan_job)
+            self.scan_job = None
+        source = iter(list(self.scanned_paths))
+        if self.image_scanner is not None:
+            self.image_scanner.close()
+            source = itertools.chain(source, self.record_scanned_paths(self.path_scanner))
+        
+        self.stack_members = {}
+        if self.stack_images_var.get():
+            scanner = self.iter_stack_primaries(source)
+        else:
+            scanner = (path for path in source)  # Closable, like the scanners of open_folder
+        current_path = self.current_image_path
+        self.images_paths = []
+        self.image_scanner = scanner
+        self.current_image_index = 0
+        
+        # Regroup up to the current image (its stack when stacking) so it stays on display
+        self.continue_image_scan(schedule=False)
+        while current_path is not None and self.image_scanner is not None:
+            if any(path == current_path or current_path in self.stack_members.get(path, ())
+                   for path in self.images_paths[-SCAN_BATCH_SIZE:]):
+                break
+            self.continue_image_scan(schedule=False)
+        for i, path in enumerate(self.images_paths):
+            if path == current_path or current_path in self.stack_members.get(path, ()):
+                self.current_image_index = i
+                break
+        
+        self.reset_results()
+        self.display_current_image()
+        if self.image_scanner is not None:
+            self.scan_job = self.root.after(1, self.continue_image_scan)
+
+    def record_scanned_paths(self, paths):
+        """Pass scanned paths through, remembering them for regrouping (see toggle_stacking)"""
+        for path in paths:
+            self.scanned_paths.append(path)
+            yield path
+
+    def iter_stack_primaries(self, paths):
+        """Group scanned paths into PPL/XPL stacks, yielding the primary path of each"""
+        for group in group_image_stacks(paths):
+            self.stack_members[group[0]] = group
+            yield group[0]
+
+    def continue_image_scan(self, schedule=True):
+        """Append the next batch of scanned paths to images_paths"""
+        self.scan_job = None
+        if self.image_scanner is None:
+            return
+            
+        batch = list(itertools.islice(self.image_scanner, SCAN_BATCH_SIZE))
+        self.images_paths.extend(batch)
+        
+        if len(batch) < SCAN_BATCH_SIZE:
+            # Scan finished
+            self.image_scanner = None
+            self.path_scanner = None
+        elif schedule:
+            self.scan_job = self.root.after(1, self.continue_image_scan)
+            
+        self.update_image_counter()
+
+    def stop_image_scan(self):
+        """Cancel a folder scan that is still running"""
+        if self.scan_job is not None:
+            self.root.after_cancel(self.scan_job)
+            self.scan_job = None
+        if self.image_scanner is not None:
+            self.image_scanner.close()
+            self.image_scanner = None
+        if self.path_scanner is not None:
+            self.path_scanner.close()
+            self.path_scanner = None
+
+    def update_image_counter(self):
+        if not self.images_paths:
+            self.label_image_counter.config(text="0/0")
+            return
+            
+        # A trailing '+' means the folder is still being scanned
+        suffix = "+" if self.image_scanner is not None else ""
+        self.label_image_counter.config(text=f"{self.current_image_index + 1}/{len(self.images_paths)}{suffix}")
 
     def display_current_image(self):
         if not self.images_paths:
             return
             
         self.current_image_path = self.images_paths[self.current_image_index]
+        self.cancel_refinement()
+        self.clear_suggestions()
+        self.overlay_labels = None  # Labels of the previous image
         
         try:
             # Open and store the image
-            self.original_image = Image.open(self.current_image_path)
-            self.current_image_array = np.array(self.original_image)
+            stack_paths = self.stack_members.get(self.current_image_path, [])
+            if len(stack_paths) > 1:
+                # Memory-mapped PPL + XPL stack; the primary image is displayed
+                cache_dir = os.path.join(self.output_folder, STACK_CACHE_FOLDER_NAME)
+                self.current_image_array = load_image_stack(stack_paths, cache_dir)
+            else:
+                self.current_image_array = load_image_array(self.current_image_path)
+            # 8-bit copy for display only; classification works on current_image_array
+            self.original_image = display_image(primary_layer(self.current_image_array))
             
             # Apply the current zoom level
             self.apply_zoom()
             
             # Update image counter
-            self.label_image_counter.config(text=f"{self.current_image_index + 1}/{len(self.images_paths)}")
+            self.update_image_counter()
             
             # Reset selected pixels for the new image
-            self.selected_pixels = []
+            self.new_selection()
             self.update_selected_pixels_display()
             
             # Look for saved mineral selections for this image
             if self.output_folder:
-                base_filename = os.path.splitext(os.path.basename(self.current_image_path))[0]
-                selections_file = os.path.join(self.output_folder, f"{base_filename}_selections.json")
-                if os.path.exists(selections_file):
+                selections_file = find_selections_file(self.output_folder, self.current_image_path, self.folder_path)
+                if selections_file:
                     self.load_mineral_selections(selections_file)
             
         except Exception as e:
@@ -467,19 +3321,69 @@ class MineralClassifier:
         self.canvas.delete("all")
         
         # Display the new image
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.current_display_image)
+        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.current_display_image, tags="base_image")
         
         # Redraw markers for selected pixels
         self.redraw_markers()
+        self.draw_overlay()
+
+    def scroll_x(self, *args):
+        self.canvas.xview(*args)
+        self.schedule_overlay()
+
+    def scroll_y(self, *args):
+        self.canvas.yview(*args)
+        self.schedule_overlay()
+
+    def schedule_overlay(self):
+        """Redraw the overlay once the current burst of scroll/resize events is over"""
+        if self.overlay_job is not None:
+            self.root.after_cancel(self.overlay_job)
+        self.overlay_job = self.root.after(30, self.draw_overlay)
+
+    def draw_overlay(self):
+        """Draw the classification labels of the visible region over the image"""
+        self.overlay_job = None
+        self.canvas.delete("overlay")
+        self.overlay_photo = None
+        if self.overlay_labels is None or self.original_image is None or not self.show_overlay_var.get():
+            return
+        
+        # Visible region in zoomed display pixels
+        view_x = self.canvas.canvasx(0)
+        view_y = self.canvas.canvasy(0)
+        alpha = int(self.overlay_alpha_var.get() * 255 / 100)
+        palette = class_palette(len(self.mineral_names), alpha)
+        overlay = render_label_overlay(self.overlay_labels, view_x, view_y, self.canvas.winfo_width(),
+                                       self.canvas.winfo_height(), self.zoom_level, palette,
+                                       label_stride=self.overlay_stride)
+        if overlay.size == 0:
+            return
+        
+        self.overlay_photo = ImageTk.PhotoImage(Image.fromarray(overlay, mode='RGBA'))
+        self.canvas.create_image(max(0, int(view_x)), max(0, int(view_y)), anchor=tk.NW,
+                                 image=self.overlay_photo, tags="overlay")
+        # Above the image, below the sample markers
+        self.canvas.tag_raise("overlay", "base_image")
 
     def redraw_markers(self):
-        if not self.selected_pixels or self.original_image is None:
+        if self.original_image is None:
             return
             
+        self.draw_suggestion_markers()
+        self.draw_region_overlays()
+        if self.region_points:
+            self.draw_region_preview()
+        
+        # Pixels selected by regions are shown by their region overlay only
+        single = np.ones(len(self.selected_pixels), dtype=bool)
+        for region in self.selection_regions:
+            single[region['start']:region['end']] = False
+        
         # For each selected pixel, calculate its position in the zoomed image
         # and draw a marker
         marker_radius = 5
-        for x, y, _ in self.selected_pixels:
+        for x, y in self.selected_pixels.coords[single]:
             # Calculate the position in the zoomed image
             zoomed_x = int(x * self.zoom_level)
             zoomed_y = int(y * self.zoom_level)
@@ -490,6 +3394,82 @@ class MineralClassifier:
                 outline="yellow", width=2
             )
 
+    def draw_suggestion_markers(self):
+        """Draw a square marker on every suggested sample location"""
+        self.canvas.delete("suggestion")
+        marker_radius = 7
+        for x, y in self.suggested_points:
+            zoomed_x = int(x * self.zoom_level)
+            zoomed_y = int(y * self.zoom_level)
+            
+            self.canvas.create_rectangle(
+                zoomed_x - marker_radius, zoomed_y - marker_radius,
+                zoomed_x + marker_radius, zoomed_y + marker_radius,
+                outline="cyan", width=2, tags="suggestion"
+            )
+
+    def draw_region_overlays(self):
+        """Draw each selected region as a single stippled canvas item"""
+        self.canvas.delete("region")
+        for region in self.selection_regions:
+            self.draw_region_shape(region['kind'], region['points'], region['radius'], tags="region")
+
+    def draw_region_shape(self, kind, points, radius, tags, closed=True):
+        """Draw a rectangle, polygon or brush stroke given in image coordinates"""
+        flat = [coordinate * self.zoom_level for point in points for coordinate in point]
+        if kind == 'brush':
+            width = max(1, int((2 * radius + 1) * self.zoom_level))
+            if len(points) == 1:
+                flat = flat * 2  # A single dab
+            self.canvas.create_line(*flat, fill="yellow", width=width, capstyle=tk.ROUND,
+                                    joinstyle=tk.ROUND, stipple="gray50", tags=tags)
+        elif kind == 'rectangle':
+            self.canvas.create_rectangle(*flat, outline="yellow", width=2, fill="yellow",
+                                         stipple="gray25", tags=tags)
+        elif closed and len(points) > 2:
+            self.canvas.create_polygon(*flat, outline="yellow", width=2, fill="yellow",
+                                       stipple="gray25", tags=tags)
+        elif len(points) > 1:
+            # Polygon still being drawn
+            self.canvas.create_line(*flat, fill="yellow", width=2, tags=tags)
+
+    def suggest_samples(self):
+        """Suggest the next sample locations from the cached results of the last classification"""
+        if self.suggester is None:
+            messagebox.showinfo("No Results", "Classify the image first to get sample suggestions.")
+            return
+            
+        count = self.suggest_count_var.get()
+        if self.suggest_mode_var.get() == "other":
+            points = self.suggester.next_other_clusters(self.current_image_array, count)
+        else:
+            # Skip regions that already hold a sample
+            labeled = [data['samples'].coords for data in self.mineral_colors.values()
+                       if data.get('source') == self.current_image_path]
+            labeled.append(self.selected_pixels.coords)
+            points = self.suggester.next_low_confidence(count, exclude_points=np.concatenate(labeled))
+            
+        if not points:
+            messagebox.showinfo("No Suggestions", "No further sample suggestions for this result.")
+            
+        self.suggested_points = points
+        self.draw_suggestion_markers()
+        
+        if points:
+            # Scroll so the first suggestion is in view
+            x, y = points[0]
+            orig_width, orig_height = self.original_image.size
+            view_width = self.canvas.winfo_width() / (orig_width * self.zoom_level)
+            view_height = self.canvas.winfo_height() / (orig_height * self.zoom_level)
+            self.canvas.xview_moveto(max(0.0, x / orig_width - view_width / 2))
+            self.canvas.yview_moveto(max(0.0, y / orig_height - view_height / 2))
+
+    def clear_suggestions(self):
+        """Forget cached results and suggested sample locations"""
+        self.suggester = None
+        self.suggested_points = []
+        self.canvas.delete("suggestion")
+
     def zoom_in(self):
         if self.original_image is None:
             return
@@ -555,6 +3535,7 @@ class MineralClassifier:
         # Reset start position
         self.pan_start_x = event.x
         self.pan_start_y = event.y
+        self.schedule_overlay()
 
     def next_image(self):
         if not self.images_paths:
@@ -570,10 +3551,8 @@ class MineralClassifier:
         self.current_image_index = (self.current_image_index - 1) % len(self.images_paths)
         self.display_current_image()
 
-    def on_canvas_click(self, event):
-        if self.original_image is None:
-            return
-            
+    def event_to_image_coords(self, event):
+        """Convert a canvas event position to image pixel coordinates, clipped to the image"""
         # Get canvas coordinates
         canvas_x = self.canvas.canvasx(event.x)
         canvas_y = self.canvas.canvasy(event.y)
@@ -586,12 +3565,38 @@ class MineralClassifier:
         orig_width, orig_height = self.original_image.size
         x_orig = max(0, min(x_orig, orig_width - 1))
         y_orig = max(0, min(y_orig, orig_height - 1))
+        return x_orig, y_orig
+
+    def on_canvas_click(self, event):
+        if self.original_image is None:
+            return
+            
+        x_orig, y_orig = self.event_to_image_coords(event)
+        
+        tool = self.selection_tool_var.get()
+        if tool == 'polygon':
+            # Each click adds a vertex; double-click closes the polygon
+            self.region_points.append((x_orig, y_orig))
+            self.draw_region_preview()
+            return
+        if tool in ('rectangle', 'brush'):
+            # Dragging draws the region, releasing the button selects its pixels
+            self.region_points = [(x_orig, y_orig)]
+            self.draw_region_preview()
+            return
+        
+        # Clicking on a suggestion marker selects exactly the suggested pixel
+        snap_radius = 7 / self.zoom_level
+        for x_sug, y_sug in self.suggested_points:
+            if abs(x_sug - x_orig) <= snap_radius and abs(y_sug - y_orig) <= snap_radius:
+                x_orig, y_orig = x_sug, y_sug
+                break
         
         # Get RGB value at that point
         pixel_color = self.current_image_array[y_orig, x_orig]
         
         # Add to selected pixels
-        self.selected_pixels.append((x_orig, y_orig, pixel_color))
+        self.selected_pixels.append(x_orig, y_orig, pixel_color)
         
         # Update display
         self.update_selected_pixels_display()
@@ -607,13 +3612,107 @@ class MineralClassifier:
             outline="yellow", width=2
         )
 
+    def on_canvas_drag(self, event):
+        if self.original_image is None or not self.region_points:
+            return
+            
+        tool = self.selection_tool_var.get()
+        point = self.event_to_image_coords(event)
+        if tool == 'rectangle':
+            self.region_points = [self.region_points[0], point]
+        elif tool == 'brush':
+            if point != self.region_points[-1]:
+                self.region_points.append(point)
+        else:
+            return
+        self.draw_region_preview()
+
+    def on_canvas_release(self, event):
+        if self.original_image is None or not self.region_points:
+            return
+            
+        tool = self.selection_tool_var.get()
+        if tool == 'rectangle':
+            if len(self.region_points) == 1:
+                self.region_points.append(self.region_points[0])
+            self.finish_region()
+        elif tool == 'brush':
+            self.finish_region()
+
+    def on_canvas_double_click(self, event):
+        if self.original_image is None:
+            return
+            
+        if self.selection_tool_var.get() == 'polygon' and len(self.region_points) >= 3:
+            self.finish_region()
+
+    def cancel_region(self, event=None):
+        """Discard the region currently being drawn"""
+        self.region_points = []
+        self.canvas.delete("region_preview")
+
+    def draw_region_preview(self):
+        self.canvas.delete("region_preview")
+        tool = self.selection_tool_var.get()
+        if tool == 'rectangle' and len(self.region_points) == 1:
+            return
+        self.draw_region_shape(tool, self.region_points, self.brush_radius_var.get(),
+                               tags="region_preview", closed=False)
+
+    def finish_region(self):
+        """Add all pixels covered by the drawn region to the selection"""
+        tool = self.selection_tool_var.get()
+        points = self.region_points
+        radius = self.brush_radius_var.get()
+        self.cancel_region()
+        
+        shape = self.current_image_array.shape
+        if tool == 'rectangle':
+            coords = rectangle_pixel_coords(points[0], points[1], shape)
+        elif tool == 'polygon':
+            coords = polygon_pixel_coords(points, shape)
+        else:
+            coords = brush_pixel_coords(points, radius, shape)
+        coords = subsample_coords(coords, self.max_region_samples_var.get())
+        if len(coords) == 0:
+            return
+        
+        # One fancy-indexing read for all covered pixels
+        colors = self.current_image_array[coords[:, 1], coords[:, 0]]
+        start = len(self.selected_pixels)
+        self.selected_pixels.extend(coords, colors)
+        self.selection_regions.append({
+            'kind': tool,
+            'points': points,
+            'radius': radius,
+            'start': start,
+            'end': len(self.selected_pixels),
+        })
+        
+        self.update_selected_pixels_display()
+        self.draw_region_overlays()
+
+    def new_selection(self):
+        """Start an empty selection for the next mineral"""
+        self.selected_pixels = SampleSet()
+        self.selection_regions = []
+        self.region_points = []
+
     def update_selected_pixels_display(self):
         self.selected_pixels_listbox.delete(0, tk.END)
-        for i, (x, y, color) in enumerate(self.selected_pixels):
-            self.selected_pixels_listbox.insert(tk.END, f"{i+1}: Position ({x},{y}), RGB: {color}")
+        count = len(self.selected_pixels)
+        # Only list the most recent selections; large regions can hold thousands of pixels
+        first = max(0, count - SELECTION_LIST_LIMIT)
+        if first > 0:
+            self.selected_pixels_listbox.insert(tk.END, f"... {first} earlier pixels ({count} selected)")
+        coords = self.selected_pixels.coords
+        colors = self.selected_pixels.colors
+        for i in range(first, count):
+            x, y = coords[i]
+            self.selected_pixels_listbox.insert(tk.END, f"{i+1}: Position ({x},{y}), RGB: {colors[i]}")
 
     def add_mineral(self):
-        if not self.selected_pixels:
+        if len(self.selected_pixels) == 0:
             messagebox.showinfo("No Selection", "Please select at least one pixel first.")
             return
             
@@ -622,21 +3721,18 @@ class MineralClassifier:
             messagebox.showinfo("Missing Name", "Please enter a mineral name.")
             return
             
-        # Get colors from selected pixels
-        colors = np.array([color for _, _, color in self.selected_pixels])
-        avg_color = np.mean(colors, axis=0).astype(int)
-        
         # Add to mineral colors dictionary
         self.mineral_colors[mineral_name] = {
-            'color': avg_color,
-            'samples': [(x, y, color.tolist()) for x, y, color in self.selected_pixels]
+            'color': self.selected_pixels.mean_color(),
+            'samples': self.selected_pixels.copy(),
+            'source': self.current_image_path,  # Image the samples were selected on
         }
         
         # Update the minerals display
         self.update_minerals_display()
         
         # Clear selection
-        self.selected_pixels = []
+        self.new_selection()
         self.update_selected_pixels_display()
         self.mineral_name_entry.delete(0, tk.END)
         
@@ -651,16 +3747,23 @@ class MineralClassifier:
             self.minerals_listbox.insert(tk.END, f"{name}: RGB: {color} (Samples: {samples_count})")
 
     def clear_selections(self):
-        self.selected_pixels = []
+        self.new_selection()
         self.update_selected_pixels_display()
         self.apply_zoom()  # Redisplay to clear markers
 
     def reset_results(self):
         """Clear classification results and reset the results frame"""
+        self.cancel_refinement()
+        
         # Clear results frame
         for widget in self.results_frame.winfo_children():
             widget.destroy()
             
+        # Cached results belong to the cleared classification
+        self.clear_suggestions()
+        self.overlay_labels = None
+        self.draw_overlay()
+            
         # Reset progress bar
         self.progress_bar["value"] = 0
         self.root.update_idletasks()
@@ -672,31 +3775,17 @@ class MineralClassifier:
         message_label.pack(expand=True, pady=20)
 
     def save_mineral_selections(self):
-        """Save the current mineral selections to a JSON file"""
+        """Save the current mineral selections to a .npz file"""
         if not self.mineral_colors or not self.output_folder:
             messagebox.showinfo("No Data", "No mineral selections to save or no output folder selected.")
             return
             
         try:
-            # Create a dictionary of mineral selections
-            selections_data = {
-                'image_path': self.current_image_path,
-                'minerals': {}
-            }
-            
-            for name, data in self.mineral_colors.items():
-                selections_data['minerals'][name] = {
-                    'color': data['color'].tolist(),
-                    'samples': data['samples']
-                }
-                
             # Generate filename based on the current image
-            base_filename = os.path.splitext(os.path.basename(self.current_image_path))[0]
-            output_file = os.path.join(self.output_folder, f"{base_filename}_selections.json")
+            base_filename = output_stem(self.current_image_path, self.folder_path)
+            output_file = os.path.join(self.output_folder, f"{base_filename}{SELECTIONS_SUFFIX}.npz")
             
-            # Save to JSON file
-            with open(output_file, 'w') as f:
-                json.dump(selections_data, f, indent=2)
+            save_selections(output_file, self.current_image_path, self.mineral_colors)
                 
             messagebox.showinfo("Save Successful", f"Mineral selections saved to:\n{output_file}")
             
@@ -704,34 +3793,21 @@ class MineralClassifier:
             messagebox.showerror("Save Error", f"Failed to save selections: {str(e)}")
 
     def load_mineral_selections(self, file_path=None):
-        """Load mineral selections from a JSON file"""
+        """Load mineral selections from a .npz file (or a .json file from earlier versions)"""
         try:
             # If no file path is provided, open a file dialog
             if file_path is None or not isinstance(file_path, str):
                 file_path = filedialog.askopenfilename(
                     title="Load Mineral Selections",
-                    filetypes=[("JSON Files", "*.json")],
+                    filetypes=[("Selection Files", "*.npz *.json"), ("NPZ Files", "*.npz"), ("JSON Files", "*.json")],
                     initialdir=self.output_folder if self.output_folder else "."
                 )
                 
             if not file_path:
                 return
                 
-            # Load from JSON file
-            with open(file_path, 'r') as f:
-                selections_data = json.load(f)
-                
-            # Clear current selections
-            self.mineral_colors = {}
-            
-            # Load minerals
-            for name, data in selections_data['minerals'].items():
-                samples = [(s[0], s[1], np.array(s[2])) for s in data['samples']]
-                
-                self.mineral_colors[name] = {
-                    'color': np.array(data['color']),
-                    'samples': samples
-                }
+            # Replaces the current selections
+            _, self.mineral_colors = load_selections(file_path)
                 
             # Update the minerals display
             self.update_minerals_display()
@@ -743,53 +3819,59 @@ class MineralClassifier:
 
     def train_classifier(self):
         """Train a classifier using the selected mineral samples based on the selected algorithm"""
-        # Collect all samples and their labels
-        X_samples = []
-        y_labels = []
-        
-        for idx, (name, data) in enumerate(self.mineral_colors.items()):
-            for x, y, color in data['samples']:
-                X_samples.append(color)
-                y_labels.append(idx)
+        if self.use_campaign_model_var.get():
+            return self.train_campaign_classifier()
         
-        # Convert to numpy arrays
-        X = np.array(X_samples)
-        y = np.array(y_labels)
+        # Minerals kept from other images take their features from the image they were selected on
+        stack_opener = make_group_opener(self.stack_members.values(),
+                                         os.path.join(self.output_folder, STACK_CACHE_FOLDER_NAME))
+        def open_image(path):
+            if path is None or path == self.current_image_path:
+                return self.current_image_array
+            return stack_opener(path)
         
-        # Normalize features for better performance
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
+        feature_set = self.get_feature_set()
+        X, y = mineral_training_features(self.mineral_colors, feature_set, self.current_image_array.shape[2],
+                                         open_image)
         
         # Create and train the classifier based on selection
         model_type = self.model_var.get()
-        
-        if model_type == "knn":
-            # K-Nearest Neighbors
-            classifier = KNeighborsClassifier(n_neighbors=min(3, len(X)))
-        elif model_type == "svm":
-            # Support Vector Machine
-            classifier = SVC(probability=True)
-        elif model_type == "rf":
-            # Random Forest
-            classifier = RandomForestClassifier(n_estimators=100)
-        elif model_type == "kmeans":
-            # K-Means
-            classifier = KMeans(n_clusters=len(self.mineral_colors))
-        else:
-            # Default to KNN
-            classifier = KNeighborsClassifier(n_neighbors=min(3, len(X)))
-        
-        # Train the classifier
-        classifier.fit(X_scaled, y)
+        classifier, scaler = train_model(X, y, model_type)
+        X_scaled = scaler.transform(X)
         
         # Save the classifier and scaler
         self.classifier = classifier
         self.scaler = scaler
+        self.mineral_names = list(self.mineral_colors)
         
         return X_scaled, y, classifier, scaler
 
+    def train_campaign_classifier(self):
+        """Use the (cached) model trained on the saved selections of all images in the results folder"""
+        # Selections of stacks are opened as the same PPL + XPL stack
+        open_image = make_group_opener(self.stack_members.values(),
+                                       os.path.join(self.output_folder, STACK_CACHE_FOLDER_NAME))
+        model = load_or_train_campaign_model(self.output_folder, self.model_var.get(), self.get_feature_set(),
+                                             n_channels=self.current_image_array.shape[2], open_image=open_image)
+        
+        self.classifier = model['classifier']
+        self.scaler = model['scaler']
+        self.mineral_names = model['mineral_names']
+        
+        return None, model['y'], self.classifier, self.scaler
+
+    def get_feature_set(self):
+        """Return the selected optional pixel features, in FEATURE_OPTIONS order"""
+        return tuple(name for name in FEATURE_OPTIONS if self.feature_vars[name].get())
+
     def classify_image(self):
-        if not self.mineral_colors:
+        self.cancel_refinement()
+        use_campaign_model = self.use_campaign_model_var.get()
+        if use_campaign_model and not self.output_folder:
+            messagebox.showinfo("No Folder", "Select a folder with saved selections to use the campaign model.")
+            return
+        
+        if not self.mineral_colors and not use_campaign_model:
             messagebox.showinfo("No Minerals", "Please define at least one mineral first.")
             return
         
@@ -804,188 +3886,78 @@ class MineralClassifier:
         self.progress_bar["value"] = 0
         self.root.update_idletasks()
         
-        # Train the classifier using the selected mineral samples
-        X_scaled, y, classifier, scaler = self.train_classifier()
-        
-        # Reshape the image array for processing
-        h, w, d = self.current_image_array.shape
-        pixels = self.current_image_array.reshape((h * w, d))
-        
-        # Create a mask for the carbon (special handling)
-        carbon_mask = self.detect_carbon(self.current_image_array)
-        
-        # Scale the pixels for the classifier
-        pixels_scaled = scaler.transform(pixels)
-        
-        # Create a classification result array and a distance/probability array
-        result = np.zeros(h * w, dtype=np.int32)
-        confidence = np.zeros(h * w, dtype=np.float32)
-        
-        # Process in batches to update progress bar
-        batch_size = 10000
-        num_batches = max(1, (h * w) // batch_size)
-        
-        # Get the distance threshold for "Other" category
-        other_threshold = self.other_threshold_var.get()
-        
-        # Classification approach depends on the model
-        model_type = self.model_var.get()
+        # Optional stage timing / memory instrumentation
+        use_cprofile = self.cprofile_var.get()
+        profiler = RunProfiler(enabled=self.profile_run_var.get() or use_cprofile, use_cprofile=use_cprofile)
+        profiler.start()
         
-        for i in range(num_batches):
-            start_idx = i * batch_size
-            end_idx = min((i + 1) * batch_size, h * w)
-            
-            # Skip pixels that are already classified as carbon
-            if np.any(carbon_mask.reshape(h * w)[start_idx:end_idx]):
-                carbon_indices = np.where(carbon_mask.reshape(h * w)[start_idx:end_idx])[0] + start_idx
-                result[carbon_indices] = len(self.mineral_colors)  # Carbon class is after all minerals
-                confidence[carbon_indices] = 1.0  # High confidence for carbon
-            
-            # Get non-carbon pixels in this batch
-            non_carbon_indices = np.where(~carbon_mask.reshape(h * w)[start_idx:end_idx])[0] + start_idx
-            
-            if len(non_carbon_indices) > 0:
-                # Classify non-carbon pixels based on model type
-                batch_pixels = pixels_scaled[non_carbon_indices]
-                
-                if model_type == "knn":
-                    # KNN: Use distances to determine confidence
-                    dists, indices = classifier.kneighbors(batch_pixels)
-                    predictions = classifier.predict(batch_pixels)
-                    
-                    # Store distances (lower is better)
-                    mean_dists = dists.mean(axis=1)
-                    # Convert distance to confidence (inverse relationship)
-                    conf = np.exp(-mean_dists / 50)  # Exponential decay of confidence with distance
-                    confidence[non_carbon_indices] = conf
-                    
-                    # Assign minerals to pixels within the distance threshold
-                    within_threshold = mean_dists < other_threshold
-                    result[non_carbon_indices[within_threshold]] = predictions[within_threshold]
-                    
-                    # Assign "Other" category to pixels beyond the threshold
-                    result[non_carbon_indices[~within_threshold]] = len(self.mineral_colors) + 1  # "Other" class
-                    confidence[non_carbon_indices[~within_threshold]] = 0.1  # Low confidence for "Other"
-                    
-                elif model_type == "kmeans":
-                    # K-Means: Use distance to cluster centers
-                    predictions = classifier.predict(batch_pixels)
-                    distances = np.min(classifier.transform(batch_pixels), axis=1)
-                    
-                    # Convert distance to confidence
-                    conf = np.exp(-distances / 50)
-                    confidence[non_carbon_indices] = conf
-                    
-                    # Assign clusters to pixels within the distance threshold
-                    within_threshold = distances < other_threshold
-                    result[non_carbon_indices[within_threshold]] = predictions[within_threshold]
-                    
-                    # Assign "Other" category to pixels beyond the threshold
-                    result[non_carbon_indices[~within_threshold]] = len(self.mineral_colors) + 1
-                    confidence[non_carbon_indices[~within_threshold]] = 0.1
-                    
-                else:  # SVM and Random Forest
-                    # Use probability estimates for confidence
-                    predictions = classifier.predict(batch_pixels)
-                    proba = classifier.predict_proba(batch_pixels)
-                    
-                    # Get highest probability for each prediction
-                    max_proba = np.max(proba, axis=1)
-                    confidence[non_carbon_indices] = max_proba
-                    
-                    # Assign minerals to pixels with sufficient confidence
-                    within_threshold = max_proba > (1.0 - other_threshold/200)  # Convert distance to probability threshold
-                    result[non_carbon_indices[within_threshold]] = predictions[within_threshold]
-                    
-                    # Assign "Other" category to low confidence pixels
-                    result[non_carbon_indices[~within_threshold]] = len(self.mineral_colors) + 1
-                    confidence[non_carbon_indices[~within_threshold]] = 0.1
-            
-            # Update progress bar
-            self.progress_bar["value"] = (i + 1) / num_batches * 100
-            self.root.update_idletasks()
-        
-        # Reshape back to image shape
-        result_image = result.reshape((h, w))
-        confidence_image = confidence.reshape((h, w))
-        
-        # Calculate percentages and confidence intervals
-        total_pixels = h * w
-        percentages = {}
-        pixel_counts = {}
-        confidence_intervals = {}
-        
-        # Helper function to calculate confidence interval
-        def confidence_interval(proportion, n, confidence=0.95):
-            """Calculate binomial proportion confidence interval"""
-            if n == 0 or proportion == 0:
-                return 0, 0
+        # The profiler must stop even if the run fails; a background refinement
+        # takes it over and stops it itself
+        refining = False
+        try:
+            # Train the classifier using the selected mineral samples
+            try:
+                with profiler.stage("train"):
+                    X_scaled, y, classifier, scaler = self.train_classifier()
+            except ValueError as e:
+                messagebox.showerror("Training Error", str(e))
+                return
             
-            z = stats.norm.ppf(1 - (1 - confidence) / 2)
-            interval = z * np.sqrt((proportion * (1 - proportion)) / n)
-            return max(0, proportion - interval), min(1, proportion + interval)
-        
-        # Add mineral percentages
-        for idx, (name, _) in enumerate(self.mineral_colors.items()):
-            mineral_pixels = np.sum(result_image == idx)
-            mineral_proportion = mineral_pixels / total_pixels
-            percentages[name] = mineral_proportion * 100
-            pixel_counts[name] = mineral_pixels
+            # Image size for reshaping the flat results
+            h, w, d = self.current_image_array.shape
+            n_minerals = len(self.mineral_names)
             
-            # Calculate confidence interval (95%)
-            lower_ci, upper_ci = confidence_interval(mineral_proportion, total_pixels)
-            confidence_intervals[name] = (lower_ci * 100, upper_ci * 100)
-        
-        # Add carbon percentage if detected
-        carbon_count = np.sum(carbon_mask)
-        if carbon_count > 0:
-            carbon_proportion = carbon_count / total_pixels
-            percentages["Carbon (Graphite)"] = carbon_proportion * 100
-            pixel_counts["Carbon (Graphite)"] = carbon_count
+            # Classification approach depends on the model
+            model_type = self.model_var.get()
+            feature_set = self.get_feature_set()
+            settings = self.get_classification_settings()
+            profiler.metadata.update({
+                'image_path': self.current_image_path,
+                'width': w,
+                'height': h,
+                'channels': d,
+                'model': model_type,
+                'feature_set': list(feature_set),
+                'postprocess': settings['postprocess'],
+                'n_minerals': n_minerals,
+                'n_samples': len(y),
+                'campaign_model': use_campaign_model,
+            })
             
-            lower_ci, upper_ci = confidence_interval(carbon_proportion, total_pixels)
-            confidence_intervals["Carbon (Graphite)"] = (lower_ci * 100, upper_ci * 100)
-        
-        # Add "Other" category percentage
-        other_count = np.sum(result_image == len(self.mineral_colors) + 1)
-        if other_count > 0:
-            other_proportion = other_count / total_pixels
-            percentages["Other"] = other_proportion * 100
-            pixel_counts["Other"] = other_count
+            model = {
+                'classifier': classifier,
+                'scaler': scaler,
+                'model_type': model_type,
+                'feature_set': feature_set,
+                'mineral_names': self.mineral_names,
+            }
+            if self.preview_var.get():
+                # Quick look at a strided copy, then refine full resolution in the background
+                preview = classify_preview(self.current_image_array, model, settings, profiler=profiler)
+                _, results_text = self.show_results(preview, settings,
+                                                    heading=f"Preview (every {preview['stride']}th row and column), "
+                                                            f"refining full resolution...")
+                self.start_refinement(model, preview, settings, profiler, results_text)
+                refining = True
+                return
             
-            lower_ci, upper_ci = confidence_interval(other_proportion, total_pixels)
-            confidence_intervals["Other"] = (lower_ci * 100, upper_ci * 100)
-        
-        # Display results
-        fig = plt.Figure(figsize=(10, 6))
-        
-        # Create a colorful visualization of the classification
-        ax1 = fig.add_subplot(121)
-        max_category = len(percentages)
-        cmap = plt.cm.get_cmap('tab10', max_category)
-        classification_img = ax1.imshow(result_image, cmap=cmap, vmin=0, vmax=max_category-1)
-        ax1.set_title('Classification')
-        ax1.axis('off')
-        
-        # Add color bar
-        cbar = fig.colorbar(classification_img, ax=ax1, ticks=range(max_category))
-        cbar.set_ticklabels(list(percentages.keys()))
-        
-        # Create a pie chart of percentages with error bars
-        ax2 = fig.add_subplot(122)
-        wedges, texts, autotexts = ax2.pie(
-            percentages.values(), 
-            labels=percentages.keys(), 
-            autopct='%1.1f%%',
-            textprops={'fontsize': 9}
-        )
-        ax2.set_title('Mineral Percentages')
-        ax2.axis('equal')
+            outcome = classify_loaded_image(self.current_image_array, model, settings,
+                                            progress_callback=self.update_progress, profiler=profiler)
+            self.finish_classification(outcome, settings, profiler)
+        finally:
+            if not refining:
+                profiler.stop()
+
+    def show_results(self, outcome, settings, heading=None):
+        """Show the results figure and the percentages of an outcome; returns (figure, text widget)"""
+        percentages = outcome['percentages']
+        pixel_counts = outcome['pixel_counts']
+        confidence_intervals = outcome['confidence_intervals']
         
-        # Adjust layout
-        fig.tight_layout()
+        fig = create_results_figure(outcome['result_image'], percentages)
         
         # Display the figure in the results frame
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
         canvas = FigureCanvasTkAgg(fig, master=self.results_frame)
         canvas.draw()
         canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
@@ -994,105 +3966,352 @@ class MineralClassifier:
         results_text = tk.Text(self.results_frame, height=10, width=50)
         results_text.pack(fill=tk.X, pady=5, padx=5)
         
-        results_text.insert(tk.END, "Results with 95% Confidence Intervals:\n")
+        if heading:
+            results_text.insert(tk.END, f"{heading}\n")
+        ci_label = "block bootstrap" if settings['ci_method'] == "bootstrap" else "binomial"
+        results_text.insert(tk.END, f"Results with 95% Confidence Intervals ({ci_label}):\n")
+        # Color swatches match the canvas overlay
+        class_names = list(self.mineral_names) + ["Carbon (Graphite)", "Other"]
+        palette = class_palette(len(self.mineral_names))
         for name, percentage in percentages.items():
             lower, upper = confidence_intervals[name]
             pixel_count = pixel_counts[name]
+            r, g, b = palette[class_names.index(name), :3]
+            results_text.tag_configure(f"swatch_{name}", foreground=f"#{r:02x}{g:02x}{b:02x}")
+            results_text.insert(tk.END, "\u25a0 ", f"swatch_{name}")
             results_text.insert(tk.END, f"{name}: {percentage:.2f}% ({lower:.2f}% - {upper:.2f}%), Pixels: {pixel_count}\n")
         
+        # Show the labels over the image
+        self.overlay_labels = outcome['result_image']
+        self.overlay_stride = outcome.get('stride', 1)
+        self.draw_overlay()
+        
+        return fig, results_text
+
+    def finish_classification(self, outcome, settings, profiler, heading=None):
+        """Show, cache and save the full-resolution results of a classification run"""
+        result_image = outcome['result_image']
+        confidence_image = outcome['confidence_image']
+        
+        # Cache the results for sample suggestions
+        self.suggester = SampleSuggester(result_image, confidence_image, other_class=len(self.mineral_names) + 1)
+        
+        # Display results
+        with profiler.stage("display"):
+            fig, results_text = self.show_results(outcome, settings, heading)
+        
         # Save results if the checkbox is checked
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        if self.save_results_var.get() and self.output_folder:
+            with profiler.stage("save"):
+                self.save_classification_results(fig, result_image, confidence_image, outcome['percentages'],
+                                                 outcome['pixel_counts'], outcome['confidence_intervals'],
+                                                 timestamp=timestamp, show_message=False)
+        
+        profiler.stop()
+        if profiler.enabled:
+            results_text.insert(tk.END, "\nStage timings:\n")
+            for line in profiler.summary():
+                results_text.insert(tk.END, f"{line}\n")
+            if self.output_folder:
+                # Profile report next to the CSV outputs
+                base_filename = output_stem(self.current_image_path, self.folder_path)
+                profiler.write_report(os.path.join(self.output_folder, f"{base_filename}_profile_{timestamp}"))
+        
         if self.save_results_var.get() and self.output_folder:
-            self.save_classification_results(fig, result_image, confidence_image, percentages, pixel_counts, confidence_intervals)
+            messagebox.showinfo("Results Saved", f"Classification results saved to:\n{self.output_folder}")
+
+    def start_refinement(self, model, preview, settings, profiler, results_text):
+        """
+        Refine a preview to full resolution in a background thread.
+        Every run keeps its progress, outcome and error in its own dict, so a
+        cancelled run finishing late cannot touch the results of a newer one.
+        """
+        image = self.current_image_array
+        refine_run = {
+            'stop': threading.Event(),
+            'profiler': profiler,
+            'progress': 0.0,
+            'outcome': None,
+            'error': None,
+        }
+        
+        def progress(fraction):
+            refine_run['progress'] = fraction
+        
+        def run():
+            try:
+                refine_run['outcome'] = refine_classification(image, model, preview, settings,
+                                                              progress_callback=progress,
+                                                              stop_event=refine_run['stop'], profiler=profiler)
+            except Exception as e:
+                refine_run['error'] = e
+        
+        refine_run['thread'] = threading.Thread(target=run, name="refine", daemon=True)
+        self.refine_run = refine_run
+        refine_run['thread'].start()
+        self.poll_refinement(settings, refine_run, results_text)
+
+    def poll_refinement(self, settings, refine_run, results_text):
+        """Follow the background refinement and replace the preview once it is done"""
+        if refine_run['stop'].is_set():
+            # Cancelled by a new classification, another image or Reset Results
+            return
+        
+        self.progress_bar["value"] = refine_run['progress'] * 100
+        if refine_run['thread'].is_alive():
+            self.root.after(200, self.poll_refinement, settings, refine_run, results_text)
+            return
+        
+        self.refine_run = None
+        if refine_run['error'] is not None:
+            refine_run['profiler'].stop()
+            self.progress_bar["value"] = 0
+            # The preview stays, without the promise of a refined result
+            results_text.delete("1.0", "1.end")
+            results_text.insert("1.0", "Preview (full-resolution refinement failed)")
+            messagebox.showerror("Refinement Error", f"Full-resolution refinement failed: {refine_run['error']}")
+            return
+        outcome = refine_run['outcome']
+        if outcome is None:
+            return
+        
+        self.reset_results()
+        self.finish_classification(outcome, settings, refine_run['profiler'],
+                                   heading=f"Refined: {outcome['refined_fraction'] * 100:.1f}% of pixels "
+                                           f"re-evaluated at full resolution")
 
-    def save_classification_results(self, fig, result_image, confidence_image, percentages, pixel_counts, confidence_intervals):
+    def cancel_refinement(self):
+        """Stop a running background refinement"""
+        if self.refine_run is None:
+            return
+        self.refine_run['stop'].set()
+        self.refine_run['profiler'].stop()
+        self.refine_run = None
+
+    def update_progress(self, fraction):
+        """Update the progress bar with a completed fraction (0-1)"""
+        self.progress_bar["value"] = fraction * 100
+        self.root.update_idletasks()
+
+    def save_classification_results(self, fig, result_image, confidence_image, percentages, pixel_counts,
+                                    confidence_intervals, timestamp=None, show_message=True):
         """Save classification results to output folder"""
         if not self.output_folder:
             return
             
-        # Get the base filename without extension
-        base_filename = os.path.splitext(os.path.basename(self.current_image_path))[0]
+        # Named by the path below the image folder
+        base_filename = output_stem(self.current_image_path, self.folder_path)
         
-        # Create a timestamp
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        save_classification_files(self.output_folder, base_filename, fig, result_image, confidence_image,
+                                  percentages, pixel_counts, confidence_intervals, timestamp=timestamp)
         
-        # Save the classification figure
-        fig_filename = os.path.join(self.output_folder, f"{base_filename}_classification_{timestamp}.png")
-        fig.savefig(fig_filename, dpi=300)
-        
-        # Save the classification data as CSV with confidence intervals
-        data_filename = os.path.join(self.output_folder, f"{base_filename}_data_{timestamp}.csv")
-        with open(data_filename, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["Mineral", "Percentage", "Lower_CI", "Upper_CI", "Pixel_Count"])
-            for name, percentage in percentages.items():
-                lower, upper = confidence_intervals[name]
-                pixel_count = pixel_counts[name]
-                writer.writerow([name, percentage, lower, upper, pixel_count])
-        
-        # Save the classification image as a separate file (without legend)
-        # Create a new figure for just the classified image without legend
-        plt.figure(figsize=(10, 10))
-        plt.imshow(result_image, cmap=plt.cm.get_cmap('tab10', len(percentages)))
-        plt.axis('off')
-        
-        # Save the image
-        img_filename = os.path.join(self.output_folder, f"{base_filename}_classified_{timestamp}.png")
-        plt.savefig(img_filename, dpi=300, bbox_inches='tight')
-        plt.close()
-        
-        # Save as TIFF file without legend
-        tiff_filename = os.path.join(self.output_folder, f"{base_filename}_classified_{timestamp}.tiff")
-        tifffile.imwrite(tiff_filename, result_image.astype(np.uint8))
-        
-        # Save confidence map as an additional visualization
-        plt.figure(figsize=(10, 10))
-        plt.imshow(confidence_image, cmap='viridis', vmin=0, vmax=1)
-        plt.colorbar(label='Confidence')
-        plt.title('Classification Confidence')
-        plt.axis('off')
-        
-        # Save the confidence map
-        conf_filename = os.path.join(self.output_folder, f"{base_filename}_confidence_{timestamp}.png")
-        plt.savefig(conf_filename, dpi=300, bbox_inches='tight')
-        plt.close()
-        
-        messagebox.showinfo("Results Saved", f"Classification results saved to:\n{self.output_folder}")
-
-    def detect_carbon(self, image):
-        """
-        Detect carbon (graphite) in the image using PIL and scikit-image.
-        Carbon appears as diffuse black areas.
-        """
-        # Convert to grayscale using PIL
-        pil_image = Image.fromarray(image)
-        gray_image = ImageOps.grayscale(pil_image)
-        gray = np.array(gray_image)
-        
-        # Threshold for dark areas
-        threshold = self.carbon_threshold_var.get()
-        min_blob_size = self.carbon_blob_size_var.get()
+        if show_message:
+            messagebox.showinfo("Results Saved", f"Classification results saved to:\n{self.output_folder}")
+
+    def get_classification_settings(self):
+        """Carbon detection, 'Other' threshold and post-processing settings from the GUI (see DEFAULT_SETTINGS)"""
+        return {
+            'carbon_threshold': self.carbon_threshold_var.get(),
+            'min_blob_size': self.carbon_blob_size_var.get(),
+            'other_threshold': self.other_threshold_var.get(),
+            'postprocess': self.postprocess_var.get(),
+            'majority_size': self.majority_size_var.get(),
+            'n_segments': self.superpixel_count_var.get(),
+            'ci_method': self.ci_method_var.get(),
+            'bootstrap_tile_size': self.bootstrap_tile_var.get(),
+        }
+
+    def classify_all_images(self):
+        """Classify every image of the folder in the background with the current model and settings"""
+        if self.batch_thread is not None:
+            # Button acts as "Stop Batch" while a run is active
+            self.batch_stop.set()
+            return
         
-        # Binary threshold
-        binary = gray < threshold
+        if not self.images_paths or not self.output_folder:
+            messagebox.showinfo("No Images", "Please select a folder with images first.")
+            return
         
-        # Label connected regions
-        labeled_array, num_features = ndimage.label(binary)
+        use_campaign_model = self.use_campaign_model_var.get()
+        if not self.mineral_colors and not use_campaign_model:
+            messagebox.showinfo("No Minerals", "Please define at least one mineral first.")
+            return
         
-        # Analyze regions and filter by size
-        carbon_mask = np.zeros_like(binary, dtype=bool)
+        # Train once (in the GUI thread), then reuse the model for every image
+        try:
+            _, _, classifier, scaler = self.train_classifier()
+        except ValueError as e:
+            messagebox.showerror("Training Error", str(e))
+            return
+        model = {
+            'classifier': classifier,
+            'scaler': scaler,
+            'model_type': self.model_var.get(),
+            'feature_set': self.get_feature_set(),
+            'mineral_names': list(self.mineral_names),
+        }
         
-        # Calculate sizes of labeled regions
-        sizes = ndimage.sum(binary, labeled_array, range(1, num_features + 1))
+        # Images of the folder, including those a running scan has not found yet;
+        # Tk variables must not be read from the worker threads
+        path_groups = self.iter_batch_groups()
+        settings = self.get_classification_settings()
+        stack_cache_dir = os.path.join(self.output_folder, STACK_CACHE_FOLDER_NAME)
+        self.batch_progress = (0, len(self.images_paths))
+        self.batch_results = None
+        self.batch_stop = threading.Event()
+        
+        def progress(done, total):
+            # The total is only known once the scan has finished
+            self.batch_progress = (done, total if total is not None else len(self.images_paths))
+        
+        def run():
+            self.batch_results = classify_folder(path_groups, self.output_folder, model, settings,
+                                                 stack_cache_dir=stack_cache_dir, progress_callback=progress,
+                                                 stop_event=self.batch_stop, folder_path=self.folder_path)
+        
+        self.batch_thread = threading.Thread(target=run, name="batch-run", daemon=True)
+        self.batch_thread.start()
+        self.classify_folder_btn.config(text="Stop Batch")
+        self.poll_batch()
+
+    def iter_batch_groups(self):
+        """
+        Yield the path groups of the current folder for a batch run (in the batch
+        reader thread), waiting for the folder scan while it is still running.
+        Stops early if another folder or grouping replaces the image list.
+        """
+        images_paths = self.images_paths
+        index = 0
+        while True:
+            # Read before the length, so paths appended by the last scan batch are not missed
+            scanning = self.image_scanner is not None and self.images_paths is images_paths
+            if index < len(images_paths):
+                path = images_paths[index]
+                index += 1
+                yield self.stack_members.get(path, [path])
+            elif scanning:
+                time.sleep(0.1)
+            else:
+                return
+
+    def poll_batch(self):
+        """Update the progress bar from the batch thread and report when it has finished"""
+        done, total = self.batch_progress
+        self.progress_bar["value"] = 100 * done / total if total else 0
         
-        # Filter regions by size
-        for i, size in enumerate(sizes):
-            if size < min_blob_size:
-                carbon_mask[labeled_array == i + 1] = True
+        if self.batch_thread.is_alive():
+            self.root.after(200, self.poll_batch)
+            return
         
-        return carbon_mask
+        self.batch_thread = None
+        self.classify_folder_btn.config(text="Classify Folder")
+        results = self.batch_results or []
+        failed = [record for record in results if record.get('error')]
+        message = f"Classified {len(results) - len(failed)} of {total} images.\nResults saved to:\n{self.output_folder}"
+        if failed:
+            message += "\n\nFailed:\n" + "\n".join(
+                f"{os.path.basename(record['image_path'])}: {record['error']}" for record in failed[:10])
+        messagebox.showinfo("Batch Finished", message)
 
 
-if __name__ == "__main__":
+def run_batch(args):
+    """Classify every image of args.batch with the campaign model of its results folder (command line)"""
+    folder_path = args.batch
+    output_folder = os.path.join(folder_path, RESULTS_FOLDER_NAME)
+    stack_cache_dir = os.path.join(output_folder, STACK_CACHE_FOLDER_NAME)
+    # Paths are streamed into the pipeline while the folder is scanned
+    paths = iter_image_paths(folder_path)
+    path_groups = group_image_stacks(paths) if args.stack else ([path] for path in paths)
+    
+    # Selections of stacks are opened as the same stack
+    open_image = make_group_opener((), stack_cache_dir, find_stacks=args.stack)
+    feature_set = tuple(name for name in FEATURE_OPTIONS if name in args.features)
+    
+    def train(image):
+        # Train on samples with the channel count of the first image read
+        return load_or_train_campaign_model(output_folder, args.model, feature_set, n_channels=image.shape[2],
+                                            open_image=open_image)
+    
+    settings = {
+        'carbon_threshold': args.carbon_threshold,
+        'min_blob_size': args.min_blob_size,
+        'other_threshold': args.other_threshold,
+        'postprocess': args.postprocess,
+        'majority_size': args.majority_size,
+        'n_segments': args.superpixels,
+        'ci_method': args.ci_method,
+        'bootstrap_tile_size': args.bootstrap_tile_size,
+    }
+    
+    def progress(done, total):
+        print(f"\r{done}/{total or '?'} images", end="", file=sys.stderr, flush=True)
+    
+    start = time.perf_counter()
+    try:
+        results = classify_folder(path_groups, output_folder, train, settings, n_workers=args.workers,
+                                  n_writers=args.writers, stack_cache_dir=stack_cache_dir,
+                                  progress_callback=progress, folder_path=folder_path)
+    except ValueError as e:
+        # No (usable) saved selections to train on
+        print(f"\n{e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+    if not results:
+        print(f"No images found in {folder_path}", file=sys.stderr)
+        return 1
+    
+    failed = [record for record in results if record.get('error')]
+    print(f"\nClassified {len(results) - len(failed)} of {len(results)} images in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.2f} images/s); results in {output_folder}", file=sys.stderr)
+    for record in failed:
+        print(f"{record['image_path']}: {record['error']}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mineral thin section classifier. "
+                                                 "Starts the GUI unless --batch is given.")
+    parser.add_argument("--batch", metavar="FOLDER",
+                        help="classify every image in FOLDER with the campaign model trained on the selections "
+                             f"saved in FOLDER/{RESULTS_FOLDER_NAME}, then exit")
+    parser.add_argument("--model", choices=("knn", "svm", "rf", "kmeans"), default="knn")
+    parser.add_argument("--features", nargs="*", choices=FEATURE_OPTIONS, default=[],
+                        help="optional pixel features to enable")
+    parser.add_argument("--stack", action="store_true", help="classify PPL + XPL image pairs as stacks")
+    parser.add_argument("--carbon-threshold", type=int, default=DEFAULT_SETTINGS['carbon_threshold'])
+    parser.add_argument("--min-blob-size", type=int, default=DEFAULT_SETTINGS['min_blob_size'])
+    parser.add_argument("--other-threshold", type=float, default=DEFAULT_SETTINGS['other_threshold'])
+    parser.add_argument("--postprocess", choices=("none", "majority", "superpixels"),
+                        default=DEFAULT_SETTINGS['postprocess'])
+    parser.add_argument("--majority-size", type=int, default=DEFAULT_SETTINGS['majority_size'])
+    parser.add_argument("--superpixels", type=int, default=DEFAULT_SETTINGS['n_segments'])
+    parser.add_argument("--ci-method", choices=("binomial", "bootstrap"), default=DEFAULT_SETTINGS['ci_method'],
+                        help="confidence intervals of the percentages")
+    parser.add_argument("--bootstrap-tile-size", type=int, default=DEFAULT_SETTINGS['bootstrap_tile_size'],
+                        help="tile size in pixels for --ci-method bootstrap")
+    parser.add_argument("--serve", metavar="FOLDER",
+                        help="run a local HTTP classification service for the selection sets saved in "
+                             f"FOLDER/{RESULTS_FOLDER_NAME}")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the HTTP service")
+    parser.add_argument("--port", type=int, default=8765, help="port of the HTTP service")
+    parser.add_argument("--max-models", type=int, default=8, help="trained models kept in memory by the service")
+    parser.add_argument("--workers", type=int, default=2, help="classification threads")
+    parser.add_argument("--writers", type=int, default=2, help="threads rendering and saving results")
+    args = parser.parse_args(argv)
+    
+    if args.batch:
+        return run_batch(args)
+    if args.serve:
+        serve(args.serve, args.host, args.port, n_workers=args.workers, max_models=args.max_models,
+              stack=args.stack)
+        return 0
+    
     root = tk.Tk()
-    app = MineralClassifier(root)
-    root.mainloop()
\ No newline at end of file
+    MineralClassifier(root)
+    root.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
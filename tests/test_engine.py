@@ -0,0 +1,185 @@
+"""
+Tests of the headless classification engine (no display needed).
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import mineral_classifier_Version6 as mc  # noqa: E402
+
+
+def random_dark_image(h, w, dark_fraction, seed, dtype=np.uint8):
+    """RGB image whose dark pixels (below the default carbon threshold) form random blobs"""
+    rng = np.random.default_rng(seed)
+    dark = rng.random((h, w)) < dark_fraction
+    image = np.where(dark[..., None], 5, 200).repeat(3, axis=2).astype(np.uint8)
+    if dtype == np.uint16:
+        image = image.astype(np.uint16) * 257
+    return image
+
+
+@pytest.mark.parametrize("band_rows", [1, 2, 7, 64, 1000])
+@pytest.mark.parametrize("min_blob_size", [1, 5, 50, 400])
+def test_streaming_carbon_mask_matches_in_memory(band_rows, min_blob_size):
+    for seed, (h, w, dark_fraction) in enumerate([(97, 131, 0.3), (200, 50, 0.55), (1, 300, 0.5), (150, 1, 0.6)]):
+        image = random_dark_image(h, w, dark_fraction, seed)
+        expected = mc.detect_carbon_mask(image, 30, min_blob_size)
+        streamed = mc.detect_carbon_mask_streaming(image, 30, min_blob_size, band_rows=band_rows)
+        assert streamed.dtype == bool
+        np.testing.assert_array_equal(streamed, expected)
+
+
+def test_streaming_carbon_mask_joins_blobs_across_many_bands(tmp_path):
+    # A one-pixel wide serpentine crosses every band boundary and is larger than min_blob_size
+    image = np.full((40, 9, 3), 200, dtype=np.uint8)
+    image[:, 0] = 5
+    image[:, 8] = 5
+    image[0, :] = 5
+    small = np.zeros((40, 9), dtype=bool)
+    image[20:22, 4] = 5  # Small blob spanning one band boundary
+    small[20:22, 4] = True
+    out = np.lib.format.open_memmap(str(tmp_path / "mask.npy"), mode='w+', dtype=bool, shape=(40, 9))
+    mask = mc.detect_carbon_mask_streaming(image, 30, 10, band_rows=1, work_dir=str(tmp_path), out=out)
+    assert mask is out
+    np.testing.assert_array_equal(mask, small)
+    np.testing.assert_array_equal(mask, mc.detect_carbon_mask(image, 30, 10))
+
+
+def test_streaming_carbon_mask_16_bit():
+    image = random_dark_image(120, 80, 0.4, seed=3, dtype=np.uint16)
+    np.testing.assert_array_equal(mc.detect_carbon_mask_streaming(image, 30, 20, band_rows=16),
+                                  mc.detect_carbon_mask(image, 30, 20))
+
+
+def test_detect_carbon_mask_streams_large_images(monkeypatch):
+    image = random_dark_image(64, 64, 0.45, seed=4)
+    expected = mc.detect_carbon_mask(image, 30, 25)
+    monkeypatch.setattr(mc, "CARBON_STREAMING_PIXELS", 100)
+    monkeypatch.setattr(mc, "CARBON_BAND_ROWS", 5)
+    np.testing.assert_array_equal(mc.detect_carbon_mask(image, 30, 25), expected)
+
+
+@pytest.mark.parametrize("feature_set", [(), ('hsv', 'lab'), ('texture',), ('gradient',), mc.FEATURE_OPTIONS])
+@pytest.mark.parametrize("chunk_rows", [1, 3, 7, 100])
+def test_chunked_features_match_whole_image(feature_set, chunk_rows):
+    rng = np.random.default_rng(5)
+    image = rng.integers(0, 256, size=(23, 17, 3), dtype=np.uint8)
+    expected = mc.compute_features(image, feature_set)
+    
+    chunks = list(mc.iter_feature_chunks(image, feature_set, chunk_rows=chunk_rows))
+    assert [(start, end) for start, end, _ in chunks] == [(s, min(s + chunk_rows, 23)) for s in range(0, 23, chunk_rows)]
+    features = np.concatenate([f for _, _, f in chunks]).reshape(expected.shape)
+    np.testing.assert_allclose(features, expected, rtol=1e-5, atol=1e-4)
+    
+    # Samples on and next to the chunk boundaries
+    ys = np.array([0, chunk_rows - 1, chunk_rows, 11, 22, 22]) % 23
+    xs = np.array([0, 16, 3, 8, 0, 16])
+    np.testing.assert_allclose(mc.sample_features(image, xs, ys, feature_set, chunk_rows=chunk_rows),
+                               expected[ys, xs], rtol=1e-5, atol=1e-4)
+
+
+def patchy_label_map(h, w, seed):
+    """Label map of 8 x 8 blocks of classes 0-2 with a few "Other" pixels (class 4)"""
+    rng = np.random.default_rng(seed)
+    labels = np.kron(rng.integers(0, 3, size=(-(-h // 8), -(-w // 8))), np.ones((8, 8), dtype=np.int64))[:h, :w]
+    labels[rng.random((h, w)) < 0.01] = 4
+    return labels.astype(np.uint8)
+
+
+def test_bootstrap_intervals_bracket_the_percentages():
+    labels = patchy_label_map(200, 150, seed=6)
+    names = ['quartz', 'feldspar', 'biotite']
+    percentages, counts, intervals = mc.compute_statistics(labels, names, ci_method="bootstrap", tile_size=16)
+    binomial = mc.compute_statistics(labels, names)
+    assert percentages == binomial[0] and counts == binomial[1]
+    assert set(intervals) == set(names) | {"Other"}
+    for name, (lower, upper) in intervals.items():
+        assert 0 <= lower <= percentages[name] <= upper <= 100
+    for name in names:
+        # The blocks are spatially correlated, so tiles vary more than independent pixels
+        lower, upper = intervals[name]
+        binomial_lower, binomial_upper = binomial[2][name]
+        assert upper - lower > binomial_upper - binomial_lower
+    
+    # Deterministic for a given seed
+    assert mc.compute_statistics(labels, names, ci_method="bootstrap", tile_size=16)[2] == intervals
+
+
+def test_bootstrap_intervals_of_a_single_class_map_are_exact():
+    labels = np.zeros((64, 64), dtype=np.uint8)
+    _, _, intervals = mc.compute_statistics(labels, ['quartz', 'feldspar'], ci_method="bootstrap", tile_size=16)
+    assert intervals == {'quartz': (100.0, 100.0), 'feldspar': (0.0, 0.0)}
+    
+    lower, upper = mc.block_bootstrap_intervals(np.zeros((3, 3, 4)))
+    np.testing.assert_array_equal(lower, np.zeros(4))
+    np.testing.assert_array_equal(upper, np.zeros(4))
+
+
+def test_bootstrap_merges_tiles_beyond_max_blocks():
+    labels = patchy_label_map(128, 96, seed=7)
+    small_tiles = mc.tile_class_histograms(labels, 5, tile_size=8)  # 16 x 12 tiles
+    large_tiles = mc.tile_class_histograms(labels, 5, tile_size=16)  # 8 x 6 tiles
+    np.testing.assert_array_equal(small_tiles.sum(axis=(0, 1)), np.bincount(labels.ravel(), minlength=5))
+    # 192 tiles with at most 48 blocks are merged 2 x 2
+    merged = mc.block_bootstrap_intervals(small_tiles, n_replicates=200, max_blocks=48)
+    expected = mc.block_bootstrap_intervals(large_tiles, n_replicates=200)
+    np.testing.assert_allclose(merged, expected)
+
+
+def reference_majority_filter(labels, size, classes, fixed_mask):
+    """Pixel-by-pixel majority vote with edge replication, ties keeping the original label"""
+    pad = size // 2
+    padded = np.pad(labels, ((pad, size - 1 - pad), (pad, size - 1 - pad)), mode='edge')
+    result = labels.copy()
+    for y in range(labels.shape[0]):
+        for x in range(labels.shape[1]):
+            window = padded[y:y + size, x:x + size].ravel()
+            votes = {c: int(np.sum(window == c)) for c in classes}
+            best = max(votes.values())
+            if votes.get(labels[y, x], 0) < best and not fixed_mask[y, x]:
+                result[y, x] = min(c for c, count in votes.items() if count == best)
+    return result
+
+
+def test_majority_filter_removes_isolated_pixels():
+    labels = np.zeros((9, 9), dtype=np.uint8)
+    labels[4, 4] = 1
+    labels[0, 0] = 2
+    labels[:, 6:] = 3  # A straight grain boundary survives
+    expected = np.zeros_like(labels)
+    expected[:, 6:] = 3
+    np.testing.assert_array_equal(mc.majority_filter(labels, size=3), expected)
+
+
+@pytest.mark.parametrize("size", [3, 5])
+def test_majority_filter_matches_reference(size):
+    rng = np.random.default_rng(size)
+    # Classes 0-2 are minerals, 3 is carbon (fixed, no vote) and 4 is "Other"
+    labels = rng.choice(5, size=(25, 30), p=[0.4, 0.25, 0.15, 0.1, 0.1]).astype(np.uint8)
+    fixed_mask = labels == 3
+    classes = [0, 1, 2, 4]
+    filtered = mc.majority_filter(labels, size=size, classes=classes, fixed_mask=fixed_mask)
+    np.testing.assert_array_equal(filtered, reference_majority_filter(labels, size, classes, fixed_mask))
+    np.testing.assert_array_equal(filtered[fixed_mask], 3)
+
+
+def test_majority_filter_marks_relabelled_pixels_uncertain():
+    labels = np.zeros((9, 9), dtype=np.uint8)
+    labels[4, 4] = 1
+    confidence = np.full((9, 9), 0.75, dtype=np.float32)
+    settings = dict(mc.DEFAULT_SETTINGS, postprocess="majority")
+    outcome = mc._finish_outcome(labels, confidence, np.zeros((9, 9), dtype=bool),
+                                 {'mineral_names': ['quartz', 'biotite']}, settings)
+    assert not outcome['result_image'].any()
+    assert outcome['confidence_image'][4, 4] == 0
+    assert outcome['pixel_counts']['biotite'] == 0
+    changed = np.zeros((9, 9), dtype=bool)
+    changed[4, 4] = True
+    np.testing.assert_array_equal(outcome['confidence_image'][~changed], 0.75)
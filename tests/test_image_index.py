@@ -0,0 +1,97 @@
+"""
+Tests of the lazy image folder scan and the cached image index.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import mineral_classifier_Version6 as mc  # noqa: E402
+
+
+def touch(root, *rel_paths):
+    for rel_path in rel_paths:
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+
+
+def relative(paths, root):
+    return [os.path.relpath(path, root) for path in paths]
+
+
+def make_archive(root):
+    touch(root, "b.png", "A.TIF", "notes.txt", "c.jpeg",
+          os.path.join("site2", "x.tiff"), os.path.join("site1", "deep", "y.jpg"), os.path.join("site1", "z.png"),
+          os.path.join(".hidden", "h.png"), os.path.join(mc.RESULTS_FOLDER_NAME, "result.png"))
+    return ["A.TIF", "b.png", "c.jpeg", os.path.join("site1", "z.png"), os.path.join("site1", "deep", "y.jpg"),
+            os.path.join("site2", "x.tiff")]
+
+
+def test_scan_order_and_filters(tmp_path):
+    root = str(tmp_path)
+    expected = make_archive(root)
+    # Files before subdirectories, names sorted case-insensitively; results and hidden folders skipped
+    assert relative(mc.scan_image_folder(root), root) == expected
+    assert relative(mc.scan_image_folder(root, recursive=False), root) == expected[:3]
+
+
+def test_index_is_written_and_reused(tmp_path):
+    root = str(tmp_path / "images")
+    expected = make_archive(root)
+    index_path = os.path.join(root, mc.RESULTS_FOLDER_NAME, mc.IMAGE_INDEX_FILENAME)
+    
+    assert relative(mc.iter_image_paths(root, index_path), root) == expected
+    with open(index_path, encoding='utf-8') as f:
+        assert f.read().splitlines() == [mc.IMAGE_INDEX_HEADER] + expected
+    
+    # Later runs read the index instead of the folder
+    touch(root, "new.png")
+    assert relative(mc.iter_image_paths(root, index_path), root) == expected
+    # refresh rescans and rewrites it
+    rescanned = expected[:3] + ["new.png"] + expected[3:]
+    assert relative(mc.iter_image_paths(root, index_path, refresh=True), root) == rescanned
+    assert relative(mc.iter_image_paths(root, index_path), root) == rescanned
+
+
+def test_index_relative_paths_follow_a_moved_archive(tmp_path):
+    root = str(tmp_path / "images")
+    expected = make_archive(root)
+    index_path = os.path.join(root, mc.RESULTS_FOLDER_NAME, mc.IMAGE_INDEX_FILENAME)
+    list(mc.iter_image_paths(root, index_path))
+    
+    moved = str(tmp_path / "remounted")
+    os.rename(root, moved)
+    moved_index = os.path.join(moved, mc.RESULTS_FOLDER_NAME, mc.IMAGE_INDEX_FILENAME)
+    paths = list(mc.iter_image_paths(moved, moved_index))
+    assert relative(paths, moved) == expected
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_abandoned_scan_does_not_commit_the_index(tmp_path):
+    root = str(tmp_path / "images")
+    expected = make_archive(root)
+    index_path = os.path.join(root, mc.RESULTS_FOLDER_NAME, mc.IMAGE_INDEX_FILENAME)
+    
+    scan = mc.iter_image_paths(root, index_path)
+    next(scan)
+    scan.close()
+    assert not os.path.exists(index_path)
+    assert not os.path.exists(index_path + ".tmp")
+    assert relative(mc.iter_image_paths(root, index_path), root) == expected
+    assert os.path.exists(index_path)
+
+
+def test_outdated_index_is_rebuilt(tmp_path):
+    root = str(tmp_path / "images")
+    expected = make_archive(root)
+    index_path = os.path.join(root, mc.RESULTS_FOLDER_NAME, mc.IMAGE_INDEX_FILENAME)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.write("stale.png\n")
+    
+    assert relative(mc.iter_image_paths(root, index_path), root) == expected
+    with open(index_path, encoding='utf-8') as f:
+        assert f.readline().rstrip('\n') == mc.IMAGE_INDEX_HEADER
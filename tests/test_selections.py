@@ -0,0 +1,66 @@
+"""
+Tests of saving and loading mineral selections.
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import mineral_classifier_Version6 as mc  # noqa: E402
+
+
+def make_samples(points):
+    samples = mc.SampleSet()
+    for x, y, color in points:
+        samples.append(x, y, color)
+    return samples
+
+
+@pytest.mark.parametrize("extension", [".npz", ".json"])
+def test_selections_round_trip(tmp_path, extension):
+    mineral_colors = {
+        'quartz': {'color': (220, 220, 215), 'samples': make_samples([(1, 2, (220, 221, 219)), (5, 7, (218, 220, 214))])},
+        'biotite': {'color': (130, 90, 50), 'samples': make_samples([(10, 3, (131, 88, 52))])},
+        'empty': {'color': (0, 0, 0), 'samples': mc.SampleSet()},
+    }
+    path = str(tmp_path / f"thin_section{mc.SELECTIONS_SUFFIX}{extension}")
+    if extension == ".npz":
+        mc.save_selections(path, "/images/thin_section.png", mineral_colors)
+    else:
+        # Format written by earlier versions
+        with open(path, 'w') as f:
+            json.dump({'image_path': "/images/thin_section.png", 'minerals': {
+                name: {'color': list(data['color']),
+                       'samples': [[int(x), int(y), [int(c) for c in color]]
+                                   for (x, y), color in zip(data['samples'].coords, data['samples'].colors)]}
+                for name, data in mineral_colors.items()}}, f)
+
+    image_path, loaded = mc.load_selections(path)
+    assert image_path == "/images/thin_section.png"
+    assert list(loaded) == list(mineral_colors)
+    for name, data in mineral_colors.items():
+        np.testing.assert_array_equal(loaded[name]['color'], data['color'])
+        np.testing.assert_array_equal(loaded[name]['samples'].coords, data['samples'].coords)
+        assert len(loaded[name]['samples']) == len(data['samples'])
+        if len(data['samples']):
+            np.testing.assert_array_equal(loaded[name]['samples'].colors, data['samples'].colors)
+
+    # A loaded empty mineral still takes new samples
+    loaded['empty']['samples'].append(3, 4, (1, 2, 3))
+    np.testing.assert_array_equal(loaded['empty']['samples'].colors, [[1, 2, 3]])
+
+
+def test_empty_selections_round_trip(tmp_path):
+    path = str(tmp_path / f"blank{mc.SELECTIONS_SUFFIX}.npz")
+    mc.save_selections(path, None, {'quartz': {'color': (1, 2, 3), 'samples': mc.SampleSet()}})
+    image_path, loaded = mc.load_selections(path)
+    assert image_path is None
+    assert len(loaded['quartz']['samples']) == 0
+    assert loaded['quartz']['samples'].coords.shape == (0, 2)